@@ -46,9 +46,24 @@ class ConfigEditorApp(QMainWindow):
             "TCP": {  
                 "host": "localhost",  
                 "port": 54333,  
-                "buffer_size": 8388608,  
+                "pool_size": 2,  
+                "stream": True,  
+                "batch_size": 16,  
+                "compression": "none",  
+                "compress_threshold": 65536,  
+                "pipeline": True,  
+                "ready_timeout": 60,  
+                "roi_only": True,  
+                "preview_step": 4,  
+                "server_tasks": False,  
+                "checksum": True,  
+                "data_format": "binary",  
                 "timeout": 10  
             },  
+            "core": {  
+                "n_threads": 4,  
+                "executor": "process"  
+            },  
             "logging": {  
                 "level": "INFO",  
                 "directory": None,  # 默认值为 null  
@@ -57,6 +72,7 @@ class ConfigEditorApp(QMainWindow):
             "plots": {  
                 "posterior_map_shape": [50, 50]  
             },  
+            "preprocessing": None,  # 默认值为 null  
             "scanning": {  
                 "max_points": 999,  
                 "duration": 7200,  
@@ -66,6 +82,11 @@ class ConfigEditorApp(QMainWindow):
                 "fixed_normalization": [1.0, 1.0],  
                 "merge_unique_positions": True,  
                 "base_error": 0.01,  
+                "errors_from_variance": False,  
+                "keep_repeats": False,  
+                "store_dir": None,  
+                "store_window": 32,  
+                "dtype": "float32",  
                 "initial_points": "hexgrid_2D_13"  # 默认初始点类型  
             },  
             "tasks": {  
@@ -1,9 +1,22 @@
 import asyncio
-import hashlib
+import inspect
 import logging
+import lzma
+import queue
+import select
 import socket
+import struct
+import threading
+import zlib
 from abc import abstractmethod
 from asyncio.streams import StreamReader, StreamWriter
+from contextlib import asynccontextmanager, contextmanager, suppress
+from functools import partial
+from itertools import count
+from multiprocessing import resource_tracker, shared_memory
+from typing import AsyncIterator, Awaitable, Callable, Iterator
+
+import numpy as np
 
 global_pause = False  
 def pause_scan():
@@ -13,43 +26,601 @@ def resume_scan():
     global global_pause
     global_pause = False
 
-def calculate_checksum(message: str) -> str:
+def calculate_checksum(payload: bytes | memoryview, value: int = 0) -> int:
     """
-    Calculates the checksum of a message using sha256.
+    Calculates the CRC32 checksum of a frame payload.
 
     Args:
-        message (str): The message to calculate the checksum of.
+        payload (bytes): The bytes to calculate the checksum of.
+        value (int): The checksum of the preceding bytes, to compute it incrementally.
 
     Returns:
-        str: The checksum of the message.
+        int: The checksum of the payload.
     """
-    hash_object = hashlib.sha256(message.encode())
-    hex_dig = hash_object.hexdigest()
-    return hex_dig
+    return zlib.crc32(payload, value)
 
 
-def add_checksum(message: str) -> str:
-    """add a checksum to the message"""
-    return message + f"||{calculate_checksum(message)}"
+BINARY_SUFFIX = "_BINARY"
+MAX_HEADER_SIZE = 4096  # upper bound for the header line of binary messages
 
 
-def remove_checksum(message: str) -> str:
-    """remove the checksum from the message and verify it"""
-    split = message.split("||")
-    if len(split) == 1:
-        return message
-    else:
-        message, checksum = split
-        if calculate_checksum(message) == checksum:
-            return message
+def encode_array_message(
+    code: str,
+    position,
+    data: np.ndarray,
+    offset: np.ndarray | None = None,
+    scale: np.ndarray | None = None,
+) -> bytes:
+    """Encode a position and an array as a binary message.
+
+    The message is an ASCII header line followed by the raw bytes of the array:
+
+        <code>_BINARY <n_pos> <pos_0> ... <pos_n> <shape_0>,<shape_1> <dtype> <nbytes>\n<bytes>
+
+    Quantized arrays (see `quantize_array`) add their offsets and scales to the header:
+
+        ... <dtype> <nbytes> <offset_0>,<offset_1>,... <scale_0>,<scale_1>,...\n<bytes>
+
+    Args:
+        code: command code of the message, e.g. MEASURE
+        position: position at which the array was measured
+        data: array to send
+        offset: offsets of a quantized array, one per entry of its first axis or one
+        scale: scales of a quantized array, as offset
+
+    Returns:
+        bytes: the encoded message
+    """
+    data = np.ascontiguousarray(data)
+    pos_str = " ".join([repr(float(p)) for p in position])
+    shape_str = ",".join([str(s) for s in data.shape])
+    header = (
+        f"{code}{BINARY_SUFFIX} {len(position)} {pos_str} "
+        f"{shape_str} {data.dtype.str} {data.nbytes}"
+    )
+    if offset is not None:
+        offset_str = ",".join([repr(float(o)) for o in np.ravel(offset)])
+        scale_str = ",".join([repr(float(s)) for s in np.ravel(scale)])
+        header += f" {offset_str} {scale_str}"
+    return (header + "\n").encode("ascii") + data.tobytes()
+
+
+def parse_binary_header(
+    header: bytes,
+) -> tuple[str, np.ndarray, tuple, np.dtype, int, np.ndarray | None, np.ndarray | None]:
+    """Parse the header line of a binary message
+
+    Args:
+        header: the header line, without the trailing newline
+
+    Returns:
+        code, position, shape, dtype, nbytes, offset, scale. offset and scale are None
+            unless the array is quantized.
+    """
+    vals = header.decode("ascii").split(" ")
+    code = vals[0].removesuffix(BINARY_SUFFIX)
+    n_pos = int(vals[1])
+    position = np.asarray(vals[2 : n_pos + 2], dtype=float)
+    shape = tuple(int(s) for s in vals[n_pos + 2].split(","))
+    dtype = np.dtype(vals[n_pos + 3])
+    nbytes = int(vals[n_pos + 4])
+    offset = scale = None
+    if len(vals) > n_pos + 6:
+        offset = np.asarray(vals[n_pos + 5].split(","), dtype=float)
+        scale = np.asarray(vals[n_pos + 6].split(","), dtype=float)
+    return code, position, shape, dtype, nbytes, offset, scale
+
+
+def decode_array_message(
+    message: bytes | memoryview,
+) -> tuple[str, np.ndarray, np.ndarray]:
+    """Decode a message built by `encode_array_message`
+
+    The array is a view on the message buffer, no copy is made. Quantized arrays are
+    the exception: they are dequantized to a new float32 array.
+
+    Args:
+        message: the full binary message
+
+    Returns:
+        code, position, data
+    """
+    header_end = bytes(message[:MAX_HEADER_SIZE]).index(b"\n")
+    code, position, shape, dtype, nbytes, offset, scale = parse_binary_header(
+        bytes(message[:header_end])
+    )
+    data = np.frombuffer(
+        message, dtype=dtype, count=nbytes // dtype.itemsize, offset=header_end + 1
+    )
+    data = data.reshape(shape)
+    if offset is not None:
+        data = dequantize_array(data, offset, scale)
+    return code, position, data
+
+
+QUANTIZED_DTYPES = ("float16", "uint16")
+UINT16_LEVELS = np.iinfo(np.uint16).max
+
+
+def quantize_array(
+    data: np.ndarray, dtype: str, batched: bool = False
+) -> tuple[np.ndarray, np.ndarray | None, np.ndarray | None]:
+    """Reduce an array to 16 bits per value for transport
+
+    float16 keeps ~3 significant digits, up to 65504. uint16 maps the range of each
+    spectrum linearly to 0..65535, which keeps the error below half a step of
+    (max - min) / 65535 whatever the counts are.
+
+    Args:
+        data: array to quantize
+        dtype: float16 or uint16
+        batched: data is a stack of spectra, each quantized with its own range
+
+    Returns:
+        data, offset, scale: the quantized array, and the offsets and scales restoring
+            it, see `dequantize_array`. offset and scale are None for float16.
+    """
+    if dtype == "float16":
+        return data.astype(np.float16), None, None
+    if dtype != "uint16":
+        raise ValueError(f"Unknown quantization {dtype}. Known: {QUANTIZED_DTYPES}")
+    flat = data.reshape(len(data) if batched else 1, -1)
+    offset = flat.min(axis=1)
+    scale = (flat.max(axis=1) - offset) / UINT16_LEVELS
+    scale[scale == 0] = 1  # constant spectra
+    quantized = np.empty(flat.shape, np.uint16)
+    np.rint((flat - offset[:, None]) / scale[:, None], out=quantized, casting="unsafe")
+    return quantized.reshape(data.shape), offset, scale
+
+
+def dequantize_array(
+    data: np.ndarray, offset: np.ndarray, scale: np.ndarray
+) -> np.ndarray:
+    """Restore an array quantized by `quantize_array` as float32"""
+    if len(offset) > 1:
+        broadcast = (-1,) + (1,) * (data.ndim - 1)
+        offset, scale = offset.reshape(broadcast), scale.reshape(broadcast)
+    restored = data.astype(np.float32)
+    restored *= scale.astype(np.float32)
+    restored += offset.astype(np.float32)
+    return restored
+
+
+def is_binary_message(message: bytes | memoryview | str) -> bool:
+    """check if a message was built by `encode_array_message`"""
+    if isinstance(message, str):
+        return False
+    first = bytes(message[:64]).split(b" ", 1)[0]
+    return first.endswith(BINARY_SUFFIX.encode("ascii"))
+
+
+SLOT_HEADER = struct.Struct("=q")  # sequence number of the array held by a ring slot
+
+
+class SharedRing:
+    """Ring buffer of equally shaped arrays in shared memory
+
+    The process creating the ring writes to it; processes on the same host attach to it
+    by name and read the slots they are told about, instead of receiving the arrays over
+    TCP. Each slot starts with the sequence number of the array it holds, which lets a
+    reader detect that a slot was recycled while it was reading it.
+
+    Args:
+        shape: shape of the arrays
+        dtype: dtype of the arrays
+        slots: number of arrays kept before the oldest slot is overwritten
+        name: name of an existing ring to attach to, None creates a new one
+    """
+
+    def __init__(
+        self,
+        shape: tuple[int],
+        dtype: np.dtype = np.float32,
+        slots: int = 128,
+        name: str | None = None,
+    ) -> None:
+        self.shape = tuple(int(n) for n in shape)
+        self.dtype = np.dtype(dtype)
+        self.slots = slots
+        nbytes = int(np.prod(self.shape)) * self.dtype.itemsize
+        self._stride = -(-(SLOT_HEADER.size + nbytes) // 64) * 64  # cache line aligned
+        self.owner = name is None
+        if self.owner:
+            self.shm = shared_memory.SharedMemory(create=True, size=self._stride * slots)
         else:
-            raise ValueError("Checksum mismatch")
+            self.shm = _attach_shared_memory(name)
+        self.name = self.shm.name
+        self._seq = 0
+
+    @classmethod
+    def attach(cls, description: str) -> "SharedRing":
+        """attach to the ring described by `describe`"""
+        name, slots, shape, dtype = description.split(" ")
+        shape = tuple(int(n) for n in shape.split(","))
+        return cls(shape, np.dtype(dtype), int(slots), name=name)
+
+    def describe(self) -> str:
+        """name slots shape dtype, all a reader needs to attach to the ring"""
+        shape_str = ",".join([str(n) for n in self.shape])
+        return f"{self.name} {self.slots} {shape_str} {self.dtype.str}"
+
+    def _array(self, slot: int) -> np.ndarray:
+        offset = slot * self._stride + SLOT_HEADER.size
+        return np.ndarray(self.shape, self.dtype, buffer=self.shm.buf, offset=offset)
+
+    def _sequence(self, slot: int) -> int:
+        return SLOT_HEADER.unpack_from(self.shm.buf, slot * self._stride)[0]
+
+    def write(self, data: np.ndarray) -> tuple[int, int]:
+        """write an array in the next slot
+
+        Returns:
+            slot, seq: the slot written and the sequence number of the array
+        """
+        seq = self._seq
+        slot = seq % self.slots
+        header = slot * self._stride
+        SLOT_HEADER.pack_into(self.shm.buf, header, -1)  # being written
+        self._array(slot)[...] = data
+        SLOT_HEADER.pack_into(self.shm.buf, header, seq)
+        self._seq += 1
+        return slot, seq
+
+    def read(self, slot: int, seq: int) -> np.ndarray:
+        """copy the array with sequence number seq out of its slot
+
+        Raises:
+            ValueError: if the slot was overwritten
+        """
+        data = self._array(slot).copy()
+        found = self._sequence(slot)
+        if found != seq:
+            raise ValueError(f"Ring slot {slot} was overwritten: {found} != {seq}")
+        return data
+
+    def close(self) -> None:
+        """detach from the ring, and free it if this process created it"""
+        self.shm.close()
+        if self.owner:
+            self.shm.unlink()
+
+
+def _attach_shared_memory(name: str) -> shared_memory.SharedMemory:
+    """attach to a shared memory block owned by another process"""
+    try:
+        return shared_memory.SharedMemory(name=name, track=False)  # python >= 3.13
+    except TypeError:
+        shm = shared_memory.SharedMemory(name=name)
+        # otherwise the resource tracker frees the block when this process exits
+        resource_tracker.unregister(shm._name, "shared_memory")
+        return shm
+
+
+FRAME_HEADER = struct.Struct("!I")  # payload length and flags, network byte order
+FRAME_CHECKSUM = struct.Struct("!I")  # CRC32 of the payload, sent after it
+MAX_FRAME_SIZE = (1 << 30) - 1  # refuse frames announcing more than ~1 GB
+SMALL_FRAME_SIZE = 64 * 1024  # below this, header and payload are sent in one call
+COMPRESSED_FLAG = 1 << 31  # set in the frame header when the payload is compressed
+CHECKSUM_FLAG = 1 << 30  # set in the frame header when the payload has a checksum
+COMPRESS_THRESHOLD = 64 * 1024  # smaller payloads are sent uncompressed
+COMPRESS_COMMAND = "COMPRESS"
+PIPELINE_COMMAND = "PIPELINE"
+REQUEST_ID = struct.Struct("!I")  # id of the request a pipelined frame belongs to
+MORE_FLAG = 1 << 31  # set in the request id of all but the last chunk of a response
+RESPONSE_LENGTH = struct.Struct("!Q")  # after the id of the first of several chunks
+PIPELINE_CHUNK_SIZE = 256 * 1024  # pipelined responses are interleaved in such chunks
 
 
-def check_checksum(message: str) -> bool:
-    """check the checksum of the message"""
-    message, checksum = message.split("||")
-    return calculate_checksum(message) == checksum
+class Codec:
+    """A compression codec for frame payloads
+
+    Args:
+        name: name under which the codec is negotiated
+        compress: function compressing bytes
+        decompress: function restoring the bytes compressed by `compress`
+    """
+
+    def __init__(
+        self,
+        name: str,
+        compress: Callable[[bytes], bytes],
+        decompress: Callable[[bytes], bytes],
+    ) -> None:
+        self.name = name
+        self.compress = compress
+        self.decompress = decompress
+
+
+CODECS: dict[str, Codec] = {}
+
+
+def register_codec(
+    name: str, compress: Callable[[bytes], bytes], decompress: Callable[[bytes], bytes]
+) -> Codec:
+    """make a codec available for negotiation, replacing any codec of the same name"""
+    CODECS[name] = Codec(name, compress, decompress)
+    return CODECS[name]
+
+
+# spectra are large and arrive often: favour speed over ratio
+register_codec("zlib", partial(zlib.compress, level=1), zlib.decompress)
+register_codec("lzma", partial(lzma.compress, preset=0), lzma.decompress)
+
+
+class Compression:
+    """Compression negotiated on a connection
+
+    Args:
+        codec: codec used for payloads of at least threshold bytes
+        threshold: size below which payloads are sent uncompressed
+    """
+
+    def __init__(self, codec: Codec, threshold: int = COMPRESS_THRESHOLD) -> None:
+        self.codec = codec
+        self.threshold = threshold
+
+    def compress(self, payload: bytes | memoryview) -> tuple[bytes | memoryview, bool]:
+        """compress the payload if it is worth it
+
+        Returns:
+            payload, compressed: the payload to send and whether it was compressed
+        """
+        if len(payload) < self.threshold:
+            return payload, False
+        compressed = self.codec.compress(payload)
+        if len(compressed) >= len(payload):
+            return payload, False
+        return compressed, True
+
+    def decompress(self, payload: bytes | memoryview) -> bytes:
+        """restore a payload sent compressed"""
+        return self.codec.decompress(payload)
+
+    def request(self) -> str:
+        """message asking the server for this compression"""
+        return f"{COMPRESS_COMMAND} {self.codec.name} {self.threshold}"
+
+    @classmethod
+    def from_message(cls, message: str) -> "Compression | None":
+        """compression agreed in a COMPRESS request or reply, None if not supported
+
+        Args:
+            message: COMPRESS codec [threshold]
+        """
+        command, *args = message.strip("\r\n").split(" ")
+        if command != COMPRESS_COMMAND or len(args) == 0 or args[0] not in CODECS:
+            return None
+        threshold = int(args[1]) if len(args) > 1 else COMPRESS_THRESHOLD
+        return cls(CODECS[args[0]], threshold)
+
+
+def pack_frame_header(
+    payload: bytes | memoryview, compressed: bool = False, checksum: bool = False
+) -> bytes:
+    """header announcing a frame with the given payload"""
+    if len(payload) > MAX_FRAME_SIZE:
+        raise ValueError(f"Frame is too long. {len(payload)}/{MAX_FRAME_SIZE}")
+    flags = (COMPRESSED_FLAG if compressed else 0) | (CHECKSUM_FLAG if checksum else 0)
+    return FRAME_HEADER.pack(len(payload) | flags)
+
+
+def unpack_frame_header(header: bytes | bytearray) -> tuple[int, bool, bool]:
+    """length of the payload announced by a frame header, if it is compressed and if
+    it is followed by a checksum"""
+    (length,) = FRAME_HEADER.unpack(header)
+    compressed = bool(length & COMPRESSED_FLAG)
+    checksum = bool(length & CHECKSUM_FLAG)
+    length &= MAX_FRAME_SIZE
+    return length, compressed, checksum
+
+
+def pack_frame_checksum(payload: bytes | memoryview, value: int = 0) -> bytes:
+    """trailer sent after a payload announced with a checksum
+
+    value is the checksum of the bytes sent between the header and the payload, if any.
+    """
+    return FRAME_CHECKSUM.pack(calculate_checksum(payload, value))
+
+
+def verify_frame_checksum(trailer: bytes | bytearray, value: int) -> None:
+    """compare the checksum calculated on a received payload with its trailer"""
+    (expected,) = FRAME_CHECKSUM.unpack(trailer)
+    if value != expected:
+        raise ValueError(f"Checksum mismatch: {value:08x} != {expected:08x}")
+
+
+def send_frame(
+    s: socket.socket,
+    payload: bytes | memoryview,
+    compression: Compression | None = None,
+    checksum: bool = False,
+) -> None:
+    """send a length-prefixed frame on a blocking socket
+
+    Args:
+        s: socket to send on
+        payload: payload of the frame
+        compression: compression negotiated on the connection, if any
+        checksum: send the CRC32 of the payload after it
+    """
+    compressed = False
+    if compression is not None:
+        payload, compressed = compression.compress(payload)
+    header = pack_frame_header(payload, compressed, checksum)
+    trailer = pack_frame_checksum(payload) if checksum else b""
+    if len(payload) < SMALL_FRAME_SIZE:
+        s.sendall(header + payload + trailer)
+    else:
+        s.sendall(header)
+        s.sendall(payload)
+        s.sendall(trailer)
+
+
+class FrameBuffer:
+    """Reusable receive buffer for length-prefixed frames
+
+    Each frame is read with recv_into straight into a preallocated bytearray, which is only
+    replaced by a larger one when a longer frame arrives. The returned memoryview points into
+    the buffer and is only valid until the next frame is received: copy what must be kept.
+    Compressed frames are decompressed with the compression negotiated on the connection.
+    Checksums are calculated on the fly while the payload is received, and verified before
+    anything is decoded.
+
+    Args:
+        size: initial size of the buffer
+        checksum: reject frames sent without checksum
+    """
+
+    def __init__(self, size: int = 64 * 1024, checksum: bool = False) -> None:
+        self._header = bytearray(FRAME_HEADER.size)
+        self._trailer = bytearray(FRAME_CHECKSUM.size)
+        self._buffer = bytearray(size)
+        self.compression: Compression | None = None
+        self.checksum = checksum
+
+    def _require_checksum(self, has_checksum: bool) -> None:
+        if self.checksum and not has_checksum:
+            raise ValueError("Frame received without checksum")
+
+    def _decompress(self, view: memoryview, compressed: bool) -> memoryview:
+        if not compressed:
+            return view
+        if self.compression is None:
+            raise ValueError("Compressed frame received, but no compression was negotiated")
+        return memoryview(self.compression.decompress(view))
+
+    def _payload_view(self, length: int) -> memoryview:
+        if len(self._buffer) < length:
+            # a new buffer, views returned earlier keep the old one alive
+            self._buffer = bytearray(max(length, 2 * len(self._buffer)))
+        return memoryview(self._buffer)[:length]
+
+    def recv(self, s: socket.socket) -> memoryview:
+        """receive a frame from a blocking socket"""
+        _recv_exactly_into(s, memoryview(self._header))
+        length, compressed, has_checksum = unpack_frame_header(self._header)
+        view = self._payload_view(length)
+        value = _recv_exactly_into(s, view, has_checksum)
+        if has_checksum:
+            _recv_exactly_into(s, memoryview(self._trailer))
+            verify_frame_checksum(self._trailer, value)
+        self._require_checksum(has_checksum)
+        return self._decompress(view, compressed)
+
+    async def arecv(self, s: socket.socket) -> memoryview:
+        """receive a frame from a non-blocking socket, without blocking the event loop"""
+        loop = asyncio.get_running_loop()
+        await _arecv_exactly_into(loop, s, memoryview(self._header))
+        length, compressed, has_checksum = unpack_frame_header(self._header)
+        view = self._payload_view(length)
+        value = await _arecv_exactly_into(loop, s, view, has_checksum)
+        if has_checksum:
+            await _arecv_exactly_into(loop, s, memoryview(self._trailer))
+            verify_frame_checksum(self._trailer, value)
+        self._require_checksum(has_checksum)
+        return self._decompress(view, compressed)
+
+
+def _recv_exactly_into(
+    s: socket.socket, view: memoryview, checksum: bool = False, value: int = 0
+) -> int:
+    """fill view with bytes from the socket, returning their checksum if asked for
+
+    value is the checksum of the bytes received before, if any.
+    """
+    received = 0
+    while received < len(view):
+        n = s.recv_into(view[received:])
+        if n == 0:
+            raise ConnectionError(
+                f"Connection closed by the server after {received}/{len(view)} bytes"
+            )
+        if checksum:
+            value = calculate_checksum(view[received : received + n], value)
+        received += n
+    return value
+
+
+async def _arecv_exactly_into(
+    loop: asyncio.AbstractEventLoop,
+    s: socket.socket,
+    view: memoryview,
+    checksum: bool = False,
+    value: int = 0,
+) -> int:
+    """fill view with bytes from the socket, returning their checksum if asked for
+
+    value is the checksum of the bytes received before, if any.
+    """
+    received = 0
+    while received < len(view):
+        n = await loop.sock_recv_into(s, view[received:])
+        if n == 0:
+            raise ConnectionError(
+                f"Connection closed by the server after {received}/{len(view)} bytes"
+            )
+        if checksum:
+            value = calculate_checksum(view[received : received + n], value)
+        received += n
+    return value
+
+
+def _encode_request(msg: str, CLRF: bool, logger: logging.Logger) -> bytes:
+    """prepare a message to be sent"""
+    logger.debug(f"TCP Sending message: {msg}")
+    if CLRF:
+        msg += "\r\n"
+    return msg.encode()
+
+
+def _decode_response(
+    data: memoryview, raw: bool, logger: logging.Logger
+) -> str | bytes | memoryview:
+    """interpret a frame received as response"""
+    if is_binary_message(data):
+        logger.debug(f"TCP Received binary message: {len(data)/1024:,.1f} kB")
+        return data
+    if raw:
+        return bytes(data).rstrip(b"\r\n")
+    data = str(data, "utf-8")
+    datastr = data[:30] + "..." if len(data) > 30 else data
+    logger.debug(f"TCP Received: {datastr}")
+    return data.strip("\r\n")
+
+
+def _requested_compression(
+    codec: str | None, threshold: int = COMPRESS_THRESHOLD
+) -> Compression | None:
+    """compression to ask for, None for no compression"""
+    if codec is None or codec == "none":
+        return None
+    if codec not in CODECS:
+        raise ValueError(f"Unknown compression codec {codec}. Known: {list(CODECS)}")
+    return Compression(CODECS[codec], threshold)
+
+
+def _agreed_compression(reply: str, logger: logging.Logger) -> Compression | None:
+    """compression accepted by the server in its reply to a COMPRESS request"""
+    compression = Compression.from_message(reply)
+    if compression is None:
+        logger.warning(f"Server refused compression, sending uncompressed: {reply}")
+    else:
+        logger.debug(f"TCP compression: {compression.codec.name} >= {compression.threshold}")
+    return compression
+
+
+def _is_alive(s: socket.socket | None) -> bool:
+    """check that a socket is open and that the server did not close it"""
+    if s is None:
+        return False
+    try:
+        readable, _, _ = select.select([s], [], [], 0)
+        if readable:
+            # the only thing to read between requests is the end of the stream
+            return len(s.recv(1, socket.MSG_PEEK)) > 0
+    except (OSError, ValueError):
+        return False
+    return True
 
 
 def send_tcp_message(
@@ -57,23 +628,27 @@ def send_tcp_message(
     port: int | str,
     msg: str,
     checksum: bool = False,
-    buffer_size: int = 1024,
     verbose: bool = False,
     timeout: float = 1.0,
     CLRF: bool = True,
     logger=None,
-) -> str:
+    raw: bool = False,
+) -> str | bytes | memoryview:
     """send a message to a host and port and return the response
 
+    Opens a new connection for this message only. Use `Connection` or `ConnectionPool` to
+    send several messages over the same connection.
+    Binary responses (see `encode_array_message`) are always returned as a memoryview.
+
     Args:
         host: host to connect to
         port: port to connect to
         msg: message to send
-        checksum: add a checksum to the message
-        buffer_size: size of the buffer to use
+        checksum: send the message with a CRC32 checksum, and require one on the response
         verbose: print out extra information
         timeout: timeout for the connection: # TODO: implement timeout
         CLRF: add a carriage return and line feed to the message
+        raw: return the response as bytes, without decoding it
 
     Returns:
         data: response from host
@@ -83,33 +658,309 @@ def send_tcp_message(
     with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as s:
         logger.debug(f"TPC Connecting to {host}:{port}")
         s.connect((host, port))
-        if checksum:
-            msg = add_checksum(msg)
-            logger.debug(f"TCP Sending message with checksum: {msg}")
-        else:
-            logger.debug(f"TCP Sending message: {msg}")
-        if CLRF:
-            msg += "\r\n"
-        if len(msg) > buffer_size:
-            raise ValueError(f"Message is too long. {len(msg)}/{buffer_size}")
-        s.sendall(msg.encode())
+        send_frame(s, _encode_request(msg, CLRF, logger), checksum=checksum)
         logger.debug("TCP Waiting for response")
-        data = s.recv(buffer_size).decode()
-        datastr = data[:30] + "..." if len(data) > 30 else data
-        logger.debug(f"TCP Received: {datastr}")
-        data = remove_checksum(data)
+        data = FrameBuffer(size=0, checksum=checksum).recv(s)
+    return _decode_response(data, raw, logger)
 
-    return data.strip("\r\n")
+
+class RequestNotSent(ConnectionError):
+    """The connection dropped before a request was sent whole
+
+    The server drops incomplete frames, so the request did not run and can be sent again.
+    """
+
+
+class Connection:
+    """A persistent connection to a TCP server
+
+    The socket is opened at the first request and kept open for the following ones.
+    Before each request the connection is checked, and it is opened again if the server
+    closed it. If the connection drops while sending a request, the request is sent once
+    more on a new connection. Once sent, a request is never sent again, even if its
+    response is lost: the server may have run it already.
+
+    Responses are received in a buffer owned by the connection. Binary responses are
+    returned as a memoryview on that buffer, valid until the next request.
+
+    Args:
+        host: host to connect to
+        port: port to connect to
+        checksum: send the messages with a CRC32 checksum, and require one on the responses
+        timeout: timeout for connecting and for each response, None waits forever
+        CLRF: add a carriage return and line feed to the messages
+        logger: logger to use
+        compression: codec to ask the server for when connecting, see `CODECS`.
+            The connection stays uncompressed if the server does not support it.
+        compress_threshold: size below which payloads are sent uncompressed
+    """
+
+    def __init__(
+        self,
+        host: str,
+        port: int,
+        checksum: bool = False,
+        timeout: float | None = None,
+        CLRF: bool = True,
+        logger: logging.Logger = None,
+        compression: str | None = None,
+        compress_threshold: int = COMPRESS_THRESHOLD,
+    ) -> None:
+        self.logger = logger or logging.getLogger("TCPConnection")
+        self.host = host
+        self.port = port
+        self.checksum = checksum
+        self.timeout = timeout
+        self.CLRF = CLRF
+        self.socket = None
+        self._frames = FrameBuffer(checksum=checksum)
+        self.compression = _requested_compression(compression, compress_threshold)
+
+    def connect(self) -> None:
+        """open the connection, closing the previous one if any"""
+        self.close()
+        self.logger.debug(f"TCP Connecting to {self.host}:{self.port}")
+        self.socket = socket.create_connection((self.host, self.port), self.timeout)
+        self.socket.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        if self.compression is not None:
+            request = self.compression.request()
+            request = _encode_request(request, self.CLRF, self.logger)
+            send_frame(self.socket, request, checksum=self.checksum)
+            reply = _decode_response(self._frames.recv(self.socket), False, self.logger)
+            self._frames.compression = _agreed_compression(reply, self.logger)
+
+    def close(self) -> None:
+        """close the connection"""
+        if self.socket is not None:
+            try:
+                self.socket.close()
+            finally:
+                self.socket = None
+
+    def is_alive(self) -> bool:
+        """health check: the connection is open and the server did not close it"""
+        return _is_alive(self.socket)
+
+    def request(self, msg: str, raw: bool = False) -> str | bytes | memoryview:
+        """send a message and return the response
+
+        Args:
+            msg: message to send
+            raw: return the response as bytes, without decoding it
+
+        Returns:
+            data: response from host
+        """
+        if not self.is_alive():
+            self.connect()
+        request = _encode_request(msg, self.CLRF, self.logger)
+        try:
+            try:
+                send_frame(
+                    self.socket, request, self._frames.compression, self.checksum
+                )
+            except ConnectionError as e:
+                self.logger.warning(f"TCP connection lost ({e}), reconnecting...")
+                self.connect()
+                send_frame(
+                    self.socket, request, self._frames.compression, self.checksum
+                )
+            data = self._frames.recv(self.socket)
+        except OSError:
+            # a late response would be read as the answer to the next request
+            self.close()
+            raise
+        return _decode_response(data, raw, self.logger)
+
+    def __del__(self) -> None:
+        try:
+            self.close()
+        except Exception:
+            pass
+
+
+class ConnectionPool:
+    """A small pool of persistent connections to the same server
+
+    Connections are opened when needed, up to size, and reused afterwards. The pool can be
+    shared between threads.
+
+    Args:
+        host: host to connect to
+        port: port to connect to
+        size: maximum number of open connections
+        kwargs: passed to `Connection`
+    """
+
+    def __init__(self, host: str, port: int, size: int = 2, **kwargs) -> None:
+        self.host = host
+        self.port = port
+        self.size = size
+        self.kwargs = kwargs
+        self._connections: list[Connection] = []
+        self._idle = queue.LifoQueue()
+        self._lock = threading.Lock()
+
+    def _get(self) -> Connection:
+        """get an idle connection, or a new one if the pool is not full"""
+        try:
+            return self._idle.get_nowait()
+        except queue.Empty:
+            pass
+        with self._lock:
+            if len(self._connections) < self.size:
+                connection = Connection(self.host, self.port, **self.kwargs)
+                self._connections.append(connection)
+                return connection
+        return self._idle.get()
+
+    @contextmanager
+    def connection(self) -> Iterator[Connection]:
+        """borrow a connection from the pool"""
+        connection = self._get()
+        try:
+            yield connection
+        finally:
+            self._idle.put(connection)
+
+    def request(self, msg: str, raw: bool = False) -> str | bytes:
+        """send a message on one of the connections and return the response
+
+        See `Connection.request`.
+        """
+        with self.connection() as connection:
+            return connection.request(msg, raw=raw)
+
+    def close(self) -> None:
+        """close all connections"""
+        for connection in self._connections:
+            connection.close()
+
+
+async def _resolve_response(
+    response: str | bytes | Awaitable[str | bytes],
+) -> str | bytes:
+    """wait for a response returned as an awaitable by `Server.parse_message`"""
+    if not inspect.isawaitable(response):
+        return response
+    try:
+        return await response
+    except Exception as e:
+        return f"ERROR {type(e).__name__} {e}"
+
+
+def _encode_response(
+    response: str | bytes, compression: Compression | None
+) -> tuple[bytes, bool]:
+    """payload of a response, and whether it was compressed"""
+    if isinstance(response, str):
+        response = response.encode("utf-8")
+    if compression is None:
+        return response, False
+    return compression.compress(response)
+
+
+async def _aencode_response(
+    response: str | bytes, compression: Compression | None
+) -> tuple[bytes, bool]:
+    """`_encode_response`, in a worker thread for large responses
+
+    Encoding and compressing spectra takes milliseconds, which would stall the other
+    connections and the other responses of a pipelined one.
+    """
+    if len(response) < SMALL_FRAME_SIZE:
+        return _encode_response(response, compression)
+    return await asyncio.to_thread(_encode_response, response, compression)
+
+
+class ResponseMultiplexer:
+    """Sends the responses of a pipelined connection as soon as they are ready
+
+    Each response is sent by its own task, split in chunks of at most chunk_size bytes
+    tagged with its request id. Chunks of different responses are interleaved, so a short
+    response never waits for more than one chunk of a long one. The first chunk of a
+    response sent in several also carries its whole length, see `RESPONSE_LENGTH`, so
+    that the client receives all of them into a single buffer.
+
+    Args:
+        writer: writer of the connection
+        logger: logger of the server
+        chunk_size: size of the chunks long responses are split into
+    """
+
+    def __init__(
+        self,
+        writer: StreamWriter,
+        logger: logging.Logger,
+        chunk_size: int = PIPELINE_CHUNK_SIZE,
+    ) -> None:
+        self.writer = writer
+        self.logger = logger
+        self.chunk_size = chunk_size
+        self._lock = asyncio.Lock()  # one chunk at a time, in the order they queue up
+        self._tasks: set[asyncio.Task] = set()
+
+    def send(
+        self,
+        request_id: int,
+        response: str | bytes | Awaitable[str | bytes],
+        compression: Compression | None = None,
+        checksum: bool = False,
+    ) -> None:
+        """start sending a response in the background, once it is ready"""
+        task = asyncio.ensure_future(
+            self._send(request_id, response, compression, checksum)
+        )
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    async def _send(
+        self,
+        request_id: int,
+        response: str | bytes | Awaitable[str | bytes],
+        compression: Compression | None,
+        checksum: bool,
+    ) -> None:
+        response = await _resolve_response(response)
+        response, compressed = await _aencode_response(response, compression)
+        view = memoryview(response)
+        try:
+            for start in range(0, max(len(view), 1), self.chunk_size):
+                chunk = view[start : start + self.chunk_size]
+                more = start + self.chunk_size < len(view)
+                tag = REQUEST_ID.pack(request_id | (MORE_FLAG if more else 0))
+                if start == 0 and more:
+                    tag += RESPONSE_LENGTH.pack(len(view))
+                async with self._lock:
+                    self.writer.write(pack_frame_header(chunk, compressed, checksum))
+                    self.writer.write(tag)
+                    self.writer.write(chunk)
+                    if checksum:
+                        self.writer.write(
+                            pack_frame_checksum(chunk, calculate_checksum(tag))
+                        )
+                    await self.writer.drain()
+                # drain does not suspend while the socket keeps up: let requests in
+                await asyncio.sleep(0)
+        except ConnectionError as e:
+            self.logger.debug(f"Response {request_id} not sent: {e}")
+
+    async def close(self) -> None:
+        """stop sending the responses still in progress"""
+        for task in list(self._tasks):
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
 
 
 class Server:
+    STREAM_COMMAND = "STREAM"
+
     def __init__(
         self,
         host: str,
         port: int,
         checksum: bool = False,
         timeout: float = 0.1,
-        message_size: int = 1024 * 1024 * 16,
         logger: logging.Logger = None,
     ) -> None:
         self.logger = logger or logging.getLogger("TCPServer")
@@ -117,48 +968,211 @@ class Server:
         self.host = host
         self.port = port
         self.server = None
-        self.message_size = message_size
 
     async def handle_client(self, reader: StreamReader, writer: StreamWriter):
         """
         Handle communication with a client.
 
+        The connection is kept open until the client closes it. Messages and responses are
+        sent as length-prefixed frames, see `send_frame`. A COMPRESS request sets the
+        compression of the following frames on this connection, see `Compression`.
+        Responses carry a checksum when the request did, or when the server requires them.
+
+        After a PIPELINE request, each frame starts with the id of its request, see
+        `REQUEST_ID`. Requests are still handled in the order they arrive, but their
+        responses are sent concurrently by a `ResponseMultiplexer`, so they may arrive
+        out of order.
+
         Args:
             reader (StreamReader): The reader object for receiving data from the client.
             writer (StreamWriter): The writer object for sending data to the client.
         """
         client_address = writer.get_extra_info("peername")
         self.logger.debug(f"New connection from {client_address}")
+        compression = None
+        pipeline = None  # ResponseMultiplexer, once PIPELINE was agreed
 
         while True:
-            data = await reader.read(self.message_size)
-            if not data:
+            try:
+                header = await reader.readexactly(FRAME_HEADER.size)
+                length, compressed, has_checksum = unpack_frame_header(header)
+                if pipeline is not None:
+                    length += REQUEST_ID.size
+                data = await reader.readexactly(length)
+                if has_checksum:
+                    trailer = await reader.readexactly(FRAME_CHECKSUM.size)
+            except (asyncio.IncompleteReadError, ConnectionError, ValueError):
                 break
-            if self.checksum and "||" in data.decode("utf-8"):
-                # Verify the checksum
-                message, recieved_checksum = data.decode("utf-8").split("||")
-                calculated_checksum = calculate_checksum(data.decode("utf-8"))
-                if recieved_checksum != calculated_checksum:
-                    self.logger.error(
-                        f"Checksum mismatch: {recieved_checksum} != {calculated_checksum}"
-                    )
+            checksum = has_checksum or self.checksum
+            request_id = None
+            if pipeline is not None:
+                (request_id,) = REQUEST_ID.unpack_from(data)
+                request_id &= ~MORE_FLAG
+            try:
+                if has_checksum:
+                    verify_frame_checksum(trailer, calculate_checksum(data))
+                elif self.checksum:
+                    raise ValueError("No checksum found")
+            except ValueError as e:
+                self.logger.error(e)
+                response = f"ERROR ChecksumError {e}"
+                if pipeline is not None:
+                    pipeline.send(request_id, response, None, checksum)
                     continue
-            elif self.checksum:
-                self.logger.error("No checksum found")
+                try:
+                    await self.write_frame(writer, response, None, checksum)
+                except ConnectionError:
+                    break
                 continue
-            else:
-                message = data.decode("utf-8")
+            if pipeline is not None:
+                data = data[REQUEST_ID.size :]
+            if compressed:
+                if compression is None:
+                    self.logger.error("Compressed frame without negotiated compression")
+                    break
+                data = compression.decompress(data)
+            message = data.decode("utf-8")
             self.logger.debug(f"Received message: {message}")
-            response = self.parse_message(message)
+            command, *args = message.strip("\r\n").split(" ")
+            if command == self.STREAM_COMMAND and pipeline is None:
+                # the connection is dedicated to the stream from now on
+                await self.handle_stream(
+                    reader, writer, *args, compression=compression, checksum=checksum
+                )
+                break
+            previous = compression
+            if command == self.STREAM_COMMAND:
+                response = "ERROR ValueError STREAM needs a connection of its own"
+            elif command == COMPRESS_COMMAND:
+                response = self.negotiate_compression(*args)
+                # the reply itself is sent with the previous compression
+                compression = Compression.from_message(response)
+            elif command == PIPELINE_COMMAND:
+                response = self.negotiate_pipeline(*args)
+            else:
+                response = self.parse_message(message)
             # Send a response
-            writer.write(response.encode("utf-8"))
-            await writer.drain()
+            if pipeline is not None:
+                pipeline.send(request_id, response, previous, checksum)
+                continue
+            try:
+                response = await _resolve_response(response)
+                await self.write_frame(writer, response, previous, checksum)
+            except ConnectionError:
+                break
+            if command == PIPELINE_COMMAND and response == f"{PIPELINE_COMMAND} on":
+                pipeline = ResponseMultiplexer(writer, self.logger)
 
+        if pipeline is not None:
+            await pipeline.close()
         self.logger.debug(f"Connection from {client_address} closed")
         writer.close()
 
+    def negotiate_compression(self, codec: str = "none", threshold: str = None) -> str:
+        """
+        Reply to a COMPRESS request.
+
+        Args:
+            codec (str): The codec asked for by the client, see `CODECS`.
+            threshold (str): The size below which payloads are sent uncompressed.
+
+        Returns:
+            str: COMPRESS codec threshold, or COMPRESS none if the codec is not supported.
+        """
+        if codec not in CODECS:
+            return f"{COMPRESS_COMMAND} none"
+        threshold = COMPRESS_THRESHOLD if threshold is None else int(threshold)
+        return f"{COMPRESS_COMMAND} {codec} {threshold}"
+
+    def negotiate_pipeline(self, *args) -> str:
+        """
+        Reply to a PIPELINE request.
+
+        Override to return "PIPELINE off" if responses must not be reordered.
+
+        Returns:
+            str: PIPELINE on, after which frames on this connection carry request ids.
+        """
+        return f"{PIPELINE_COMMAND} on"
+
+    async def write_frame(
+        self,
+        writer: StreamWriter,
+        response: str | bytes,
+        compression: Compression | None = None,
+        checksum: bool = False,
+    ) -> None:
+        """send a response to the client as a length-prefixed frame"""
+        response, compressed = await _aencode_response(response, compression)
+        writer.write(pack_frame_header(response, compressed, checksum))
+        writer.write(response)
+        if checksum:
+            writer.write(pack_frame_checksum(response))
+        await writer.drain()
+
+    async def handle_stream(
+        self,
+        reader: StreamReader,
+        writer: StreamWriter,
+        *args,
+        compression: Compression | None = None,
+        checksum: bool = False,
+    ) -> None:
+        """
+        Push the messages of `stream_messages` to the client until either side stops.
+
+        Args:
+            reader (StreamReader): The reader object of the client, watched for disconnection.
+            writer (StreamWriter): The writer object for sending data to the client.
+            args: arguments of the STREAM command, passed to `stream_messages`.
+            compression (Compression): The compression negotiated on the connection.
+            checksum (bool): Send the messages with a checksum.
+        """
+        self.logger.info(f"Streaming to {writer.get_extra_info('peername')}")
+        stream = self.stream_messages(*args)
+        # nothing is expected from the client, reading only detects when it leaves
+        client_gone = asyncio.ensure_future(reader.read())
+        try:
+            while True:
+                next_message = asyncio.ensure_future(anext(stream))
+                await asyncio.wait(
+                    {next_message, client_gone}, return_when=asyncio.FIRST_COMPLETED
+                )
+                if client_gone.done():
+                    next_message.cancel()
+                    with suppress(asyncio.CancelledError, StopAsyncIteration):
+                        await next_message
+                    break
+                try:
+                    response = next_message.result()
+                except StopAsyncIteration:
+                    break
+                await self.write_frame(writer, response, compression, checksum)
+        except NotImplementedError as e:
+            await self.write_frame(
+                writer, f"ERROR {type(e).__name__} {e}", None, checksum
+            )
+        except ConnectionError:
+            pass
+        finally:
+            client_gone.cancel()
+            await stream.aclose()
+        self.logger.info(f"Stream to {writer.get_extra_info('peername')} ended")
+
+    async def stream_messages(self, *args) -> AsyncIterator[str | bytes]:
+        """
+        Messages pushed to a client that sent the STREAM command.
+
+        Override in subclasses to support streaming.
+
+        Yields:
+            str | bytes: The messages to send to the client.
+        """
+        raise NotImplementedError("this server does not support streaming")
+        yield
+
     @abstractmethod
-    def parse_message(self, message: str) -> str:
+    def parse_message(self, message: str) -> str | bytes | Awaitable[str | bytes]:
         """
         Parse a message received from the client.
 
@@ -166,7 +1180,11 @@ class Server:
             message (str): The message to parse.
 
         Returns:
-            str: The response to send to the client.
+            str | bytes: The response to send to the client. bytes are sent as they are.
+                Responses that must wait for an event, or take long to encode, can be
+                returned as an awaitable, e.g. of `asyncio.to_thread`, which is awaited
+                before sending. Pipelined connections keep serving other requests
+                meanwhile, and interleave the chunks of long responses with them.
         """
         response = f'parsed message "{message[:15]}...{message[-15:]}"'
         self.logger.debug(response, end="")
@@ -212,6 +1230,26 @@ class Server:
             loop.close()
 
 class Client:
+    """Non-blocking client for a `Server`
+
+    With pipeline=True, the client asks the server to tag frames with request ids (see
+    `Server.handle_client`). Requests are then sent without waiting for the previous
+    responses, which a background task hands to the waiting requests as they arrive, in
+    any order. Servers refusing PIPELINE are used one request at a time.
+
+    Args:
+        host: host to connect to
+        port: port to connect to
+        checksum: protect the messages with a CRC32 checksum
+        end: appended to each message
+        verbose: print out extra information
+        timeout: timeout for connecting
+        logger: logger to use
+        compression: codec used for large payloads, see `CODECS`
+        compress_threshold: size in bytes below which payloads are sent uncompressed
+        pipeline: send requests without waiting for the previous responses
+    """
+
     def __init__(
         self,
         host: str,
@@ -220,75 +1258,348 @@ class Client:
         end: str = "\r\n",
         verbose: bool = True,
         timeout: float = 1.0,
-        buffer_size: int = 1024 * 1024 * 8,
+        logger: logging.Logger = None,
+        compression: str | None = None,
+        compress_threshold: int = COMPRESS_THRESHOLD,
+        pipeline: bool = False,
     ) -> None:
+        self.logger = logger or logging.getLogger("TCPClient")
         self.host = host
         self.port = port
-        self.reader = None
-        self.writer = None
+        self.socket = None
         self.verbose = verbose
         self.timeout = timeout
         self.checksum = checksum
-        self.buffer_size = buffer_size
         self.end = end
+        self._frames = FrameBuffer(checksum=checksum)
+        self.compression = _requested_compression(compression, compress_threshold)
+        self.pipeline = pipeline
+        self.pipelined = False  # True once the server agreed to PIPELINE
+        self._pending: dict[int, asyncio.Future] = {}  # request id -> response
+        self._request_ids = count()
+        self._reader: asyncio.Task | None = None
+        self._send_lock = asyncio.Lock()
+        self._request_lock = asyncio.Lock()
+        self._connect_lock = asyncio.Lock()
 
     async def connect(self) -> None:
         """
-        Connect to the TCP server.
+        Connect to the TCP server, and negotiate the compression if one was requested.
         """
-        self.reader, self.writer = await asyncio.open_connection(
-            self.host, self.port, limit=self.buffer_size
+        self.close()
+        loop = asyncio.get_running_loop()
+        self.socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.socket.setblocking(False)
+        self.socket.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        await asyncio.wait_for(
+            loop.sock_connect(self.socket, (self.host, self.port)), self.timeout
         )
+        self._frames.compression = None
+        if self.compression is not None:
+            await self.send_message(self.compression.request())
+            reply = await asyncio.wait_for(self.receive_message(), self.timeout)
+            self._frames.compression = _agreed_compression(str(reply), self.logger)
+        if self.pipeline:
+            await self.send_message(PIPELINE_COMMAND)
+            reply = str(await asyncio.wait_for(self.receive_message(), self.timeout))
+            if reply == f"{PIPELINE_COMMAND} on":
+                self.pipelined = True
+                self._reader = asyncio.ensure_future(
+                    self._read_responses(self.socket, self._pending)
+                )
+            else:
+                self.logger.warning(f"Server refused pipelining: {reply}")
+
+    async def ensure_connected(self) -> None:
+        """connect, unless the connection is alive, once for all concurrent callers"""
+        async with self._connect_lock:
+            if not self.is_alive():
+                await self.connect()
 
-    async def send_message(self, message: str) -> None:
+    async def send_message(self, message: str, request_id: int | None = None) -> None:
         """
         Send a message to the TCP server.
 
         Args:
             message (str): The message to send.
+            request_id (int): Id tagging the message on a pipelined connection.
+
+        Raises:
+            RequestNotSent: if the connection drops before the message is sent whole.
         """
-        if self.checksum:
-            message = add_checksum(message)
         if self.end:
             message += self.end
-        self.writer.write(message.encode("utf-8"))
-        await self.writer.drain()
+        payload = message.encode("utf-8")
+        compressed = False
+        if self._frames.compression is not None:
+            payload, compressed = self._frames.compression.compress(payload)
+        loop = asyncio.get_running_loop()
+        tag = b"" if request_id is None else REQUEST_ID.pack(request_id)
+        frame = pack_frame_header(payload, compressed, self.checksum) + tag + payload
+        if self.checksum:
+            frame += pack_frame_checksum(payload, calculate_checksum(tag))
+        try:
+            await loop.sock_sendall(self.socket, frame)
+        except ConnectionError as e:
+            raise RequestNotSent(str(e)) from e
 
-    async def receive_message(self) -> str:
+    async def receive_message(self) -> str | memoryview:
         """
         Receive a message from the TCP server.
 
+        Binary messages (see `encode_array_message`) are returned as a memoryview on the
+        receive buffer, which is only valid until the next call. Not available on a
+        pipelined connection, where responses are received by `request`.
+
+        Returns:
+            str | memoryview: The message received from the TCP server.
+
+        Raises:
+            ValueError: If the checksum of the message is missing or does not match.
+        """
+        data = await self._frames.arecv(self.socket)
+        if is_binary_message(data):
+            return data
+        return str(data, "utf-8")
+
+    async def request(
+        self, message: str, timeout: float | None = None
+    ) -> str | memoryview:
+        """
+        Send a message and wait for the response.
+
+        If sending fails, the response does not arrive in time or the request is
+        cancelled, the connection is closed: a late response would otherwise be taken
+        for the answer to the next request. On a pipelined connection, late responses
+        are recognised by their request id and dropped, so the connection is only closed
+        if sending fails.
+
+        Concurrent requests are sent one at a time, or all at once when pipelined.
+
+        Args:
+            message (str): The message to send.
+            timeout (float): Time to wait for the response, None waits forever.
+
         Returns:
-            str: The message received from the TCP server.
-        """
-        data = await self.reader.read(self.buffer_size)  # , timeout=self.timeout)
-        if self.checksum and "||" in data.decode("utf-8"):
-            # Verify the checksum
-            message, recieved_checksum = data.decode("utf-8").split("||")
-            calculated_checksum = calculate_checksum(data.decode("utf-8"))
-            if recieved_checksum != calculated_checksum:
-                self.logger.error(
-                    f"Checksum mismatch: {recieved_checksum} != {calculated_checksum}"
+            str | memoryview: The response, see `receive_message`. Binary responses of a
+                pipelined connection own their buffer.
+        """
+        if self.pipelined:
+            return await self._pipelined_request(message, timeout)
+        async with self._request_lock:
+            try:
+                await self.send_message(message)
+                return await asyncio.wait_for(self.receive_message(), timeout)
+            except (asyncio.CancelledError, asyncio.TimeoutError, OSError):
+                self.close()
+                raise
+
+    async def _pipelined_request(
+        self, message: str, timeout: float | None
+    ) -> str | memoryview:
+        request_id = next(self._request_ids) % MORE_FLAG
+        pending = self._pending
+        future = asyncio.get_running_loop().create_future()
+        pending[request_id] = future
+        try:
+            try:
+                async with self._send_lock:
+                    await self.send_message(message, request_id)
+            except (asyncio.CancelledError, OSError):
+                self.close()  # the frame may have been sent in part
+                raise
+            return await asyncio.wait_for(future, timeout)
+        finally:
+            pending.pop(request_id, None)
+
+    async def _read_responses(
+        self, sock: socket.socket, pending: dict[int, asyncio.Future]
+    ) -> None:
+        """hand the frames of a pipelined connection to the requests waiting for them"""
+        loop = asyncio.get_running_loop()
+        header = bytearray(FRAME_HEADER.size)
+        tag = bytearray(REQUEST_ID.size)
+        total = bytearray(RESPONSE_LENGTH.size)
+        trailer = bytearray(FRAME_CHECKSUM.size)
+        # request id -> buffer of the response and number of bytes received in it
+        buffers: dict[int, tuple[memoryview, int]] = {}
+        errors: dict[int, ValueError] = {}
+        try:
+            while True:
+                await _arecv_exactly_into(loop, sock, memoryview(header))
+                length, compressed, has_checksum = unpack_frame_header(header)
+                value = await _arecv_exactly_into(
+                    loop, sock, memoryview(tag), has_checksum
                 )
-                return None
-        elif self.checksum:
-            self.logger.error("No checksum found")
-            return None
-        else:
-            message = data.decode("utf-8")
-        return message
+                (request_id,) = REQUEST_ID.unpack(tag)
+                more = bool(request_id & MORE_FLAG)
+                request_id &= ~MORE_FLAG
+                if request_id in buffers:
+                    buffer, received = buffers[request_id]
+                else:
+                    size = length
+                    if more:
+                        value = await _arecv_exactly_into(
+                            loop, sock, memoryview(total), has_checksum, value
+                        )
+                        (size,) = RESPONSE_LENGTH.unpack(total)
+                    # a buffer per response: responses outlive the next frame
+                    buffer, received = memoryview(bytearray(size)), 0
+                if received + length > len(buffer):
+                    raise ValueError(f"Response {request_id} longer than announced")
+                chunk = buffer[received : received + length]
+                value = await _arecv_exactly_into(loop, sock, chunk, has_checksum, value)
+                buffers[request_id] = buffer, received + length
+                try:
+                    if has_checksum:
+                        await _arecv_exactly_into(loop, sock, memoryview(trailer))
+                        verify_frame_checksum(trailer, value)
+                    self._frames._require_checksum(has_checksum)
+                except ValueError as e:
+                    errors[request_id] = e
+                # receiving does not suspend while data is pending: let requests out
+                await asyncio.sleep(0)
+                if more:
+                    continue
+                buffer, received = buffers.pop(request_id)
+                error = errors.pop(request_id, None)
+                future = pending.pop(request_id, None)
+                if future is None or future.done():
+                    continue  # the request gave up waiting
+                if error is not None:
+                    future.set_exception(error)
+                    continue
+                try:
+                    data = self._frames._decompress(buffer[:received], compressed)
+                except Exception as e:
+                    future.set_exception(e)
+                    continue
+                future.set_result(data if is_binary_message(data) else str(data, "utf-8"))
+        except (OSError, ValueError) as e:
+            self.logger.warning(f"Pipelined connection lost: {e}")
+            if self.socket is sock:
+                self._reader = None
+                self.close()
+        finally:
+            for future in pending.values():
+                if not future.done():
+                    future.set_exception(ConnectionError("Connection closed"))
+
+    def is_alive(self) -> bool:
+        """health check: the connection is open and the server did not close it"""
+        if self.pipelined and (self._reader is None or self._reader.done()):
+            return False
+        return _is_alive(self.socket)
+
+    @property
+    def in_flight(self) -> int:
+        """number of pipelined requests waiting for their response"""
+        return len(self._pending)
 
     def close(self) -> None:
         """
         Close the connection to the TCP server.
+
+        Pipelined requests still waiting for their response raise ConnectionError.
         """
-        self.writer.close()
+        if self._reader is not None:
+            self._reader.cancel()
+            self._reader = None
+        for future in self._pending.values():
+            if not future.done():
+                future.set_exception(ConnectionError("Connection closed"))
+        self._pending = {}
+        self.pipelined = False
+        if self.socket is not None:
+            try:
+                self.socket.close()
+            finally:
+                self.socket = None
 
     def __del__(self) -> None:
         try:
             self.close()
         except Exception:
             pass
+
+
+class AsyncConnectionPool:
+    """A small pool of `Client` connections to the same server, shared by coroutines
+
+    Connections are opened when needed, up to size, and reused afterwards. Requests made
+    while all connections are busy wait for one to be released, so a slow command only
+    holds its own connection. Pipelined connections (see `Client`) are shared instead:
+    each request goes to the connection with the fewest requests in flight.
+
+    Args:
+        host: host to connect to
+        port: port to connect to
+        size: maximum number of open connections
+        kwargs: passed to `Client`
+    """
+
+    def __init__(self, host: str, port: int, size: int = 2, **kwargs) -> None:
+        self.host = host
+        self.port = port
+        self.size = size
+        self.kwargs = kwargs
+        self.logger = kwargs.get("logger") or logging.getLogger("TCPClient")
+        self._clients: list[Client] = []
+        self._idle: list[Client] = []
+        self._semaphore = asyncio.Semaphore(size)
+        self.pipeline = kwargs.get("pipeline", False)
+
+    def _least_busy(self) -> Client:
+        """pipelined client with the fewest requests in flight, opening one if all are busy"""
+        idle = [client for client in self._clients if client.in_flight == 0]
+        if idle or len(self._clients) >= self.size:
+            return min(idle or self._clients, key=lambda client: client.in_flight)
+        client = Client(self.host, self.port, **self.kwargs)
+        self._clients.append(client)
+        return client
+
+    @asynccontextmanager
+    async def connection(self) -> AsyncIterator[Client]:
+        """borrow a connected client from the pool"""
+        if self.pipeline:
+            client = self._least_busy()
+            await client.ensure_connected()
+            yield client
+            return
+        async with self._semaphore:
+            if self._idle:
+                client = self._idle.pop()
+            else:
+                client = Client(self.host, self.port, **self.kwargs)
+                self._clients.append(client)
+            try:
+                if not client.is_alive():
+                    await client.connect()
+                yield client
+            finally:
+                # closed clients are connected again when they are next borrowed
+                self._idle.append(client)
+
+    async def request(self, msg: str, timeout: float | None = None) -> str | memoryview:
+        """send a message on one of the connections and return the response
+
+        If the connection drops while sending, the message is sent once more on a new
+        connection. Once sent, it is not sent again, see `Connection`. See
+        `Client.request`.
+        """
+        async with self.connection() as client:
+            try:
+                return await client.request(msg, timeout)
+            except RequestNotSent as e:
+                self.logger.warning(f"TCP connection lost ({e}), reconnecting...")
+                await client.ensure_connected()
+                return await client.request(msg, timeout)
+
+    def close(self) -> None:
+        """close all connections"""
+        for client in self._clients:
+            client.close()
+
     
 def listen_for_commands(self):  
             """监听用户输入的命令"""  
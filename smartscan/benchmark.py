@@ -0,0 +1,362 @@
+"""Loopback benchmark of the TCP protocol
+
+Starts a `BenchmarkSGM4` server in a separate process on localhost and measures the
+round trip latency and the throughput of `TCP.send_tcp_message`, `TCP.Client` and
+`SGM4Commands.MEASURE`, for float32 payloads from a few bytes up to whole 640x400
+spectra. The results are printed as JSON. Save them before changing the transport and
+compare the changed version against them:
+
+    python -m smartscan.benchmark -o baseline.json
+    python -m smartscan.benchmark -b baseline.json
+"""
+
+import argparse
+import asyncio
+import json
+import logging
+import multiprocessing as mp
+import platform
+import socket
+import sys
+import time
+from typing import Any, Callable, Sequence
+
+import numpy as np
+
+from smartscan import TCP
+from smartscan.sgm4commands import SGM4Commands
+from smartscan.simulator import VirtualSGM4
+
+SHAPES = ((1, 1), (16, 16), (128, 128), (640, 400))
+METHODS = ("send_tcp_message", "Client", "MEASURE")
+MEASURE_TIMEOUT = 30.0  # s, whole spectra in text format take a while
+
+
+class _RepeatQueue:
+    """Output queue always holding the same spectrum, so MEASURE never runs dry"""
+
+    def __init__(self, pos: Sequence[float], data: np.ndarray) -> None:
+        self.item = pos, data
+
+    def empty(self) -> bool:
+        return False
+
+    def qsize(self) -> int:
+        return 1
+
+    def get_nowait(self) -> tuple[Sequence[float], np.ndarray]:
+        return self.item
+
+
+class BenchmarkSGM4(VirtualSGM4):
+    """`VirtualSGM4` answering MEASURE with a fixed spectrum, without scanning
+
+    Adds two commands:
+
+    PAYLOAD nx ny - returns a binary message with a random float32 (nx, ny) array
+    BENCH_SHAPE nx ny - sets the shape of the spectrum returned by MEASURE
+    """
+
+    def __init__(self, host: str, port: int, **kwargs) -> None:
+        super().__init__(host, port, save_to_file=False, **kwargs)
+        self.init_scan(("x", 0, 10, 1), ("y", 0, 10, 1), scan_name="benchmark")
+        self.limits = [0, 10, 0, 10]  # flat, as LIMITS and INFO expect
+        self.rng = np.random.default_rng(0)
+        self._payloads = {}  # encoded PAYLOAD responses by shape
+        self.BENCH_SHAPE(*self.signal_shape)
+
+    def PAYLOAD(self, nx: str, ny: str) -> bytes:
+        shape = int(nx), int(ny)
+        if shape not in self._payloads:
+            data = self.rng.random(shape, dtype=np.float32)
+            self._payloads[shape] = TCP.encode_array_message("PAYLOAD", (0.0,), data)
+        return self._payloads[shape]
+
+    def BENCH_SHAPE(self, nx: str, ny: str) -> str:
+        self.signal_shape = [int(nx), int(ny)]
+        self.roi = None
+        data = self.rng.random(self.signal_shape, dtype=np.float32)
+        self.output_queue = _RepeatQueue(self.current_pos, data)
+        if self.ring is not None:
+            self.ring.close()
+            self.ring = TCP.SharedRing(self.measure_shape, np.float32, self.RING_SLOTS)
+        return f"BENCH_SHAPE {nx} {ny}"
+
+
+def _serve(host: str, port: int, checksum: bool, stop: Any) -> None:
+    """run a `BenchmarkSGM4` until the stop event is set"""
+    logging.disable(logging.INFO)  # MEASURE logs every spectrum
+    server = BenchmarkSGM4(host, port)
+    server.checksum = checksum
+
+    async def serve() -> None:
+        loop = asyncio.create_task(server.tcp_loop())
+        while not stop.is_set():
+            await asyncio.sleep(0.1)
+        loop.cancel()
+
+    try:
+        asyncio.run(serve())
+    finally:
+        if server.ring is not None:
+            server.ring.close()
+
+
+def _free_port(host: str) -> int:
+    with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as s:
+        s.bind((host, 0))
+        return s.getsockname()[1]
+
+
+def _wait_for_server(host: str, port: int, timeout: float = 30.0) -> None:
+    deadline = time.monotonic() + timeout
+    while True:
+        try:
+            socket.create_connection((host, port), timeout=1.0).close()
+            return
+        except OSError:
+            if time.monotonic() > deadline:
+                raise TimeoutError(f"Benchmark server not up after {timeout} s")
+            time.sleep(0.05)
+
+
+def _time_calls(call: Callable[[], Any], repeats: int, warmup: int) -> np.ndarray:
+    """duration in seconds of each of repeats calls, after warmup untimed calls"""
+    for _ in range(warmup):
+        call()
+    times = np.empty(repeats)
+    for i in range(repeats):
+        t0 = time.perf_counter()
+        call()
+        times[i] = time.perf_counter() - t0
+    return times
+
+
+async def _time_async_calls(
+    call: Callable[[], Any], repeats: int, warmup: int
+) -> np.ndarray:
+    """as `_time_calls`, for a coroutine function"""
+    for _ in range(warmup):
+        await call()
+    times = np.empty(repeats)
+    for i in range(repeats):
+        t0 = time.perf_counter()
+        await call()
+        times[i] = time.perf_counter() - t0
+    return times
+
+
+def summarize(method: str, shape: Sequence[int], times: np.ndarray) -> dict:
+    """latency percentiles and throughput of the round trips of one benchmark
+
+    The throughput counts the float32 bytes of the array, whatever the data format or
+    compression used to send it.
+    """
+    nbytes = int(np.prod(shape)) * 4
+    return {
+        "method": method,
+        "shape": list(shape),
+        "bytes": nbytes,
+        "repeats": len(times),
+        "p50_ms": float(np.percentile(times, 50) * 1e3),
+        "p99_ms": float(np.percentile(times, 99) * 1e3),
+        "MB_per_s": float(nbytes * len(times) / times.sum() / 1e6),
+    }
+
+
+def bench_send_tcp_message(
+    host: str, port: int, shape: Sequence[int], repeats: int, warmup: int, **kwargs
+) -> np.ndarray:
+    """round trips of `TCP.send_tcp_message`, one connection per message"""
+    msg = f"PAYLOAD {shape[0]} {shape[1]}"
+    checksum = kwargs.get("checksum", False)
+    return _time_calls(
+        lambda: TCP.send_tcp_message(host, port, msg, checksum=checksum, raw=True),
+        repeats,
+        warmup,
+    )
+
+
+def bench_client(
+    host: str, port: int, shape: Sequence[int], repeats: int, warmup: int, **kwargs
+) -> np.ndarray:
+    """round trips of `TCP.Client.send_message` and `receive_message`"""
+
+    async def bench() -> np.ndarray:
+        client = TCP.Client(
+            host,
+            port,
+            checksum=kwargs.get("checksum", False),
+            compression=kwargs.get("compression"),
+        )
+        await client.connect()
+        msg = f"PAYLOAD {shape[0]} {shape[1]}"
+
+        async def call() -> None:
+            await client.send_message(msg)
+            await client.receive_message()
+
+        try:
+            return await _time_async_calls(call, repeats, warmup)
+        finally:
+            client.close()
+
+    return asyncio.run(bench())
+
+
+def bench_measure(
+    host: str, port: int, shape: Sequence[int], repeats: int, warmup: int, **kwargs
+) -> np.ndarray:
+    """round trips of `SGM4Commands.MEASURE`, in the data format given"""
+    checksum = kwargs.get("checksum", False)
+    msg = f"BENCH_SHAPE {shape[0]} {shape[1]}"
+    TCP.send_tcp_message(host, port, msg, checksum=checksum)
+    remote = SGM4Commands(
+        host,
+        port,
+        checksum=checksum,
+        timeout=MEASURE_TIMEOUT,
+        data_format=kwargs.get("data_format", "binary"),
+        compression=kwargs.get("compression"),
+        pool_size=1,
+    )
+    remote.connect()
+    try:
+        return _time_calls(remote.MEASURE, repeats, warmup)
+    finally:
+        remote.disconnect()
+
+
+BENCHMARKS = {
+    "send_tcp_message": bench_send_tcp_message,
+    "Client": bench_client,
+    "MEASURE": bench_measure,
+}
+
+
+def run_benchmarks(
+    shapes: Sequence[Sequence[int]] = SHAPES,
+    methods: Sequence[str] = METHODS,
+    repeats: int = 200,
+    warmup: int = 10,
+    host: str = "localhost",
+    checksum: bool = False,
+    compression: str | None = None,
+    data_format: str = "binary",
+) -> dict:
+    """Run the benchmarks against a server started in a separate process
+
+    Args:
+        shapes: shapes of the float32 arrays sent
+        methods: benchmarks to run, see `BENCHMARKS`
+        repeats: timed round trips per method and shape
+        warmup: untimed round trips before them
+        host: interface the server listens on
+        checksum: protect the messages with a CRC32 checksum
+        compression: codec for the Client and MEASURE connections, see `TCP.CODECS`
+        data_format: MEASURE payload format, see `SGM4Commands`
+
+    Returns:
+        report: the settings and one summary per method and shape, see `summarize`
+    """
+    settings = {
+        "repeats": repeats,
+        "warmup": warmup,
+        "checksum": checksum,
+        "compression": compression,
+        "data_format": data_format,
+        "python": platform.python_version(),
+        "numpy": np.__version__,
+        "platform": platform.platform(),
+    }
+    port = _free_port(host)
+    stop = mp.Event()
+    server = mp.Process(target=_serve, args=(host, port, checksum, stop), daemon=True)
+    server.start()
+    try:
+        _wait_for_server(host, port)
+        results = []
+        for method in methods:
+            for shape in shapes:
+                times = BENCHMARKS[method](
+                    host,
+                    port,
+                    shape,
+                    repeats,
+                    warmup,
+                    checksum=checksum,
+                    compression=compression,
+                    data_format=data_format,
+                )
+                results.append(summarize(method, shape, times))
+    finally:
+        stop.set()
+        server.join(5.0)
+        if server.is_alive():
+            server.terminate()
+    return {"settings": settings, "results": results}
+
+
+def compare(report: dict, baseline: dict) -> dict:
+    """Add the ratios to the baseline to the results measured in both
+
+    p50_ratio < 1 and MB_per_s_ratio > 1 mean faster than the baseline.
+    """
+    reference = {(r["method"], tuple(r["shape"])): r for r in baseline["results"]}
+    for result in report["results"]:
+        base = reference.get((result["method"], tuple(result["shape"])))
+        if base is None:
+            continue
+        result["p50_ratio"] = result["p50_ms"] / base["p50_ms"]
+        result["p99_ratio"] = result["p99_ms"] / base["p99_ms"]
+        result["MB_per_s_ratio"] = result["MB_per_s"] / base["MB_per_s"]
+    report["baseline"] = baseline["settings"]
+    return report
+
+
+def main(argv: Sequence[str] | None = None) -> None:
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    parser.add_argument(
+        "-s",
+        "--shapes",
+        default=",".join([f"{nx}x{ny}" for nx, ny in SHAPES]),
+        help="comma separated array shapes, e.g. 1x1,640x400",
+    )
+    parser.add_argument(
+        "-m", "--methods", default=",".join(METHODS), help="comma separated benchmarks"
+    )
+    parser.add_argument("-n", "--repeats", type=int, default=200)
+    parser.add_argument("-w", "--warmup", type=int, default=10)
+    parser.add_argument("--checksum", action="store_true")
+    parser.add_argument("--compression", default=None, choices=list(TCP.CODECS))
+    parser.add_argument(
+        "--format",
+        default="binary",
+        choices=VirtualSGM4.DATA_FORMATS,
+        help="MEASURE data format",
+    )
+    parser.add_argument("-o", "--output", default=None, help="save the report to file")
+    parser.add_argument("-b", "--baseline", default=None, help="report to compare to")
+    args = parser.parse_args(argv)
+
+    report = run_benchmarks(
+        shapes=[tuple(int(n) for n in s.split("x")) for s in args.shapes.split(",")],
+        methods=args.methods.split(","),
+        repeats=args.repeats,
+        warmup=args.warmup,
+        checksum=args.checksum,
+        compression=args.compression,
+        data_format=args.format,
+    )
+    if args.baseline is not None:
+        with open(args.baseline, "r") as f:
+            report = compare(report, json.load(f))
+    text = json.dumps(report, indent=2)
+    if args.output is not None:
+        with open(args.output, "w") as f:
+            f.write(text)
+    sys.stdout.write(text + "\n")
+
+
+if __name__ == "__main__":
+    main()
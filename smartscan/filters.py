@@ -0,0 +1,99 @@
+"""Separable smoothing filters along the last two axes of spectra
+
+Both filters run one 1D pass per axis, with kernels built once per parameter set and
+cached. Box filters of odd integer width use running sums, whose cost does not depend on
+the width. Filters keep the float dtype of their input, so float32 spectra are filtered
+in float32.
+"""
+
+from functools import lru_cache
+from typing import Sequence
+
+import numpy as np
+from astropy.convolution import Box1DKernel
+from scipy.ndimage import correlate1d, uniform_filter1d
+
+FRAME_AXES = (-2, -1)
+
+
+@lru_cache(maxsize=64)
+def box_kernel(width: float) -> np.ndarray:
+    """1D box kernel of width, as astropy Box1DKernel, read-only"""
+    kernel = Box1DKernel(width).array
+    kernel.flags.writeable = False
+    return kernel
+
+
+@lru_cache(maxsize=64)
+def gaussian_kernel(sigma: float, truncate: float = 4.0) -> np.ndarray:
+    """1D gaussian kernel, cut at truncate sigmas as scipy gaussian_filter, read-only"""
+    radius = int(truncate * sigma + 0.5)
+    x = np.arange(-radius, radius + 1)
+    kernel = np.exp(-0.5 * (x / sigma) ** 2)
+    kernel /= kernel.sum()
+    kernel.flags.writeable = False
+    return kernel
+
+
+def float_dtype(x: np.ndarray) -> np.dtype:
+    """dtype to filter x in: its own if float32 or float64, float64 otherwise"""
+    dtype = np.asarray(x).dtype
+    return dtype if dtype in (np.float32, np.float64) else np.dtype(np.float64)
+
+
+def _as_float(x: np.ndarray) -> np.ndarray:
+    return np.asarray(x, dtype=float_dtype(x))
+
+
+def box(
+    x: np.ndarray, width: float, axes: Sequence[int] = FRAME_AXES
+) -> np.ndarray:
+    """Smooth with a box kernel, as astropy convolve with Box2DKernel(width)
+
+    Edges are extended, as boundary="extend" of astropy convolve. NaNs spread instead
+    of being interpolated over.
+
+    Args:
+        x: input array
+        width: width of the box, in pixels
+        axes: axes to smooth along
+
+    Returns:
+        np.ndarray: the smoothed array
+    """
+    x = _as_float(x)
+    kernel = box_kernel(width)
+    uniform = np.all(kernel == kernel[0])
+    for axis in axes:
+        if uniform:
+            x = uniform_filter1d(x, len(kernel), axis=axis, mode="nearest")
+        else:
+            x = correlate1d(x, kernel, axis=axis, mode="nearest")
+    return x
+
+
+def gaussian(
+    x: np.ndarray,
+    sigma: float | Sequence[float],
+    truncate: float = 4.0,
+    axes: Sequence[int] = FRAME_AXES,
+) -> np.ndarray:
+    """Smooth with a gaussian kernel, as scipy gaussian_filter along axes
+
+    Args:
+        x: input array
+        sigma: standard deviation of the gaussian, in pixels, for all axes or one per
+            axis. Axes with a sigma of 0 are not smoothed.
+        truncate: cut the kernel at this many sigmas
+        axes: axes to smooth along
+
+    Returns:
+        np.ndarray: the smoothed array
+    """
+    x = _as_float(x)
+    sigmas = np.broadcast_to(sigma, (len(axes),))
+    for axis, sigma in zip(axes, sigmas):
+        if sigma > 0:
+            kernel = gaussian_kernel(float(sigma), float(truncate))
+            x = correlate1d(x, kernel, axis=axis, mode="reflect")
+    return x
@@ -25,6 +25,7 @@ def cost_per_axis(
             - n_dim (int): 维度数量（默认值：2）  
             - axes (Sequence[Sequence[float]]): 要舍入的点的网格  
             - prev_points (np.ndarray): 之前测量的点  
+            - measured (store.GridIndex): 已测量的网格节点，给定时代替 prev_points  
 
     返回：  
         Sequence[float]: 从原点到每个点的移动成本  
@@ -55,13 +56,19 @@ def cost_per_axis(
     n_tasks = cfp.get("n_tasks")  
     n_dim = cfp.get("n_dim")  
     axes = cfp.get("axes")  
-    prev_points = np.array(cfp.get("prev_points"))[::n_tasks, :-1]  
+    measured = cfp.get("measured")  
+    if measured is None:  
+        prev_points = np.array(cfp.get("prev_points"))[::n_tasks, :-1]  
 
     distances = np.zeros((len(x), n_dim))  
     out = np.zeros((len(x)))  
     for i, xx in enumerate(x):  
         rounded = round_to_axes(xx, axes)  
-        if np.any(np.all(np.isclose(rounded, prev_points), axis=1)):  
+        if measured is not None:  
+            already_measured = xx in measured  
+        else:  
+            already_measured = np.any(np.all(np.isclose(rounded, prev_points), axis=1))  
+        if already_measured:  
             logger.warning(  
                 f"点 {np.asarray(xx).ravel()} 舍入到 {rounded}，该点已被测量"  
             )  
@@ -1,5 +1,4 @@
 from pathlib import Path
-from typing import tuple
 
 import dask.array
 import h5py
@@ -8,12 +7,13 @@ import xarray as xr
 import yaml
 from tqdm.auto import tqdm
 
-from . import tasks
+from . import preprocessing, tasks
 
 
 def load_smartscan(
     filename: str,
     folder: str | Path = None,
+    dtype: str | np.dtype | None = None,
 ) -> dict["str", np.ndarray | xr.DataArray]:
     """Load data acquired with the GP driven smart scan on SGM4
 
@@ -24,6 +24,8 @@ def load_smartscan(
     Args:
         filename (str): file name
         folder (str|Path, optional): folder path. Defaults to None.
+        dtype (str|np.dtype, optional): dtype of the spectra, through merging and tasks.
+            Defaults to None, the dtype of the file.
 
     Returns:
         tuple[np.ndarray, np.ndarray]: positions, data
@@ -37,6 +39,8 @@ def load_smartscan(
     with h5py.File(h5_file_name, "r", swmr=True) as file:
         positions = file["Entry/Data/ScanDetails/TruePositions"][()]
         spectra = file["Entry/Data/TransformedData"][()]
+        if dtype is not None:
+            spectra = spectra.astype(dtype, copy=False)
         fa_len = file["Entry/Data/ScanDetails/FastAxis_length"][()]
         fa_start = file["Entry/Data/ScanDetails/FastAxis_start"][()]
         fa_step = file["Entry/Data/ScanDetails/FastAxis_step"][()]
@@ -73,7 +77,7 @@ def load_smartscan(
         "coords": coords,
         "attrs": {f"settings/{k}": v for k, v in settings.items()},
     }
-    if len(settings) > 0:
+    if len(settings) > 0 and out["attrs"]["settings/roi"] is not None:
         roi = out["attrs"]["settings/roi"]
         out["roi_dict"] = {k: slice(*v) for k, v in zip(fa_name, roi)}
 
@@ -109,10 +113,13 @@ def load_smartscan(
             merged[pos] += sp
             counts[pos] += 1
         else:
-            merged[pos] = sp
+            merged[pos] = sp.copy()  # not to add to all_spectra in place
             counts[pos] = 1
-    # get the mean of data with the same position
-    merged = {k: v / counts[k] for k, v in merged.items()}
+    # get the mean of data with the same position, in the dtype of float spectra
+    for k, v in merged.items():
+        merged[k] = v / counts[k]
+        if np.issubdtype(v.dtype, np.floating):  # integer counts average to floats
+            merged[k] = merged[k].astype(v.dtype)
     out["unique_positions"] = np.array(tuple(merged.keys()))
     out["unique_counts"] = np.array(tuple(counts.values()))
     out["unique_spectra"] = xr.concat(merged.values(), dim="uidx")
@@ -127,18 +134,22 @@ def load_smartscan(
         for task, td in settings["tasks"].items():
             out["tasks"][task] = {
                 "callable": getattr(tasks, td["function"]),
-                "pars": td["params"],
+                "pars": td.get("params"),
+                "input": td.get("input", preprocessing.RAW),
             }
-        out["task_values"] = []
-    for i in tqdm(range(len(out["unique_spectra"]))):
-        tvals = []
-        sp = out["unique_spectra"].isel(
-            uidx=i
-        )  # .isel(out['roi_dict']).squeeze().values,
-        for task, td in out["tasks"].items():
-            tvals.append(td["callable"](sp, **td["pars"]))
-        out["task_values"].append(tvals)
-    out["task_values"] = np.array(out["task_values"])
+        # the preprocessing steps the tasks read, as run by SmartScan
+        steps = preprocessing.build(
+            settings.get("preprocessing"),
+            [td["input"] for td in out["tasks"].values()],
+        )
+    # each task reduces the whole stack of its input in one call
+    intermediates = preprocessing.run_stack(out["unique_spectra"].values, steps)
+    out["task_values"] = np.column_stack(
+        [
+            td["callable"](intermediates[td["input"]], **(td["pars"] or {}))
+            for td in tqdm(out["tasks"].values())
+        ]
+    )
     out["task_values_norm"] = out["task_values"] / out["task_values"].max(axis=0)
     out["task_values_norm"] = out["task_values"] / out["task_values"].max(axis=0)
 
@@ -252,7 +263,9 @@ def get_scan_params(sd: dict) -> dict:
     params["normalize_values"] = sd["scanning"]["normalize_values"]
     try:
         roi_pars = sd["preprocessing"].get("roi", {}).get("params", {})
-        if len(roi_pars) > 0:
+        if "roi" in roi_pars:  # a crop step
+            params["roi"] = roi_pars["roi"]
+        elif len(roi_pars) > 0:
             params["roi"] = list(roi_pars.values())
         else:
             params["roi"] = None
@@ -277,7 +290,7 @@ def get_scan_params(sd: dict) -> dict:
             params["cnr_bg_roi"] = None
         if task == "std" and td["params"] is not None:
             params["std_roi"] = td["params"]["roi"]
-        if task == "curvature":
+        if task == "curvature" and "roi" in td["params"]:
             params["roi"] = td["params"]["roi"]
 
     # aquisition function
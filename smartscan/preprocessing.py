@@ -0,0 +1,188 @@
+"""Preprocessing of the spectra, shared by the tasks
+
+The preprocessing section of the settings declares named steps, each applying a
+function of this module to the spectrum or to the output of another step:
+
+    preprocessing:
+      roi:
+        function: crop
+        params:
+          roi: [[145, 190], [10, 140]]
+      smooth:
+        function: smooth
+        input: roi
+        params:
+          size: 10
+
+A task reads the output of a step by naming it as its input, and the spectrum itself
+without one. Each step runs at most once per spectrum, only if a task needs it, so that
+tasks looking at the same region or smoothing the same way share the work:
+
+    tasks:
+      mean:
+        function: mean
+        input: roi
+      laplace_filter:
+        function: laplace_filter
+        input: smooth
+        params:
+          sigma: 0
+
+Step functions never change their input, which other steps and tasks may read as well.
+"""
+
+from graphlib import CycleError, TopologicalSorter
+from typing import Sequence
+
+import numpy as np
+
+from . import filters
+
+RAW = "raw"  # name of the spectrum itself
+
+Step = tuple[str, str, str, dict]  # name, function, input, params
+
+
+def crop(x: np.ndarray, roi: Sequence[Sequence[int]]) -> np.ndarray:
+    """Crop an array to a region of interest
+
+    Args:
+        x (np.ndarray): input array
+        roi (Sequence[Sequence[int]]): start and stop index along each axis
+
+    Returns:
+        np.ndarray: the region of interest, a view of x
+    """
+    roi = np.array(roi)
+    return x[tuple(slice(start, stop) for start, stop in roi)]
+
+
+def rebin(x: np.ndarray, factor: int | Sequence[int] = 2) -> np.ndarray:
+    """Average blocks of factor pixels along each axis
+
+    Pixels left over at the end of an axis are dropped.
+
+    Args:
+        x (np.ndarray): input array
+        factor (int | Sequence[int], optional): bin size, per axis or for all.
+            Defaults to 2.
+
+    Returns:
+        np.ndarray: the binned array
+    """
+    factor = np.broadcast_to(factor, (x.ndim,)).astype(int)
+    shape = np.array(x.shape) // factor
+    x = x[tuple(slice(0, n * f) for n, f in zip(shape, factor))]
+    blocks = np.column_stack([shape, factor]).ravel()
+    return x.reshape(blocks).mean(axis=tuple(range(1, 2 * x.ndim, 2)))
+
+
+def normalize(x: np.ndarray, by: str = "mean") -> np.ndarray:
+    """Divide an array by its mean, maximum or sum
+
+    Args:
+        x (np.ndarray): input array
+        by (str, optional): "mean", "max" or "sum". Defaults to "mean".
+
+    Returns:
+        np.ndarray: the normalized array
+    """
+    if by not in ("mean", "max", "sum"):
+        raise ValueError(f"Unknown normalization {by}, expected mean, max or sum.")
+    return x / getattr(np, by)(x)
+
+
+def smooth(x: np.ndarray, size: float = 1, kernel: str = "gaussian") -> np.ndarray:
+    """Smooth an array with a gaussian or a box kernel
+
+    Args:
+        x (np.ndarray): input array
+        size (float, optional): sigma of the gaussian kernel, or width of the box.
+            Defaults to 1.
+        kernel (str, optional): "gaussian" or "box". Defaults to "gaussian".
+
+    Returns:
+        np.ndarray: the smoothed array, float32 for float32 input, float64 otherwise
+    """
+    axes = tuple(range(x.ndim))
+    if kernel == "gaussian":
+        return filters.gaussian(x, size, axes=axes)
+    if kernel == "box":
+        return filters.box(x, size, axes=axes)
+    raise ValueError(f"Unknown kernel {kernel}, expected gaussian or box.")
+
+
+FUNCTIONS = {f.__name__: f for f in (crop, rebin, normalize, smooth)}
+
+
+def build(settings: dict | None, outputs: Sequence[str] = ()) -> list[Step]:
+    """Steps computing the outputs, in the order they have to run
+
+    Args:
+        settings: the preprocessing section of the settings
+        outputs: names of the steps the tasks read
+
+    Returns:
+        steps: (name, function, input, params) of each step needed
+
+    Raises:
+        ValueError: if a step or an output is unknown, or the steps form a cycle
+    """
+    settings = settings or {}
+    graph = {}
+    for name, d in settings.items():
+        if name == RAW:
+            raise ValueError(f"{RAW} names the spectrum, not a preprocessing step.")
+        if d["function"] not in FUNCTIONS:
+            raise ValueError(f"Unknown function {d['function']} for step {name}.")
+        graph[name] = d.get("input", RAW)
+    for name in (*graph.values(), *outputs):
+        if name != RAW and name not in graph:
+            raise ValueError(f"Unknown preprocessing step {name}.")
+    needed = set()
+    for name in outputs:
+        while name != RAW and name not in needed:
+            needed.add(name)
+            name = graph[name]
+    sorter = TopologicalSorter({name: [graph[name]] for name in needed})
+    try:
+        order = [name for name in sorter.static_order() if name != RAW]
+    except CycleError as e:
+        raise ValueError(f"Preprocessing steps form a cycle: {e.args[1]}") from e
+    return [
+        (name, settings[name]["function"], graph[name], settings[name].get("params"))
+        for name in order
+    ]
+
+
+def run(data: np.ndarray, steps: Sequence[Step]) -> dict[str, np.ndarray]:
+    """Run the steps on a spectrum
+
+    Args:
+        data: the spectrum
+        steps: steps in the order they have to run, see `build`
+
+    Returns:
+        intermediates: the spectrum as raw and the output of each step, by name
+    """
+    intermediates = {RAW: data}
+    for name, function, source, params in steps:
+        func = FUNCTIONS[function]
+        intermediates[name] = func(intermediates[source], **(params or {}))
+    return intermediates
+
+
+def run_stack(data: np.ndarray, steps: Sequence[Step]) -> dict[str, np.ndarray]:
+    """Run the steps on each spectrum of a stack
+
+    Args:
+        data: the spectra, with shape (n, *spectrum_shape)
+        steps: steps in the order they have to run, see `build`
+
+    Returns:
+        intermediates: the stack as raw and the stacked outputs of each step, by name
+    """
+    if len(steps) == 0 or len(data) == 0:
+        return {RAW: data}
+    outputs = [run(d, steps) for d in data]
+    return {name: np.stack([o[name] for o in outputs]) for name in outputs[0]}
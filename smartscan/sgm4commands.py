@@ -1,12 +1,39 @@
+import asyncio
+import json
 import logging
+import time
+from functools import partial
 from itertools import product
 from pathlib import Path
-from typing import Any, List, Tuple
+from typing import Any, AsyncIterator, Callable, List, Sequence, Tuple
 
 import numpy as np
 from numpy.typing import NDArray
 
-from .TCP import send_tcp_message
+from .TCP import (
+    COMPRESS_THRESHOLD,
+    AsyncConnectionPool,
+    Client,
+    ConnectionPool,
+    SharedRing,
+    decode_array_message,
+    is_binary_message,
+)
+
+
+BINARY_FORMATS = ("binary", "float16", "uint16")
+# format tried next when SGM4 refuses one
+DATA_FORMAT_FALLBACK = {
+    "shm": "binary",
+    "float16": "binary",
+    "uint16": "binary",
+    "binary": "text",
+}
+
+
+def _is_view(data: NDArray[Any] | None) -> bool:
+    """data is an array sharing the memory of another, e.g. a receive buffer"""
+    return data is not None and data.base is not None
 
 
 class SGM4Commands:
@@ -15,10 +42,19 @@ class SGM4Commands:
     Args:
         host: host to connect to
         port: port to connect to
-        checksum: add a checksum to the message
+        checksum: protect the messages with a CRC32 checksum
         verbose: print out extra information
         timeout: timeout for the connection
-        buffer_size: size of the buffer to use
+        data_format: preferred MEASURE payload format, negotiated on connect.
+            "binary" falls back to "text" if the server does not support it.
+            "shm" reads the spectra from a shared memory ring, it only works when SGM4
+            runs on the same host and falls back to "binary" otherwise.
+            "float16" and "uint16" send 16 bits per value, see `TCP.quantize_array`,
+            and fall back to "binary".
+        pool_size: number of persistent connections kept open to the SGM4
+        compression: codec used for large payloads, negotiated on each connection.
+            None or "none" disables compression, see `TCP.CODECS` for the others.
+        compress_threshold: size in bytes below which payloads are sent uncompressed
     """
 
     INVALID_NUMBER = -999999999.0
@@ -30,7 +66,10 @@ class SGM4Commands:
         checksum: bool = False,
         verbose: bool = True,
         timeout: float = 1.0,
-        buffer_size: int = 1024,
+        data_format: str = "binary",
+        pool_size: int = 2,
+        compression: str | None = None,
+        compress_threshold: int = COMPRESS_THRESHOLD,
     ) -> None:
         self.logger = logging.getLogger(f"{__name__}.SGM4Commands")
         # TCP
@@ -39,7 +78,24 @@ class SGM4Commands:
         self.checksum = checksum
         self.verbose = verbose
         self.timeout = timeout
-        self.buffer_size = buffer_size
+        self.preferred_data_format = data_format
+        self.data_format = "text"  # until negotiated in connect
+        self.ring = None  # shared memory ring of the shm format
+        self.roi = None  # region of the spectra sent by SGM4, see SET_ROI
+        self.server_tasks = None  # names of the tasks SGM4 reduces, see START
+        self.compression = compression
+        self.compress_threshold = compress_threshold
+        self.pool = ConnectionPool(
+            host,
+            port,
+            size=pool_size,
+            checksum=checksum,
+            timeout=timeout,
+            CLRF=True,
+            logger=self.logger,
+            compression=compression,
+            compress_threshold=compress_threshold,
+        )
 
         self._limits = None
         self._step_size = None
@@ -55,14 +111,14 @@ class SGM4Commands:
     def filename(self) -> Path:
         """filename of the scan"""
         if self._filename is None:
-            self._filename = self.FILENAME()
+            self._fetch_info("FILENAME")
         return self._filename
 
     @property
     def ndim(self) -> int:
         """number of dimensions of the scan"""
         if self._ndim is None:
-            self._ndim = self.NDIM()
+            self._fetch_info("NDIM")
         return self._ndim
 
     @property
@@ -73,14 +129,14 @@ class SGM4Commands:
             limits: list of tuples of floats
         """
         if self._limits is None:
-            self._limits = self.LIMITS()
+            self._fetch_info("LIMITS")
         return self._limits
 
     @property
     def step_size(self) -> List[float]:
         """step size of the scan"""
         if self._step_size is None:
-            self._step_size = [np.abs(st) for st in self.STEP_SIZE()]
+            self._fetch_info("STEP_SIZE")
         return self._step_size
 
     @property
@@ -96,7 +152,7 @@ class SGM4Commands:
     def spectrum_shape(self) -> Tuple[int]:
         """shape of the spectrum"""
         if self._spectrum_shape is None:
-            self._spectrum_shape = self.SHAPE()
+            self._fetch_info("SHAPE")
         return tuple(self._spectrum_shape)
 
     @property
@@ -117,31 +173,56 @@ class SGM4Commands:
                 self._axes.append(np.arange(start, stop, step))
         return self._axes
 
-    def send_command(self, command, *args) -> str:
+    def send_command(self, command, *args, raw: bool = False) -> str | bytes:
         """send a command to SGM4 and wait for a response
 
         Args:
             command: command to send
             args: arguments to send with the command
+            raw: return the response as bytes
 
         Returns:
             response: response from SGM4
         """
+        message = self._format_command(command, *args)
+        try:
+            response = self.pool.request(message, raw=raw)
+        except ValueError as e:  # corrupted frame
+            raise RuntimeError(f"Error: {e}") from e
+        return self._check_response(command, message, response)
+
+    def _request(
+        self, command: str, *args, parse: Callable[[Any], Any], raw: bool = False
+    ) -> Any:
+        """send a command and return its response as interpreted by parse
+
+        The commands are written once, as a message and the method parsing the response,
+        for `SGM4Commands` and `AsyncSGM4Commands` alike: the latter awaits the response
+        here, and its commands return awaitables.
+        """
+        return parse(self.send_command(command, *args, raw=raw))
+
+    def _fetch_info(self, command: str) -> None:
+        """ask SGM4 for a piece of the scan info, which the command stores"""
+        getattr(self, command)()
+
+    def _format_command(self, command, *args) -> str:
         message = command.upper()
         for arg in args:
             message += f" {arg}"
         self.logger.debug(f"Sending message: {message}")
-        response = send_tcp_message(
-            host=self.host,
-            port=self.port,
-            msg=message,
-            checksum=self.checksum,
-            verbose=self.verbose,
-            timeout=self.timeout,
-            buffer_size=self.buffer_size,
-            CLRF=True,
-        )
+        return message
+
+    def _check_response(
+        self, command: str, message: str, response: str | bytes | memoryview
+    ) -> str | memoryview:
+        """raise RuntimeError if SGM4 refused the command"""
+        if is_binary_message(response):
+            self.logger.debug(f"Received response: {message} -> {len(response)} bytes")
+            return response
         self.logger.debug(f"Received response: {message} -> {response[:50]}...")
+        if isinstance(response, bytes):
+            response = response.decode()
         if "INVALID" in response:
             raise RuntimeError(f"Invalid command: {command}")
         elif "ERROR" in response:
@@ -155,35 +236,74 @@ class SGM4Commands:
         - check if it is a new connection or not (i.e. if we have a filename)
         - add status information on both sides
 
-        command order:
+        INFO returns all the scan info in one round trip. SGM4 versions without INFO are
+        asked command by command, in this order:
         NDIM - get number of dimensions
         LIMITS - after NDIM, as you need to know how many to expect
         FILENAME - get the filename of the scan
         CURRENT_POS - where are we starting from?
 
         """
-        self._ndim = self.NDIM()
-        self._limits = self.LIMITS()
-        assert (
-            len(self._limits) == self._ndim
-        ), f"Expected {self._ndim} limits, got {len(self._limits)}"
         try:
-            self._current_pos = self.CURRENT_POS()
+            self.INFO()
+        except RuntimeError as e:
+            self.logger.info(f"INFO failed ({e}), asking for the scan info one by one")
+            self._ndim = self.NDIM()
+            self._limits = self.LIMITS()
             assert (
-                len(self._current_pos) == self._ndim
-            ), f"Expected {self._ndim} current positions, got {len(self._current_pos)}"
-        except IndexError:
-            pass
-        self._filename = Path(self.FILENAME())
+                len(self._limits) == self._ndim
+            ), f"Expected {self._ndim} limits, got {len(self._limits)}"
+            try:
+                self._current_pos = self.CURRENT_POS()
+                assert (
+                    len(self._current_pos) == self._ndim
+                ), f"Expected {self._ndim} current positions, got {len(self._current_pos)}"
+            except IndexError:
+                pass
+            self.FILENAME()
+        self._filename = Path(self._filename)
         if self._filename.is_file():
             print(f"file {self._filename} found! good to go!")
             # self.parse_file()
         else:
             Warning(f"Expected {self._filename} to be a file")
+        self.negotiate_data_format()
+
+    def negotiate_data_format(self) -> str:
+        """agree with SGM4 on the MEASURE payload format
+
+        Falls back along DATA_FORMAT_FALLBACK if the server does not support the
+        preferred format, down to the text format, which is also assumed if the server
+        does not know the FORMAT command.
+
+        Returns:
+            data_format: the format in use
+        """
+        data_format = self.preferred_data_format
+        while True:
+            try:
+                self.data_format = self.FORMAT(data_format)
+                if self.data_format == "shm":
+                    self.SHM()
+                break
+            except (RuntimeError, OSError, ValueError) as e:
+                self.data_format = "text"
+                if data_format not in DATA_FORMAT_FALLBACK:
+                    break
+                data_format = DATA_FORMAT_FALLBACK[data_format]
+                self.logger.warning(f"FORMAT failed ({e}), trying {data_format}")
+        self.logger.info(f"MEASURE data format: {self.data_format}")
+        return self.data_format
 
     def disconnect(self) -> None:
-        """disconnect from SGM4"""
-        Warning("Disconnecting from SGM4 is not yet implemented")
+        """disconnect from SGM4, closing all open connections"""
+        self.pool.close()
+        self._close_ring()
+
+    def _close_ring(self) -> None:
+        if self.ring is not None:
+            self.ring.close()
+            self.ring = None
 
     def ADD_POINT(self, *args) -> bool:
         """add a point to the scan queue
@@ -194,11 +314,16 @@ class SGM4Commands:
         Returns:
             flag indicating success
         """
+        self._check_point(args)
+        return self._request("ADD_POINT", *args, parse=self._parse_add_point)
+
+    def _check_point(self, args) -> None:
         assert len(args) == self._ndim, f"Expected {self._ndim} args, got {len(args)}"
         assert all(
             a != self.INVALID_NUMBER for a in args
         ), f"DO NOT move to {self.INVALID_NUMBER}"
-        response = self.send_command("ADD_POINT", *args)
+
+    def _parse_add_point(self, response: str) -> bool:
         split = response.split(" ")
         cmd = split.pop(0)
         vals = [float(x) for x in split]
@@ -211,13 +336,55 @@ class SGM4Commands:
             )
         return True
 
+    def ADD_POINTS(self, positions: NDArray[Any]) -> tuple[NDArray[Any], int]:
+        """add several points to the scan queue in one round trip
+
+        Args:
+            positions: positions to add, with shape (n, ndim)
+
+        Returns:
+            accepted: positions as queued by SGM4, with shape (n, ndim)
+            queue_length: number of points in the queue after adding them
+        """
+        points = self._format_points(positions)
+        parse = partial(self._parse_add_points, n_points=len(points))
+        return self._request("ADD_POINTS", len(points), *points, parse=parse)
+
+    def _format_points(self, positions: NDArray[Any]) -> List[str]:
+        positions = np.asarray(positions, dtype=float)
+        assert (
+            positions.ndim == 2 and positions.shape[1] == self._ndim
+        ), f"Expected positions with shape (n, {self._ndim}), got {positions.shape}"
+        assert np.all(
+            positions != self.INVALID_NUMBER
+        ), f"DO NOT move to {self.INVALID_NUMBER}"
+        return [",".join([str(x) for x in pos]) for pos in positions]
+
+    def _parse_add_points(
+        self, response: str, n_points: int
+    ) -> tuple[NDArray[Any], int]:
+        split = response.strip("\r\n").split(" ")
+        cmd = split.pop(0)
+        assert cmd == "ADD_POINTS", f"Expected ADD_POINTS, got {cmd}"
+        n = int(split.pop(0))
+        assert n == n_points, f"Expected {n_points} points, got {n}"
+        accepted = np.asarray(
+            [[float(x) for x in point.split(",")] for point in split[:n]], dtype=float
+        ).reshape(n, self._ndim)
+        queue_length = int(split[n])
+        if np.any(accepted == self.INVALID_NUMBER):
+            Warning("Some of the positions provided are invalid.")
+        return accepted, queue_length
+
     def CLEAR(self) -> bool:
         """clear the scan queue
 
         Returns:
             flag indicating success
         """
-        response = self.send_command("CLEAR")
+        return self._request("CLEAR", parse=self._parse_clear)
+
+    def _parse_clear(self, response: str) -> bool:
         split = response.split(" ")
         assert split[0] == "CLEAR", f"Expected CLEAR, got {split[0]}"
         return True
@@ -228,7 +395,9 @@ class SGM4Commands:
         Returns:
             limits: list of tuples of floats
         """
-        response = self.send_command("LIMITS")
+        return self._request("LIMITS", parse=self._parse_limits)
+
+    def _parse_limits(self, response: str) -> List[Tuple[float]]:
         print(response)
         split = response.split(" ")
         assert split[0] == "LIMITS", f"Expected LIMITS, got {split[0]}"
@@ -247,7 +416,9 @@ class SGM4Commands:
         Returns:
             queue: list of tuples of floats
         """
-        response = self.send_command("QUEUE")
+        return self._request("QUEUE", parse=self._parse_queue)
+
+    def _parse_queue(self, response: str) -> str:
         split = response.split(" ")
         assert split[0] == "QUEUE", f"Expected QUEUE, got {split[0]}"
         # queue_size = int()
@@ -259,7 +430,9 @@ class SGM4Commands:
         Returns:
             ndim: number of dimensions
         """
-        response = self.send_command("NDIM")
+        return self._request("NDIM", parse=self._parse_ndim)
+
+    def _parse_ndim(self, response: str) -> int:
         split = response.split(" ")
         assert split[0] == "NDIM", f"Expected NDIM, got {split[0]}"
         self._ndim = int(split[1])
@@ -267,7 +440,9 @@ class SGM4Commands:
 
     def SHAPE(self) -> Tuple[int]:
         """get the shape of a spectrum and store it in self.spectrum_shape"""
-        response = self.send_command("SHAPE")
+        return self._request("SHAPE", parse=self._parse_shape)
+
+    def _parse_shape(self, response: str) -> Tuple[int]:
         split = response.split(" ")
         assert split[0] == "SHAPE", f"Expected SHAPE, got {split[0]}"
         self._spectrum_shape = [int(s) for s in split[1:]]
@@ -279,7 +454,9 @@ class SGM4Commands:
         Returns:
             filename: filename of the scan
         """
-        response = self.send_command("FILENAME")
+        return self._request("FILENAME", parse=self._parse_filename)
+
+    def _parse_filename(self, response: str) -> str:
         split = response.split(" ")
         assert split[0] == "FILENAME", f"Expected FILENAME, got {split[0]}"
         self._filename = " ".join(split[1:])
@@ -292,7 +469,9 @@ class SGM4Commands:
         Returns:
             dict: {axis: position}
         """
-        response = self.send_command("CURRENT_POS")
+        return self._request("CURRENT_POS", parse=self._parse_current_pos)
+
+    def _parse_current_pos(self, response: str) -> List[float]:
         split = response.split(" ")
         assert split[0] == "CURRENT_POS", f"Expected CURRENT_POS, got {split[0]}"
         current_pos = {
@@ -310,25 +489,43 @@ class SGM4Commands:
         Returns:
             step_size: list of floats
         """
-        response = self.send_command("STEP_SIZE")
+        return self._request("STEP_SIZE", parse=self._parse_step_size)
+
+    def _parse_step_size(self, response: str) -> List[float]:
         split = response.split(" ")
         if split[0] != "STEP_SIZE":
             raise ValueError(f"Expected STEP_SIZE, got {split[0]}")
-        step_size = [float(s) for s in split[1:]]
+        step_size = [np.abs(float(s)) for s in split[1:]]
         assert (
             len(step_size) == self.ndim
         ), f"Expected {self.ndim} step sizes, got {len(step_size)}"
         self._step_size = step_size
         return step_size
 
-    def START(self) -> bool:
+    def START(self, task_settings: dict | None = None) -> bool:
         """Start the scan
 
+        With task_settings, SGM4 reduces each spectrum to the tasks itself, and MEASURE
+        returns the task values instead of the spectrum.
+
+        Args:
+            task_settings: the tasks section of the settings, None to get spectra
+
         Returns:
             ack: START
         """
-        response = self.send_command("START")
-        assert response == "START", f"Expected START, got {response}"
+        args = self._format_tasks(task_settings)
+        return self._request("START", *args, parse=self._parse_start)
+
+    def _format_tasks(self, task_settings: dict | None) -> List[str]:
+        if task_settings is None:
+            return []
+        return [json.dumps(task_settings, separators=(",", ":"))]
+
+    def _parse_start(self, response: str) -> bool:
+        split = response.split(" ")
+        assert split[0] == "START", f"Expected START, got {response}"
+        self.server_tasks = split[2].split(",") if len(split) > 2 else None
         return True
 
     def END(self) -> str:
@@ -337,7 +534,9 @@ class SGM4Commands:
         Returns:
             ack: the size of the remaining queue
         """
-        response = self.send_command("END")
+        return self._request("END", parse=self._parse_end)
+
+    def _parse_end(self, response: str) -> str:
         split = response.split(" ")
         assert split[0] == "END", f"Expected END, got {split[0]}"
         assert len(split) == 2, f"Expected 2 args, got {len(split)}"
@@ -349,7 +548,78 @@ class SGM4Commands:
         Returns:
             status: status of the scan
         """
-        response = self.send_command("STATUS")
+        return self._request("STATUS", parse=self._parse_status)
+
+    def WAIT_READY(self, timeout: float) -> str:
+        """Wait until SGM4 is ready to scan
+
+        SGM4 answers as soon as it is ready. Longer waits are split in requests shorter
+        than the connection timeout. Requests timing out, e.g. while SGM4 is busy
+        starting the scan, are sent again until timeout.
+
+        Args:
+            timeout: maximum time to wait, in seconds
+
+        Returns:
+            status: status of the scan once ready
+
+        Raises:
+            TimeoutError: if SGM4 is not ready after timeout
+        """
+        deadline = time.monotonic() + timeout
+        while True:
+            try:
+                response = self.send_command("WAIT_READY", self._ready_wait(deadline))
+                ready, status = self._parse_wait_ready(response)
+            except TimeoutError:
+                ready, status = False, "unresponsive"
+            if ready:
+                return status
+            if time.monotonic() >= deadline:
+                raise TimeoutError(f"SGM4 not ready after {timeout} s. Status: {status}")
+
+    def _ready_wait(self, deadline: float) -> str:
+        wait = min(deadline - time.monotonic(), self.timeout / 2)
+        return f"{max(wait, 0):.3f}"
+
+    def _parse_wait_ready(self, response: str) -> tuple[bool, str]:
+        split = response.split(" ")
+        assert split[0] == "WAIT_READY", f"Expected WAIT_READY, got {split[0]}"
+        assert len(split) == 3, f"Expected 3 args, got {len(split)}"
+        self.status = split[2]
+        return split[1] == "1", split[2]
+
+    def INFO(self) -> dict:
+        """Get all the scan info in one round trip, and store it like the commands
+        fetching each piece (NDIM, LIMITS, STEP_SIZE, SHAPE, FILENAME, CURRENT_POS) do
+
+        Returns:
+            info: dict with keys ndim, limits, step_size, shape, filename, current_pos
+                and status
+        """
+        return self._request("INFO", parse=self._parse_info)
+
+    def _parse_info(self, response: str) -> dict:
+        split = response.split(" ", 1)
+        assert split[0] == "INFO", f"Expected INFO, got {split[0]}"
+        info = json.loads(split[1])
+        self._ndim = int(info["ndim"])
+        self._limits = [tuple(limit) for limit in info["limits"]]
+        assert (
+            len(self._limits) == self._ndim
+        ), f"Expected {self._ndim} limits, got {len(self._limits)}"
+        self._step_size = [np.abs(float(step)) for step in info["step_size"]]
+        assert (
+            len(self._step_size) == self._ndim
+        ), f"Expected {self._ndim} step sizes, got {len(self._step_size)}"
+        self._spectrum_shape = [int(n) for n in info["shape"]]
+        self.roi = info.get("roi")
+        self._filename = info["filename"]
+        self._current_pos = info["current_pos"]
+        self.status = info["status"]
+        return info
+
+    def _parse_status(self, response: str) -> str:
         split = response.split(" ")
         assert split[0] == "STATUS", f"Expected STATUS, got {split[0]}"
         assert len(split) == 2, f"Expected 2 args, got {len(split)}"
@@ -362,7 +632,9 @@ class SGM4Commands:
         Returns:
             ack: ABORT
         """
-        response = self.send_command("ABORT")
+        return self._request("ABORT", parse=self._parse_abort)
+
+    def _parse_abort(self, response: str) -> bool:
         assert response == "ABORT", f"Expected ABORT, got {response}"
         # TODO: stop the measurement loop
         return True
@@ -373,19 +645,283 @@ class SGM4Commands:
         Returns:
             paused or unpaused status
         """
-        response = self.send_command("PAUSE")
+        return self._request("PAUSE", parse=self._parse_pause)
+
+    def _parse_pause(self, response: str) -> str:
         split = response.split(" ")
         assert split[0] == "PAUSE", f"Expected PAUSE, got {response}"
         self.status = split[1]
         return str(split[1])
 
+    def FORMAT(self, data_format: str) -> str:
+        """Set the format of the MEASURE payload
+
+        Args:
+            data_format: one of text, binary, shm, float16 or uint16
+
+        Returns:
+            data_format: the format set on the server
+        """
+        parse = partial(self._parse_format, data_format=data_format)
+        return self._request("FORMAT", data_format, parse=parse)
+
+    def SET_ROI(
+        self, roi: Sequence[Sequence[int]] | None, preview_step: int | None = None
+    ) -> List[List[int]]:
+        """Ask SGM4 to send only a region of interest of the spectra
+
+        The spectra sent afterwards, and spectrum_shape, are cropped to the region. SGM4
+        still saves the whole spectra.
+
+        Args:
+            roi: [[x0, x1], [y0, y1]] in pixels of the whole spectrum, None for all of it
+            preview_step: decimation of the whole spectrum sent by PREVIEW
+
+        Returns:
+            roi: the region SGM4 sends, clipped to the spectrum
+        """
+        roi = self._parse_set_roi(
+            self.send_command("SET_ROI", *self._format_roi(roi, preview_step))
+        )
+        if self.data_format == "shm":
+            self.SHM()  # SGM4 made a ring for the new spectrum shape
+        return roi
+
+    def _format_roi(
+        self, roi: Sequence[Sequence[int]] | None, preview_step: int | None
+    ) -> List[str]:
+        args = ["none"] if roi is None else [f"{int(lo)},{int(hi)}" for lo, hi in roi]
+        if preview_step is not None:
+            args.append(str(preview_step))
+        return args
+
+    def _parse_set_roi(self, response: str) -> List[List[int]]:
+        split = response.split(" ")
+        assert split[0] == "SET_ROI", f"Expected SET_ROI, got {split[0]}"
+        roi = [[int(v) for v in limit.split(",")] for limit in split[1:]]
+        self.roi = roi
+        self._spectrum_shape = [hi - lo for lo, hi in roi]
+        return roi
+
+    def PREVIEW(self) -> NDArray[Any] | None:
+        """Get the last whole spectrum, decimated as set by SET_ROI
+
+        Returns:
+            preview: the decimated spectrum, or None if nothing was measured yet
+        """
+        raw = self.data_format in BINARY_FORMATS
+        return self._request("PREVIEW", raw=raw, parse=self._parse_preview)
+
+    def _parse_preview(self, message: str | bytes | memoryview) -> NDArray[Any] | None:
+        if is_binary_message(message):
+            msg_code, _, data = decode_array_message(message)
+            assert msg_code == "PREVIEW", f"Expected PREVIEW, got {msg_code}"
+            return data.copy()  # detach from the connection receive buffer
+        if isinstance(message, bytes):
+            message = message.decode()
+        split = message.strip("\r\n").split(" ")
+        if split[0] == "NO_DATA":
+            return None
+        assert split[0] == "PREVIEW", f"Expected PREVIEW, got {split[0]}"
+        shape = tuple(int(n) for n in split[1].split(","))
+        return np.asarray(split[2:], dtype=float).reshape(shape)
+
+    def SHM(self) -> SharedRing:
+        """Attach to the shared memory ring SGM4 writes the spectra to in shm format
+
+        Returns:
+            ring: the ring, also stored in self.ring
+
+        Raises:
+            OSError: if the ring cannot be attached, e.g. SGM4 runs on another host
+            ValueError: if the ring does not hold spectra of the expected shape
+        """
+        return self._request("SHM", parse=self._parse_shm)
+
+    def _parse_shm(self, response: str) -> SharedRing:
+        split = response.split(" ", 1)
+        assert split[0] == "SHM", f"Expected SHM, got {split[0]}"
+        self._close_ring()
+        ring = SharedRing.attach(split[1])
+        if self._spectrum_shape is not None and ring.shape != self.spectrum_shape:
+            ring.close()
+            raise ValueError(f"Ring holds {ring.shape} arrays, not {self.spectrum_shape}")
+        self.ring = ring
+        return ring
+
+    def _parse_format(self, response: str, data_format: str) -> str:
+        split = response.split(" ")
+        assert split[0] == "FORMAT", f"Expected FORMAT, got {split[0]}"
+        if split[1] != data_format:
+            raise RuntimeError(f"Requested format {data_format}, got {split[1]}")
+        return split[1]
+
     def MEASURE(self) -> tuple[None, None] | tuple[NDArray[Any], NDArray[Any]]:
         """Measure the current position
 
         Returns:
             ack: MEASURE
         """
-        message = self.send_command("MEASURE")
+        spectrum_shape = self.spectrum_shape  # before MEASURE reuses the buffer
+        raw = self.data_format in BINARY_FORMATS
+        parse = partial(self._parse_detached, self.parse_measure, spectrum_shape)
+        return self._request("MEASURE", raw=raw, parse=parse)
+
+    def MEASURE_N(
+        self, k: int
+    ) -> tuple[str, None] | tuple[NDArray[Any], NDArray[Any]]:
+        """Fetch up to k spectra from the SGM4 output queue in one round trip
+
+        Args:
+            k: maximum number of spectra to fetch
+
+        Returns:
+            positions, data: positions with shape (n, ndim) and spectra with shape
+                (n, *spectrum_shape), or (message, None) if there is no data
+        """
+        spectrum_shape = self.spectrum_shape  # before MEASURE_N reuses the buffer
+        raw = self.data_format in BINARY_FORMATS
+        parse = partial(self._parse_detached, self.parse_measure_n, spectrum_shape)
+        return self._request("MEASURE_N", k, raw=raw, parse=parse)
+
+    def _parse_detached(
+        self,
+        parse: Callable,
+        spectrum_shape: Tuple[int],
+        message: str | bytes | memoryview,
+    ) -> tuple[str, None] | tuple[NDArray[Any], NDArray[Any]]:
+        """parse a MEASURE or MEASURE_N response into arrays owning their memory"""
+        positions, data = parse(message, spectrum_shape)
+        if isinstance(message, memoryview) and _is_view(data):
+            data = data.copy()  # detach from the connection receive buffer
+        return positions, data
+
+    async def STREAM(self) -> AsyncIterator[tuple[NDArray[Any], NDArray[Any]]]:
+        """Subscribe to the spectra pushed by SGM4 as soon as they are measured
+
+        Opens a dedicated connection, which is closed when the iteration stops.
+        Binary spectra are views on the receive buffer, only valid until the next
+        iteration: copy them to keep them.
+
+        Yields:
+            pos, data: position and spectrum
+
+        Raises:
+            RuntimeError: if SGM4 refuses the subscription
+        """
+        spectrum_shape = self.spectrum_shape
+        client = Client(
+            self.host,
+            self.port,
+            checksum=self.checksum,
+            timeout=self.timeout,
+            logger=self.logger,
+            compression=self.compression,
+            compress_threshold=self.compress_threshold,
+        )
+        await client.connect()
+        try:
+            await client.send_message("STREAM")
+            while True:
+                try:
+                    message = await client.receive_message()
+                    pos, data = self.parse_measure(message, spectrum_shape)
+                except ValueError as e:
+                    self.logger.error(f"Dropped corrupted STREAM message: {e}")
+                    continue
+                if data is None:
+                    raise RuntimeError(f"STREAM failed: {pos}")
+                yield pos, data
+        finally:
+            client.close()
+
+    def parse_measure_n(
+        self,
+        message: str | bytes | memoryview,
+        spectrum_shape: Tuple[int] = None,
+    ) -> tuple[str, None] | tuple[NDArray[Any], NDArray[Any]]:
+        """Interpret the response to a MEASURE_N command
+
+        A single MEASURE response is accepted too, as a batch of one spectrum. If SGM4
+        reduces the spectra (see `START`), data holds the task values, with shape
+        (n, n_tasks).
+        Binary responses are decoded without copying, shm responses are copied out of
+        the ring.
+
+        Args:
+            message: response in either text or binary format
+            spectrum_shape: shape of one spectrum, used for the text format
+
+        Returns:
+            positions, data: positions with shape (n, ndim) and spectra with shape
+                (n, *spectrum_shape), or (message, None) if there is no data
+        """
+        if is_binary_message(message):
+            msg_code, positions, data = decode_array_message(message)
+            if msg_code in ("MEASURE_N", "MEASURE_N_TASKS"):
+                return positions.reshape(len(data), -1), data
+        elif isinstance(message, (str, bytes)):
+            if isinstance(message, bytes):
+                message = message.decode()
+            vals = message.strip("\r\n").split(" ")
+            if vals[0] == "MEASURE_N":
+                vals = [v for v in vals[1:] if len(v) > 0]
+                n, ndim = int(vals[0]), int(vals[1])
+                positions = np.asarray(vals[2 : n * ndim + 2], dtype=float)
+                data = np.asarray(vals[n * ndim + 2 :], dtype=float)
+                if spectrum_shape is not None:
+                    data = data.reshape((n, *spectrum_shape))
+                else:
+                    data = data.reshape(n, -1)
+                return positions.reshape(n, ndim), data
+            if vals[0] == "MEASURE_N_TASKS":
+                vals = [v for v in vals[1:] if len(v) > 0]
+                n, ndim = int(vals[0]), int(vals[1])
+                positions = np.asarray(vals[2 : n * ndim + 2], dtype=float)
+                values = np.asarray(vals[n * ndim + 2 :], dtype=float)
+                return positions.reshape(n, ndim), values.reshape(n, -1)
+            if vals[0] == "MEASURE_N_SHM":
+                vals = [v for v in vals[1:] if len(v) > 0]
+                n, ndim = int(vals[0]), int(vals[1])
+                positions = np.asarray(vals[2 : n * ndim + 2], dtype=float)
+                slots = [v.split(":") for v in vals[n * ndim + 2 :]]
+                data = np.stack([self._read_ring(*slot) for slot in slots])
+                return positions.reshape(n, ndim), data
+        pos, data = self.parse_measure(message, spectrum_shape)
+        if data is None:
+            return pos, None
+        return pos[np.newaxis], data[np.newaxis]
+
+    def parse_measure(
+        self,
+        message: str | bytes | memoryview,
+        spectrum_shape: Tuple[int] = None,
+    ) -> tuple[str, None] | tuple[NDArray[Any], NDArray[Any]]:
+        """Interpret the response to a MEASURE command
+
+        Binary responses are decoded without copying: the returned spectrum shares memory
+        with the message. Spectra in shm format are copied out of the ring, as its slots
+        are recycled. If SGM4 reduces the spectra (see `START`), data holds the task
+        values.
+
+        Args:
+            message: response in either text or binary format
+            spectrum_shape: shape of the spectrum, used for the text format
+
+        Returns:
+            pos, data: position and spectrum, or (message, None) if there is no data
+
+        Raises:
+            ValueError: if the ring slot of a shm response was overwritten
+        """
+        if is_binary_message(message):
+            msg_code, pos, data = decode_array_message(message)
+            if msg_code in ("MEASURE", "MEASURE_TASKS"):
+                return pos, data
+            self.logger.warning(f"Unknown message code: {msg_code}")
+            return msg_code, None
+        if isinstance(message, bytes):
+            message = message.decode()
         vals = message.strip("\r\n").split(" ")
         msg_code = vals[0]
         vals = [v for v in vals[1:] if len(v) > 0]
@@ -398,9 +934,184 @@ class SGM4Commands:
                 n_pos = int(vals[0])
                 pos = np.asarray(vals[1 : n_pos + 1], dtype=float)
                 data = np.asarray(vals[n_pos + 1 :], dtype=float)
-                if self.spectrum_shape is not None:
-                    data = data.reshape(self.spectrum_shape)
+                if spectrum_shape is not None:
+                    data = data.reshape(spectrum_shape)
                 return pos, data
+            case "MEASURE_TASKS":
+                n_pos = int(vals[0])
+                pos = np.asarray(vals[1 : n_pos + 1], dtype=float)
+                return pos, np.asarray(vals[n_pos + 1 :], dtype=float)
+            case "MEASURE_SHM":
+                n_pos = int(vals[0])
+                pos = np.asarray(vals[1 : n_pos + 1], dtype=float)
+                return pos, self._read_ring(*vals[n_pos + 1 : n_pos + 3])
             case _:
                 self.logger.warning(f"Unknown message code: {msg_code}")
                 return message, None
+
+    def _read_ring(self, slot: str, seq: str) -> NDArray[Any]:
+        if self.ring is None:
+            raise ValueError("Received a shm spectrum without an attached ring")
+        return self.ring.read(int(slot), int(seq))
+
+
+class AsyncSGM4Commands(SGM4Commands):
+    """Awaitable version of `SGM4Commands`, for use from coroutines
+
+    Every command returns an awaitable sending its message over a pool of non-blocking
+    `TCP.Client` connections, so waiting for SGM4 never blocks the event loop. The
+    commands are those of `SGM4Commands`, whose responses are awaited in `_request`
+    before they are parsed; only the commands sending several requests are written
+    again here. A command
+    that takes longer than timeout raises asyncio.TimeoutError. A command that times out
+    or is cancelled closes its connection, which is opened again by the next command.
+
+    With pipeline=True, commands share the connections instead of waiting for a free
+    one, so that STATUS or ADD_POINT is answered while a large MEASURE_N response is
+    still being transferred. A pipelined command that times out leaves its connection
+    open.
+
+    The scan info (ndim, limits, spectrum shape, ...) is fetched by `connect`, which must
+    be awaited before using the properties: they raise RuntimeError until then.
+
+    Args: see `SGM4Commands`, and
+        pipeline: tag requests with ids, so responses can arrive out of order
+    """
+
+    def __init__(
+        self,
+        host: str,
+        port: int,
+        checksum: bool = False,
+        verbose: bool = True,
+        timeout: float = 1.0,
+        data_format: str = "binary",
+        pool_size: int = 2,
+        compression: str | None = None,
+        compress_threshold: int = COMPRESS_THRESHOLD,
+        pipeline: bool = True,
+    ) -> None:
+        super().__init__(
+            host,
+            port,
+            checksum=checksum,
+            verbose=verbose,
+            timeout=timeout,
+            data_format=data_format,
+            pool_size=pool_size,
+            compression=compression,
+            compress_threshold=compress_threshold,
+        )
+        self.logger = logging.getLogger(f"{__name__}.AsyncSGM4Commands")
+        self.pool = AsyncConnectionPool(
+            host,
+            port,
+            size=pool_size,
+            checksum=checksum,
+            timeout=timeout,
+            logger=self.logger,
+            compression=compression,
+            compress_threshold=compress_threshold,
+            pipeline=pipeline,
+        )
+
+    async def send_command(self, command, *args, raw: bool = False) -> str | memoryview:
+        """send a command to SGM4 and wait for a response
+
+        Args:
+            command: command to send
+            args: arguments to send with the command
+            raw: unused, binary responses are always returned as a memoryview
+
+        Returns:
+            response: response from SGM4
+        """
+        message = self._format_command(command, *args)
+        try:
+            response = await self.pool.request(message, self.timeout)
+        except ValueError as e:  # corrupted frame
+            raise RuntimeError(f"Error: {e}") from e
+        return self._check_response(command, message, response)
+
+    async def _request(
+        self, command: str, *args, parse: Callable[[Any], Any], raw: bool = False
+    ) -> Any:
+        """send a command and return its response as interpreted by parse"""
+        return parse(await self.send_command(command, *args, raw=raw))
+
+    def _fetch_info(self, command: str) -> None:
+        """the scan info cannot be fetched from a property, connect fetches it all"""
+        raise RuntimeError(f"{command} not fetched yet, await connect() first")
+
+    async def connect(self) -> None:
+        """ask SGM4 for the scan info, see `SGM4Commands.connect`
+
+        The spectrum shape and the step size are fetched too, so that all properties are
+        available afterwards.
+        """
+        try:
+            await self.INFO()
+        except RuntimeError as e:
+            self.logger.info(f"INFO failed ({e}), asking for the scan info one by one")
+            await self.NDIM()
+            await self.LIMITS()
+            assert (
+                len(self._limits) == self._ndim
+            ), f"Expected {self._ndim} limits, got {len(self._limits)}"
+            try:
+                await self.CURRENT_POS()
+            except IndexError:
+                pass
+            await self.FILENAME()
+            await self.SHAPE()
+            await self.STEP_SIZE()
+        self._filename = Path(self._filename)
+        if self._filename.is_file():
+            print(f"file {self._filename} found! good to go!")
+        else:
+            Warning(f"Expected {self._filename} to be a file")
+        await self.negotiate_data_format()
+
+    async def negotiate_data_format(self) -> str:
+        """agree with SGM4 on the MEASURE payload format, see `SGM4Commands`"""
+        data_format = self.preferred_data_format
+        while True:
+            try:
+                self.data_format = await self.FORMAT(data_format)
+                if self.data_format == "shm":
+                    await self.SHM()
+                break
+            except (RuntimeError, OSError, ValueError) as e:
+                self.data_format = "text"
+                if data_format not in DATA_FORMAT_FALLBACK:
+                    break
+                data_format = DATA_FORMAT_FALLBACK[data_format]
+                self.logger.warning(f"FORMAT failed ({e}), trying {data_format}")
+        self.logger.info(f"MEASURE data format: {self.data_format}")
+        return self.data_format
+
+    async def WAIT_READY(self, timeout: float) -> str:
+        """Wait until SGM4 is ready to scan, see `SGM4Commands.WAIT_READY`"""
+        deadline = time.monotonic() + timeout
+        while True:
+            try:
+                wait = self._ready_wait(deadline)
+                ready, status = self._parse_wait_ready(
+                    await self.send_command("WAIT_READY", wait)
+                )
+            except (TimeoutError, asyncio.TimeoutError):  # distinct before python 3.11
+                ready, status = False, "unresponsive"
+            if ready:
+                return status
+            if time.monotonic() >= deadline:
+                raise TimeoutError(f"SGM4 not ready after {timeout} s. Status: {status}")
+
+    async def SET_ROI(
+        self, roi: Sequence[Sequence[int]] | None, preview_step: int | None = None
+    ) -> List[List[int]]:
+        """Send only a region of interest of the spectra, see `SGM4Commands.SET_ROI`"""
+        args = self._format_roi(roi, preview_step)
+        roi = self._parse_set_roi(await self.send_command("SET_ROI", *args))
+        if self.data_format == "shm":
+            await self.SHM()  # SGM4 made a ring for the new spectrum shape
+        return roi
@@ -1,22 +1,28 @@
 import argparse  
 import asyncio  
+import contextlib
+import inspect
 import itertools  
+import json
 import logging  
 import multiprocessing as mp  
 import time  
 from pathlib import Path  
-from typing import Any, Callable, Sequence, Tuple  
+from typing import Any, AsyncIterator, Awaitable, Callable, Sequence, Tuple
 
 import h5py  
 import numpy as np  
 import yaml  
-from tqdm.auto import tqdm, trange  
+from tqdm.auto import tqdm  
 
 # import smartscan.tasks as processing  
-from smartscan import TCP, tasks, utils  
+from smartscan import TCP, preprocessing, tasks, utils  
 
-class VirtualSGM4(TCP.Server):  
-    MOTOR_SPEED = 300  # um/s  
+class VirtualSGM4(TCP.Server):
+    MOTOR_SPEED = 300  # um/s
+    DATA_FORMATS = ("text", "binary", "shm", "float16", "uint16")
+    RING_SLOTS = 128  # spectra kept in shared memory before a slot is recycled
+    STREAM_POLL = 0.01  # s, bounds the delay of the output queue feeder thread
 
     def __init__(  
         self,  
@@ -26,7 +32,6 @@ class VirtualSGM4(TCP.Server):
         source_file: str | Path = None,  
         limits: list[tuple[float]] = None,  
         step_size: Sequence[float] = None,  
-        buffer_size: int = 1024 * 1024 * 8,  
         dwell_time: float = None,  
         simulate_times: bool = False,  
         save_to_file: bool = True,  
@@ -37,7 +42,15 @@ class VirtualSGM4(TCP.Server):
         self.logger.info("Initializing VirtualSGM4 object")  
         self.output_queue = mp.Queue()  
         self.input_queue = mp.Queue()  
-        self.status = "IDLE"  # TODO: implement status  
+        self.status = "IDLE"  # TODO: implement status
+        self.data_format = "text"  # MEASURE payload format, see FORMAT
+        self._data_acquired = asyncio.Event()  # set when a spectrum is queued
+        self._ready = asyncio.Event()  # set once the scan loop accepts points
+        self.ring = None  # shared memory ring used by the shm format
+        self.roi = None  # [[x0, x1], [y0, y1]] sent by MEASURE, None for the whole spectrum
+        self.preview_step = 4  # decimation of the PREVIEW spectrum
+        self.last_frame = None  # last position and whole spectrum acquired, for PREVIEW
+        self.task_settings = None  # tasks reduced next to acquire_data, see START
         if source_file is not None:  
             self.init_scan_from_file(source_file)  
         elif limits is not None and step_size is not None:  
@@ -265,7 +278,12 @@ class VirtualSGM4(TCP.Server):
         pos, data = self.read_data(self.current_pos)
         if self.save_to_file:
             self.write_data(pos, data)
-        self.output_queue.put_nowait((pos, data))
+        if self.task_settings is None:
+            self.output_queue.put_nowait((pos, data))
+        else:
+            self.output_queue.put_nowait((pos, self.reduce(data)))
+        self.last_frame = pos, data
+        self._data_acquired.set()
         self.logger.info(
             f"Acquired data at position {pos} | output queue size: {self.output_queue.qsize()}"
         )
@@ -313,6 +331,7 @@ class VirtualSGM4(TCP.Server):
         time.sleep(2)  # yes, this should freeze the server for 2 seconds
         self.logger.info("Server Ready!")
         self.status = "ready"
+        self._ready.set()
 
         self.wait_at_queue_empty = True
         # self.current_pos = [np.mean(l) for l in self.limits]
@@ -365,11 +384,19 @@ class VirtualSGM4(TCP.Server):
         # ORDERS:
 
         ADD_POINT xx yy zz - add position xxyyzz to the queue -> ADD_POINT xx yy zz queue_length
+        ADD_POINTS n x0,y0 x1,y1 ... - add n positions to the queue, snapped to the grid
+            -> ADD_POINTS n x0,y0 x1,y1 ... queue_length
         CLEAR - reset the queue -> CLEAR
         SCAN - start the scan -> SCAN
+        START [tasks] - get ready to scan -> START
+            with the task settings as JSON, e.g. {"mean":{"function":"mean","params":{}}},
+            each spectrum is reduced to the tasks and MEASURE sends the task values
+            -> START TASKS name0,name1,...
         END - stop waiting at queue empty -> END queue_length
         ABORT - stop the scan -> ABORT
         PAUSE - pause the scan or resumes it -> PAUSE
+        FORMAT fmt - set the MEASURE payload format (text|binary|shm|float16|uint16)
+            -> FORMAT fmt
 
         # REQUESTS:
 
@@ -378,7 +405,30 @@ class VirtualSGM4(TCP.Server):
         CURRENT_POS - returns the current position -> CURRENT_POS xx yy zz
         QUEUE - returns all the points in the queue -> QUEUE xx,yy,zz, xx,yy,zz xx yy zz
         STATUS - returns the status of the scanner -> STATUS status
+        WAIT_READY t - waits up to t seconds for the scanner to be ready
+            -> WAIT_READY 1 status, or WAIT_READY 0 status if it is not ready yet
+        INFO - returns the scan metadata at once -> INFO {"ndim": n, "limits": ..., ...}
+        SET_ROI x0,x1 y0,y1 [step] - MEASURE sends only this region of the spectra, and
+            PREVIEW decimates by step -> SET_ROI x0,x1 y0,y1 clipped to the spectrum
+            SET_ROI none sends the whole spectra again -> SET_ROI 0,nx 0,ny
+        PREVIEW - returns the last whole spectrum decimated by step
+            -> PREVIEW nx,ny data, or in a binary format PREVIEW_BINARY ...
         FILENAME - returns the filename of the current scan -> FILENAME filename
+        SHM - describes the shared memory ring of the shm format -> SHM name slots shape dtype
+        MEASURE - returns the oldest spectrum in the output queue -> MEASURE n xx yy data
+            or, in binary format, MEASURE_BINARY n xx yy shape dtype nbytes\n<bytes>
+            or, in shm format, MEASURE_SHM n xx yy slot seq
+            float16 and uint16 are binary formats with 16 bits per value, see TCP.quantize_array
+            or, with tasks set by START, MEASURE_TASKS n xx yy value0 value1 ...
+            or, in a binary format, MEASURE_TASKS_BINARY n xx yy n_tasks dtype nbytes\n<bytes>
+        MEASURE_N k - returns up to k spectra from the output queue
+            -> MEASURE_N n ndim x0 y0 x1 y1 ... data0 data1 ...
+            or, in binary format, MEASURE_N_BINARY n*ndim x0 y0 ... n,shape dtype nbytes\n<bytes>
+            or, in shm format, MEASURE_N_SHM n ndim x0 y0 x1 y1 ... slot0:seq0 slot1:seq1 ...
+            or, with tasks set by START, MEASURE_N_TASKS n ndim x0 y0 ... values0 values1 ...
+            or, in a binary format, MEASURE_N_TASKS_BINARY n*ndim x0 y0 ... n,n_tasks ...
+        STREAM - keeps the connection open and sends each spectrum as a MEASURE response
+            as soon as it is acquired
 
         ERROR errortype parameters
 
@@ -403,7 +453,11 @@ class VirtualSGM4(TCP.Server):
             raise e
         finally:
             truncated_message = message[:50] + "..." if len(message) > 50 else message
-            truncated_answer = answer[:50] + "..." if len(answer) > 50 else answer
+            truncated_answer = (
+                f"{answer[:50]}..."
+                if isinstance(answer, (str, bytes)) and len(answer) > 50
+                else answer
+            )
             # self.logger.debug(f'Received message "{truncated_message.strip('\n')}", answer "{truncated_answer.strip('\n')}"')
             return answer
 
@@ -416,6 +470,27 @@ class VirtualSGM4(TCP.Server):
         pts = " ".join([str(x) for x in args])
         return f"ADD_POINT {pts}"  # {len(self.queue)}
 
+    def ADD_POINTS(self, n: str, *args) -> str:
+        """Add n points, given as x,y,z strings, to the queue in one go.
+
+        Points are snapped to the scan grid before being queued.
+        """
+        n = int(n)
+        assert len(args) == n, f"expected {n} points, got {len(args)}"
+        snapped = []
+        for arg in args:
+            point = [float(x) for x in arg.split(",")]
+            assert (
+                len(point) == self.ndim
+            ), f"expected {self.ndim} coordinates, got {len(point)}"
+            point = [
+                float(axis[np.abs(axis - x).argmin()])
+                for axis, x in zip(self.axes, point)
+            ]
+            self.input_queue.put_nowait(point)
+            snapped.append(",".join([str(x) for x in point]))
+        return f"ADD_POINTS {n} {' '.join(snapped)} {self.input_queue.qsize()}"
+
     def CLEAR(self) -> str:
         self.input_queue.clear()
         return "CLEAR"
@@ -424,9 +499,24 @@ class VirtualSGM4(TCP.Server):
         self.status = "SCANNING"
         return "SCAN"
 
-    def START(self) -> str:
+    def START(self, *args) -> str:
+        task_settings = json.loads(" ".join(args)) if len(args) > 0 else None
+        for name, d in (task_settings or {}).items():
+            if not callable(getattr(tasks, d["function"], None)):
+                raise ValueError(f"unknown function {d['function']} for task {name}")
+        self.task_settings = task_settings
         self.status = "READY"
-        return "START"
+        if self.task_settings is None:
+            return "START"
+        return f"START TASKS {','.join(self.task_settings)}"
+
+    def reduce(self, data: np.ndarray) -> np.ndarray:
+        """reduce a spectrum to the values of the tasks set by START"""
+        reduced = []
+        for d in self.task_settings.values():
+            func = getattr(tasks, d["function"])
+            reduced.append(func(data, **(d.get("params") or {})))
+        return np.asarray(reduced, dtype=float).flatten()
 
     def END(self) -> str:
         self.wait_at_queue_empty = False
@@ -434,6 +524,7 @@ class VirtualSGM4(TCP.Server):
 
     def ABORT(self) -> str:
         self.status = "ABORTED"
+        self._ready.clear()
         # TODO: stop the measurement loop
         return "ABORT"
 
@@ -462,36 +553,229 @@ class VirtualSGM4(TCP.Server):
     def STATUS(self) -> str:
         return f"STATUS {self.status}"
 
+    async def WAIT_READY(self, timeout: str = "0") -> str:
+        with contextlib.suppress(asyncio.TimeoutError):
+            await asyncio.wait_for(self._ready.wait(), float(timeout))
+        return f"WAIT_READY {int(self._ready.is_set())} {self.status}"
+
+    def INFO(self) -> str:
+        info = {
+            "ndim": self.ndim,
+            "limits": [
+                [float(x), float(y)] for x, y in zip(self.limits[::2], self.limits[1::2])
+            ],
+            "step_size": [float(s) for s in self.steps],
+            "shape": list(self.measure_shape),
+            "roi": self.roi,
+            "filename": str(self.target_file_name),
+            "current_pos": {d: float(x) for d, x in zip(self.dims, self.current_pos)},
+            "status": self.status,
+        }
+        return f"INFO {json.dumps(info)}"
+
     def FILENAME(self) -> Path:
         return f"FILENAME {self.target_file_name}"
 
     def ERROR(self, error: str) -> str:
         return f"ERROR {error}"
 
-    def MEASURE(self) -> str:
+    def FORMAT(self, data_format: str = None) -> str:
+        if data_format is not None:
+            data_format = data_format.lower()
+            if data_format not in self.DATA_FORMATS:
+                raise ValueError(f"unknown data format {data_format}")
+            if data_format == "shm" and self.ring is None:
+                self.ring = TCP.SharedRing(self.measure_shape, np.float32, self.RING_SLOTS)
+            self.data_format = data_format
+        return f"FORMAT {self.data_format}"
+
+    def SHM(self) -> str:
+        if self.ring is None:
+            raise RuntimeError("no shared memory ring, set FORMAT shm first")
+        return f"SHM {self.ring.describe()}"
+
+    def MEASURE(self) -> str | bytes | Awaitable[str | bytes]:
         # pos, data = self.acquire_data(changed = [False,False])
         if self.output_queue.empty():
             return "NO_DATA"
         pos, data = self.output_queue.get_nowait()
+        if self.task_settings is not None:
+            return self._encode_tasks("MEASURE_TASKS", pos, data)
+        data = self._crop(data)
+        if self.data_format == "shm":
+            pos_str = " ".join([str(v) for v in pos])
+            slot, seq = self.ring.write(data)
+            self.logger.info(f"MEASURE {len(pos)} {pos_str} shm slot {slot}")
+            return f"MEASURE_SHM {len(pos)} {pos_str} {slot} {seq}"
+        # encoding a whole spectrum would hold up the other requests. The format is
+        # read and the spectrum cropped here, as SET_ROI and FORMAT may change them
+        self.logger.info(f"MEASURE {len(pos)} {pos} {self.data_format} {data.shape}")
+        return asyncio.to_thread(self._encode_measure, self.data_format, pos, data)
+
+    @staticmethod
+    def _encode_measure(data_format: str, pos, data: np.ndarray) -> str | bytes:
+        """MEASURE response in the text or a binary format, run in a worker thread"""
+        if data_format in ("binary", *TCP.QUANTIZED_DTYPES):
+            return VirtualSGM4._encode_binary(data_format, "MEASURE", pos, data)
         pos_str = " ".join([str(v) for v in pos])
         data_str = " ".join(
             [str(np.round(v, 4).astype(np.float32)) for v in data.ravel()]
         )
-        self.logger.info(f"MEASURE {len(pos)} {pos_str} {data_str[:30]}...")
         # pos_str =  ' '.join([str(v) for v in self.current_pos])
         # data_str = ' '.join([str(np.round(v,4).astype(np.float32)) for v in np.random.rand(640,400).ravel()])
         # time.sleep(np.random.rand(1)[0])
         # print()
-        return f"MEASURE {len(self.current_pos)} {pos_str} {data_str}"
+        return f"MEASURE {len(pos)} {pos_str} {data_str}"
+
+    def MEASURE_N(self, k: str) -> str | bytes | Awaitable[str | bytes]:
+        """Return up to k spectra from the output queue in a single response.
+
+        Positions are stacked to shape (n, ndim) and spectra to shape (n, *signal_shape).
+        Spectra are taken from the queue at once, and stacked and encoded in a worker
+        thread, so that the server keeps answering other requests meanwhile.
+        """
+        k = int(k)
+        if k < 1:
+            raise ValueError(f"MEASURE_N expects a positive count, got {k}")
+        if self.data_format == "shm":
+            k = min(k, self.ring.slots)  # the batch must not wrap around the ring
+        batch = []
+        while len(batch) < k and not self.output_queue.empty():
+            batch.append(self.output_queue.get_nowait())
+        if len(batch) == 0:
+            return "NO_DATA"
+        positions = np.asarray([pos for pos, _ in batch], dtype=float)
+        if self.task_settings is not None:
+            values = np.stack([d for _, d in batch])
+            return self._encode_tasks("MEASURE_N_TASKS", positions, values)
+        if self.data_format == "shm":
+            # ring slots are written in queue order, on the event loop
+            pos_str = " ".join([str(v) for v in positions.ravel()])
+            slots = [self.ring.write(self._crop(d)) for _, d in batch]
+            slots = " ".join(["%d:%d" % slot for slot in slots])
+            self.logger.info(f"MEASURE_N {len(batch)} shm {slots}")
+            return f"MEASURE_N_SHM {len(batch)} {positions.shape[1]} {pos_str} {slots}"
+        # cropped here, with the region and the format of the request, see MEASURE
+        spectra = [self._crop(d) for _, d in batch]
+        self.logger.info(f"MEASURE_N {len(batch)} {self.data_format}")
+        return asyncio.to_thread(
+            self._encode_measure_n, self.data_format, positions, spectra
+        )
+
+    @staticmethod
+    def _encode_measure_n(
+        data_format: str, positions: np.ndarray, spectra: list[np.ndarray]
+    ) -> str | bytes:
+        """MEASURE_N response in the text or a binary format, run in a worker thread"""
+        data = np.stack(spectra)
+        if data_format in ("binary", *TCP.QUANTIZED_DTYPES):
+            return VirtualSGM4._encode_binary(
+                data_format, "MEASURE_N", positions.ravel(), data, batched=True
+            )
+        pos_str = " ".join([str(v) for v in positions.ravel()])
+        data_str = " ".join(
+            [str(np.round(v, 4).astype(np.float32)) for v in data.ravel()]
+        )
+        return f"MEASURE_N {len(data)} {positions.shape[1]} {pos_str} {data_str}"
+
+    @staticmethod
+    def _encode_binary(
+        data_format: str, code: str, pos, data: np.ndarray, batched: bool = False
+    ) -> bytes:
+        """binary message in data_format, quantizing the spectra if asked to"""
+        if data_format == "binary":
+            return TCP.encode_array_message(code, pos, data.astype(np.float32))
+        data, offset, scale = TCP.quantize_array(data, data_format, batched)
+        return TCP.encode_array_message(code, pos, data, offset, scale)
+
+    def _encode_tasks(self, code: str, pos, values: np.ndarray) -> str | bytes:
+        """task values, binary unless the data format is text
+
+        pos and values have a leading batch axis for MEASURE_N_TASKS.
+        """
+        if self.data_format != "text":
+            self.logger.info(f"{code} {self.data_format} {values.shape}")
+            return TCP.encode_array_message(code, np.ravel(pos), values)
+        pos = np.asarray(pos, dtype=float)
+        pos_str = " ".join([str(v) for v in pos.ravel()])
+        values_str = " ".join([repr(float(v)) for v in values.ravel()])
+        self.logger.info(f"{code} {pos_str} {values_str[:30]}...")
+        if code == "MEASURE_N_TASKS":
+            return f"{code} {len(pos)} {pos.shape[1]} {pos_str} {values_str}"
+        return f"{code} {len(pos)} {pos_str} {values_str}"
+
+    async def stream_messages(self) -> AsyncIterator[str | bytes]:
+        """Push each spectrum to the client as soon as it is acquired."""
+        while True:
+            message = self.MEASURE()
+            if message != "NO_DATA":
+                yield await message if inspect.isawaitable(message) else message
+                continue
+            self._data_acquired.clear()
+            try:
+                await asyncio.wait_for(self._data_acquired.wait(), self.STREAM_POLL)
+            except asyncio.TimeoutError:
+                pass
 
     def SHAPE(self) -> str:
-        return f"SHAPE {self.signal_shape[0]} {self.signal_shape[1]}"
+        return f"SHAPE {self.measure_shape[0]} {self.measure_shape[1]}"
+
+    @property
+    def measure_shape(self) -> tuple[int]:
+        """shape of the spectra sent by MEASURE"""
+        if self.roi is None:
+            return tuple(int(n) for n in self.signal_shape)
+        return tuple(hi - lo for lo, hi in self.roi)
+
+    def _crop(self, data: np.ndarray) -> np.ndarray:
+        if self.roi is None:
+            return data
+        (x0, x1), (y0, y1) = self.roi
+        return data[x0:x1, y0:y1]
+
+    def SET_ROI(self, *args) -> str:
+        """Send only a region of interest of the spectra, the whole ones are still saved"""
+        if len(args) == 0 or args[0].lower() == "none":
+            self.roi = None
+        else:
+            roi = []
+            for arg, n in zip(args[:2], self.signal_shape):
+                lo, hi = (int(v) for v in arg.split(","))
+                lo, hi = max(lo, 0), min(hi, int(n))
+                if lo >= hi:
+                    raise ValueError(f"empty region of interest {arg} for size {n}")
+                roi.append([lo, hi])
+            self.roi = roi
+        if len(args) > 2:
+            self.preview_step = max(int(args[2]), 1)
+        if self.ring is not None and self.ring.shape != self.measure_shape:
+            self.ring.close()
+            self.ring = TCP.SharedRing(self.measure_shape, np.float32, self.RING_SLOTS)
+        roi = self.roi or [[0, int(n)] for n in self.signal_shape]
+        return f'SET_ROI {" ".join([f"{lo},{hi}" for lo, hi in roi])}'
+
+    def PREVIEW(self) -> str | bytes:
+        if self.last_frame is None:
+            return "NO_DATA"
+        pos, data = self.last_frame
+        step = self.preview_step
+        nx, ny = data.shape[0] // step, data.shape[1] // step
+        # mean of step x step blocks
+        preview = data[: nx * step, : ny * step].reshape(nx, step, ny, step).mean((1, 3))
+        if self.data_format == "text":
+            data_str = " ".join(
+                [str(np.round(v, 4).astype(np.float32)) for v in preview.ravel()]
+            )
+            return f"PREVIEW {nx},{ny} {data_str}"
+        return TCP.encode_array_message("PREVIEW", pos, preview.astype(np.float32))
 
     def STEP_SIZE(self) -> str:
         return f'STEP_SIZE {" ".join([str(s) for s in self.steps])}'
 
     def __del__(self) -> None:
         self.close_file()
+        if self.ring is not None:
+            self.ring.close()
 
 
 class SGM4FileManager:
@@ -567,11 +851,11 @@ class SGM4FileManager:
             assert ds is not None, "File does not contain data"
             # cache data
             if self._data is None:
-                self._data = np.zeros(ds.shape)
+                self._data = np.zeros(ds.shape, dtype=ds.dtype)
             elif self._data.shape != ds.shape:
                 # resize if shape is different
                 old = self._data
-                self._data = np.zeros(ds.shape)
+                self._data = np.zeros(ds.shape, dtype=ds.dtype)
                 self._data[: old.shape[0], : old.shape[1]] = old
             if isinstance(index, int):
                 index = slice(index, None, None)
@@ -629,11 +913,9 @@ class SGM4FileManager:
             return positions, data
 
     def get_last_n_spectra(self, n) -> np.ndarray:
-        out = np.zeros((n, 640, 400))
-        for i in range(n):
-            with h5py.File(self.filename, "r", swmr=self.swmr) as f:
-                ds = f["Entry/Data/TransformedData"]
-                out[-i, :, :] = ds[-i, :, :]
+        with h5py.File(self.filename, "r", swmr=self.swmr) as f:
+            ds = f["Entry/Data/TransformedData"]
+            out = ds[len(ds) - n :]  # in the dtype of the file
         return out
 
     def get_merged_data(self, index: int, func: str | Callable = "mean") -> dict:
@@ -676,38 +958,61 @@ class SGM4FileManager:
         return len(self) > len_old_data
 
     def get_reduced_data(
-        self, index: int | slice, pipe: Sequence[str | Callable] = ["sum"]
+        self,
+        index: int | slice,
+        pipe: Sequence[str | Callable] = ["sum"],
+        steps: Sequence[preprocessing.Step] = (),
+        source: str = preprocessing.RAW,
     ) -> np.ndarray:
         """Apply dimensionality reduction to data from file.
 
         Args:
             index: index of spectrum to get. If slice, get slice of data
                 if int, get single spectrum
-            func: function to reduce data with
+            pipe: sequence of functions to reduce data with
+            steps: preprocessing steps to run first, see preprocessing.build
+            source: output of the steps the pipe reads, the spectrum by default
 
         Returns:
             reduced: reduced data
         """
-        data = self.get_combined_data(index)
-        reduced = np.zeros((len(data), len(data[0])))
-        for i, d in tqdm(enumerate(data), total=len(data), desc="Reducing data"):
-            reduced[i] = self.process(d, pipe)
-        return reduced
+        data = self.get_data(index)
+        reduced = self.process(data, pipe, steps, source)
+        return np.asarray(reduced).reshape(len(data), -1)
 
-    def process(self, data: np.ndarray, pipe: Sequence[str | Callable]) -> np.ndarray:
-        """Apply a sequence of functions to data.
+    def process(
+        self,
+        data: np.ndarray,
+        pipe: Sequence[str | Callable],
+        steps: Sequence[preprocessing.Step] = (),
+        source: str = preprocessing.RAW,
+    ) -> np.ndarray:
+        """Apply a sequence of functions to a stack of spectra.
+
+        The preprocessing steps run first on each spectrum, as in SmartScan, and the pipe
+        starts from their output named source. Functions named by a string are tasks,
+        reducing each spectrum of the stack in one call, or numpy functions, reducing
+        each spectrum over its axes. Callables get the whole stack.
 
         Args:
-            data: data to process
+            data: spectra to process, with shape (n, *spectrum_shape)
             pipe: sequence of functions to apply to data
+            steps: preprocessing steps to run first, see preprocessing.build
+            source: output of the steps the pipe reads, the spectrum by default
 
         Returns:
             processed: processed data
         """
-        processed = data
+        processed = preprocessing.run_stack(data, steps)[source]
         for f in pipe:
-            if isinstance(f, str):
+            if isinstance(f, str) and hasattr(tasks, f):
                 processed = getattr(tasks, f)(processed)
+            elif isinstance(f, str) and processed.ndim > 1:
+                # reduce each spectrum, or each row of task values, over its axes
+                axes = tuple(range(1, processed.ndim))
+                processed = getattr(np, f)(processed, axis=axes)
+            elif isinstance(f, str):
+                pass  # one value per spectrum already, nothing left to reduce
             else:
                 processed = f(processed)
         return processed
@@ -720,55 +1025,58 @@ class SGM4FileManager:
         else:
             return self._stack
 
-    def reduce(self, func: Callable | str) -> np.ndarray | None:
+    def reduce(
+        self,
+        func: Callable | str,
+        steps: Sequence[preprocessing.Step] = (),
+        source: str = preprocessing.RAW,
+        chunk_size: int = 256,
+    ) -> np.ndarray | None:
         """Reduce each spectrum to a smaller feature space.
 
+        The file is read and reduced chunk_size spectra at a time.
+
         Args:
             func: function to reduce stack with
+            steps: preprocessing steps to run first, see preprocessing.build
+            source: output of the steps func reads, the spectrum by default
+            chunk_size: number of spectra read at once. Defaults to 256.
 
         Returns:
             reduced: reduced stack
         """
-        if hasattr(np, func):  # check if function is a numpy function
-            func = getattr(np, func)
-        elif callable(func):
-            pass
-        elif hasattr(
-            tasks, func
-        ):  # check if function is a function in the reduce module
-            func = getattr(tasks, func)
-        else:
+        if not callable(func) and not hasattr(np, func) and not hasattr(tasks, func):
             raise ValueError(
                 "Function is not a numpy function nor a callable nor a "
-                / "function in the reduce module"
+                "function in the reduce module"
             )
-        for i in trange(len(self), desc="Reducing spectra"):
-            reduced = func(self.get_data(i))
-            if not isinstance(reduced, np.ndarray):
-                reduced = np.array(reduced)
-            if reduced.ndim == 0:
-                reduced = reduced.reshape((1,))
-            elif reduced.ndim >= 2:
-                reduced = reduced.flatten()
-            # cache reduced stack
-            if self._stack is None:
-                self._stack = np.empty((len(self), len(reduced) + self.ndim))
-            if self._stack.shape[1] != len(reduced) + self.ndim:
-                # resize if shape is different
-                old = self._stack
-                self._stack = np.empty((len(self), len(reduced) + self.ndim))
-                self._stack[: old.shape[0], : old.shape[1]] = old
-
-            pos = self.get_positions(i)
-            if pos.ndim == 0:
-                pos = pos.reshape((1,))
-            elif pos.ndim >= 2:
-                pos = pos.flatten()
-
-            self._stack[i, ...] = np.concatenate([pos, reduced])
-
+        n = len(self)
+        reduced = []
+        for i in tqdm(range(0, n, chunk_size), desc="Reducing spectra"):
+            data = self.get_data(slice(i, min(i + chunk_size, n)))
+            data = preprocessing.run_stack(data, steps)[source]
+            reduced.append(self._reduce_chunk(data, func))
+        reduced = np.concatenate(reduced) if n > 0 else np.empty((0, 0))
+        positions = self.get_positions(slice(None)).reshape(n, -1)
+        # cache reduced stack
+        self._stack = np.concatenate([positions, reduced], axis=1)
         return self._stack
 
+    @staticmethod
+    def _reduce_chunk(data: np.ndarray, func: Callable | str) -> np.ndarray:
+        """reduce a stack of spectra with func, see reduce"""
+        if callable(func):
+            # any callable, one spectrum at a time
+            reduced = np.stack([np.asarray(func(d)).flatten() for d in data])
+        elif hasattr(np, func):  # check if function is a numpy function
+            if data.ndim > 1:
+                reduced = getattr(np, func)(data, axis=tuple(range(1, data.ndim)))
+            else:
+                reduced = data  # one value per spectrum already
+        else:  # a function in the reduce module
+            reduced = getattr(tasks, func)(data)  # the whole chunk in one call
+        return np.asarray(reduced).reshape(len(data), -1)
+
     @property
     def raw_data(self) -> np.ndarray:
         """Get stack from file."""
@@ -4,6 +4,8 @@ import logging
 import shutil
 import time
 import traceback
+from concurrent.futures import Executor, ProcessPoolExecutor, ThreadPoolExecutor
+from contextlib import suppress
 from functools import partial
 from pathlib import Path
 import threading  # 导入threading模块
@@ -12,10 +14,10 @@ import matplotlib.pyplot as plt
 import numpy as np
 import yaml
 from gpcam.gp_optimizer import fvGPOptimizer
-from typing import Optional  #临时加入
+from typing import Optional, Sequence  #临时加入
 from scipy.stats import qmc # 导入qmc模块
 
-from . import TCP, gp, plot, sgm4commands, tasks, utils
+from . import TCP, gp, plot, preprocessing, sgm4commands, store, tasks, utils
 
 # 定义初始点字典  
 RELATIVE_INITIAL_POINTS = {  
@@ -239,6 +241,39 @@ def resume_scan():
     global_pause = False
 
 
+def _reduce_spectrum(
+    data: np.ndarray,
+    task_list: list[tuple[str, dict | None, str]],
+    steps: Sequence[preprocessing.Step] = (),
+) -> np.ndarray:
+    """reduce a spectrum to tasks, given as (function name, params, input) triples
+
+    The preprocessing steps run first, once, and each task reads its input among their
+    outputs. Module level, so that it can run in a process pool.
+    """
+    intermediates = preprocessing.run(data, steps)
+    reduced = []
+    for function, kwargs, source in task_list:
+        func = getattr(tasks, function)
+        if kwargs is None:
+            reduced.append(func(intermediates[source]))
+        else:
+            reduced.append(func(intermediates[source], **kwargs))
+    return np.asarray(reduced, dtype=float).flatten()
+
+
+def _reduce_batch_spectra(
+    data: Sequence[np.ndarray],
+    task_list: list[tuple[str, dict | None, str]],
+    steps: Sequence[preprocessing.Step] = (),
+) -> np.ndarray:
+    """reduce a batch of spectra to tasks, one row per spectrum, see _reduce_spectrum
+
+    A single pool job per batch, which is sent to the worker in one go.
+    """
+    return np.stack([_reduce_spectrum(d, task_list, steps) for d in data])
+
+
 
 class SmartScan:
     """AsyncScanManager class.
@@ -258,7 +293,7 @@ class SmartScan:
         last_spectrum (np.ndarray): The last spectrum.
         logger (logging.Logger): A logger object.
         positions (list): A list of positions.
-        remote (SGM4Commands): An object to communicate with the SGM4.
+        remote (AsyncSGM4Commands): An object to communicate with the SGM4.
         settings (dict): A dictionary with the settings.
         task_labels (list): A list of task labels.
         values (list): A list of values.
@@ -309,24 +344,50 @@ class SmartScan:
         self.task_labels: list[str] = list(self.settings["tasks"].keys())
 
         # connect to SGM4
-        self.remote = sgm4commands.SGM4Commands(
+        self.remote = sgm4commands.AsyncSGM4Commands(
             self.settings["TCP"]["host"],
             self.settings["TCP"]["port"],
-            buffer_size=self.settings["TCP"]["buffer_size"],
+            checksum=self.settings["TCP"].get("checksum", False),
+            timeout=self.settings["TCP"]["timeout"],
+            data_format=self.settings["TCP"].get("data_format", "binary"),
+            pool_size=self.settings["TCP"].get("pool_size", 2),
+            compression=self.settings["TCP"].get("compression"),
+            compress_threshold=self.settings["TCP"].get("compress_threshold", 65536),
+            pipeline=self.settings["TCP"].get("pipeline", True),
         )
+        self._executor = self._make_executor()  # None reduces on the event loop
+        n_workers = (self.settings.get("core") or {}).get("n_threads", 0) or 0
+        self._in_flight = asyncio.Semaphore(2 * max(n_workers, 1))  # batches reducing
+        self._reductions: set[asyncio.Task] = set()
+        self._versions = {}  # per grid node, count of reductions of the merged spectrum
+        self._measure_n = True  # cleared if SGM4 does not know MEASURE_N
+        self._add_points_supported = True  # cleared if SGM4 does not know ADD_POINTS
 
         # init data containers
-        self._all_spectra_dict = {}  # dict of lists of spectra
-        self._mean_spectra_dict = {}  # dict of mean of spectra per position
-        self._task_dict = {}  # dict of tasks per position
-
-        self._all_positions: list = []  # list of positions as measured
-        self._all_spectra: list = []  # list of spectra as measured
-        self._all_tasks: list = []  # list of tasks as measured
+        # spectra are kept on disk, see _open_stores
+        self._spectra = None  # store.SpectrumStore of spectra as measured
+        self._stats = None  # store.PositionStats of the spectra per position
+        # dtype spectra are received, stored and reduced in
+        self._dtype = np.dtype(self.settings["scanning"].get("dtype", "float64"))
+        if self._dtype not in (np.float32, np.float64):
+            raise ValueError(f"scanning.dtype {self._dtype} is not float32 or float64.")
+        self._errors = {}  # dict of task errors per grid node
+        # positions, tasks and errors, per position or as measured, see TaskTable
+        self._table = None
+        # store.GridIndex of the positions in the table, whose nodes key all the stores
+        self._measured = None
 
         self.hyperparameter_history = {}  # dict of hyperparameters history
 
         self.last_spectrum = None  # last spectrum as measured
+        self._roi = None  # region of the spectra sent by SGM4, None for all of it
+        self._task_params = {}  # task params relative to the region, see _set_roi
+        # preprocessing steps the tasks need, params relative to the region
+        self._steps = preprocessing.build(
+            self.settings.get("preprocessing"),
+            [d.get("input", preprocessing.RAW) for d in self.settings["tasks"].values()],
+        )
+        self._server_tasks = False  # SGM4 sends task values instead of spectra, see _start
         self.last_asked_position = None  # last position provided by the GP
         self.task_weights = None  # will be set by get_taks_normalization_weights
 
@@ -365,8 +426,9 @@ class SmartScan:
     @property
     def n_spectra(self) -> int:
         """Get the number of spectra."""
-        each = [len(d) for d in self._all_spectra_dict.values()]
-        return sum(each)
+        if self._stats is None:
+            return 0
+        return sum(self._stats.counts.values())
 
     @property
     def n_tasks(self) -> int:
@@ -382,135 +444,290 @@ class SmartScan:
 
     @property
     def positions(self) -> np.ndarray:
-        """Get the positions."""
-        if self.settings["scanning"]["merge_unique_positions"]:
-            return np.array([np.array(p) for p in self._mean_spectra_dict.keys()])
-        else:
-            return np.array(self._all_positions, dtype=float)
+        """Get the positions, read-only.
+
+        Positions being reduced are not there yet. The array is a view of the data,
+        updated in place, copy it to keep its values.
+        """
+        if self._table is None:
+            return np.empty(0)
+        return self._table.positions
 
     @property
     def task_values(self) -> np.ndarray:
-        """Get the values."""
-        if self.settings["scanning"]["merge_unique_positions"]:
-            return np.array(list(self._task_dict.values()))
-        else:
-            return np.array(self._all_tasks, dtype=float)
+        """Get the values, read-only, see positions."""
+        if self._table is None:
+            return np.empty(0)
+        return self._table.values
 
     @property
     def errors(self) -> np.ndarray:
-        """Get the errors."""
+        """Get the errors.
+
+        With merge_unique_positions, the error of a position is base_error / sqrt(n) for
+        n spectra. With errors_from_variance, it is the standard error of the mean
+        spectrum relative to its mean, once a position has 2 spectra or more.
+        """
+        if self._table is None:
+            return np.empty(0)
         if self.settings["scanning"]["merge_unique_positions"]:
-            base_error = self.settings["scanning"]["base_error"]
-            return np.array(
-                [
-                    [base_error / np.sqrt(len(d))] * len(self.task_labels)
-                    for d in self._all_spectra_dict.values()
-                ],
-                dtype=float,
-            )
+            return self._table.errors
         else:
-            return np.ones((len(self.task_labels), len(self._all_spectra)), dtype=float)
+            return self._table.errors.T
+
+    def _error(self, p: Sequence[float]) -> float:
+        """error of the tasks at position p, see errors"""
+        count = self._stats.count(p)
+        base_error = self.settings["scanning"]["base_error"]
+        if not self.settings["scanning"].get("errors_from_variance", False):
+            return base_error / np.sqrt(count)
+        if count < 2:
+            return base_error
+        sem = np.sqrt(np.mean(self._stats.variance(p)) / count)
+        scale = np.mean(np.abs(self._stats.mean(p)))
+        return sem / scale if scale > 0 else base_error
+
+    def _open_stores(self, shape: tuple[int]) -> None:
+        """create the files keeping the spectra, once their shape is known
+
+        scanning.store_dir is the directory of the files, the system temporary directory
+        if not set, and scanning.store_window the number of spectra of each file kept
+        in RAM. Spectra and their means are stored as scanning.dtype, and looked up by
+        their grid node.
+        """
+        kwargs = dict(
+            key=self._measured.node,
+            dtype=self._dtype,
+            directory=self.settings["scanning"].get("store_dir"),
+            window=self.settings["scanning"].get("store_window", 32),
+        )
+        self._spectra = store.SpectrumStore(shape, **kwargs)
+        self._stats = store.PositionStats(shape, **kwargs)
+        self.logger.info(f"Keeping spectra of shape {shape} in {self._spectra.path}")
 
-    async def fetch_and_reduce_loop(self) -> None:  
-        """Fetch data from SGM4 and reduce it."""  
-        self.logger.info("Starting fetch data loop.")  
-        await asyncio.sleep(1)  # wait a bit before starting  
-        while not self._should_stop:  
-            if global_pause==True:  # 检查是否暂停  
-                await asyncio.sleep(1)  # 暂停时等待  
-                continue  
-        
-            self.logger.debug("Fetching data...")  
-            pos, data = await self._fetch_data()  
-            if data is not None:  
-                self.logger.info(f"Data received: {data.shape}")  
-                t0 = time.time()  
-                if self.settings["scanning"]["merge_unique_positions"]:  
-                    p = tuple(pos)  
-                    if p in self._all_spectra_dict.keys():  
-                        self._all_spectra_dict[p].append(data)  
-                        self._mean_spectra_dict[p] = np.mean(  
-                            np.array(self._all_spectra_dict[p]), axis=0  
-                        )  
-                        self.logger.debug(  
-                            f"Pos {pos} has {len(self._all_spectra_dict[p])} spectra."  
-                        )  
-                    else:  
-                        self._all_spectra_dict[p] = [data]  
-                        self._mean_spectra_dict[p] = data  
-                    self._task_dict[p] = self._reduce(pos, self._mean_spectra_dict[p])  
-                    self.logger.info(  
-                        f"Updated data: {p}: tasks {self._task_dict[p]} | {len(self._all_spectra_dict[p])} spectra | time: {time.time()-t0:.3f} s"  
-                    )  
-                else:  
-                    self._all_positions.append(pos)  
-                    self._all_spectra.append(data)  
-                    self._all_tasks.append(self._reduce(pos, data))  
-                self.last_spectrum = data  
-                self._has_new_data = True  
-            else:  
-                self.logger.debug("No data received.")  
+    async def fetch_and_reduce_loop(self) -> None:
+        """Fetch data from SGM4 and reduce it.
+
+        Spectra are received through a STREAM subscription if enabled in the settings,
+        falling back to polling with MEASURE if SGM4 does not support it.
+        """
+        self.logger.info("Starting fetch data loop.")
+        await asyncio.sleep(1)  # wait a bit before starting
+        if self.settings["TCP"].get("stream", True):
+            stream_task = asyncio.create_task(self._stream_and_reduce())
+            while not self._should_stop and not stream_task.done():
+                await asyncio.sleep(0.2)
+            if not stream_task.done():
+                stream_task.cancel()
+                with suppress(asyncio.CancelledError):
+                    await stream_task
+                return
+            try:
+                stream_task.result()
+                return
+            except (RuntimeError, OSError) as e:
+                self.logger.warning(f"STREAM unavailable, polling MEASURE: {e}")
+        while not self._should_stop:
+            if global_pause==True:  # 检查是否暂停
+                await asyncio.sleep(1)  # 暂停时等待
+                continue
+
+            self.logger.debug("Fetching data...")
+            positions, data = await self._fetch_data()
+            if data is not None:
+                await self._submit_batch(positions, data)
+            else:
+                self.logger.debug("No data received.")
                 await asyncio.sleep(0.2)
 
+    async def _stream_and_reduce(self) -> None:
+        """Reduce the spectra pushed by SGM4 as they arrive."""
+        async for pos, data in self.remote.STREAM():
+            while global_pause and not self._should_stop:
+                await asyncio.sleep(1)
+            # copy out of the stream receive buffer
+            data = np.array(data, dtype=self._dtype)
+            await self._submit_batch(pos[np.newaxis], data[np.newaxis])
+            # receiving does not suspend while data is pending, let the other loops run
+            await asyncio.sleep(0)
+
+    async def _submit_batch(self, positions: np.ndarray, data: np.ndarray) -> None:
+        """Ingest a batch of spectra in the background
+
+        Waits only while too many batches are being reduced, so that fetching keeps up
+        with the reduction pool.
+        """
+        await self._in_flight.acquire()
+        task = asyncio.create_task(self._ingest_batch(positions, data))
+        self._reductions.add(task)
+        task.add_done_callback(self._reduction_done)
+
+    def _reduction_done(self, task: asyncio.Task) -> None:
+        self._reductions.discard(task)
+        self._in_flight.release()
+        if not task.cancelled() and task.exception() is not None:
+            e = task.exception()
+            self.logger.error(f"{type(e).__name__} reducing data: {e}")
+
+    async def _ingest_batch(self, positions: np.ndarray, data: np.ndarray) -> None:
+        """Store a batch of spectra and reduce them together.
+
+        With merge_unique_positions, each position in the batch is reduced only once,
+        after all its new spectra were added to its running mean. The spectra themselves
+        are only kept with scanning.keep_repeats. A position appears in
+        positions and task_values once its reduction is done. If a position got new
+        spectra meanwhile, only the reduction of the latest mean is kept.
+
+        Args:
+            positions: positions, with shape (n, ndim)
+            data: spectra, with shape (n, *spectrum_shape)
+        """
+        self.logger.info(f"Data received: {len(data)} x {data.shape[1:]}")
+        t0 = time.time()
+        if self._measured is None:
+            self._measured = store.GridIndex(self.remote.axes)
+        if self._spectra is None:
+            self._open_stores(data.shape[1:])
+        if self._table is None:
+            self._table = store.TaskTable(
+                positions.shape[1], self.n_tasks, key=self._measured.node
+            )
+        if self.settings["scanning"]["merge_unique_positions"]:
+            keep_repeats = self.settings["scanning"].get("keep_repeats", False)
+            updated = {}  # grid node -> position
+            for pos, spectrum in zip(positions, data):
+                self._stats.add(pos, spectrum)
+                if keep_repeats:
+                    self._spectra.append(pos, spectrum)
+                updated[self._measured.node(pos)] = pos
+            for node, pos in updated.items():
+                self._versions[node] = self._versions.get(node, 0) + 1
+                self._errors[node] = self._error(pos)
+                self.logger.debug(f"Pos {pos} has {self._stats.count(pos)} spectra.")
+            versions = {node: self._versions[node] for node in updated}
+            reduced = await self._reduce_in_pool(
+                np.asarray(list(updated.values())),
+                [self._stats.mean(pos) for pos in updated.values()],
+            )
+            for (node, pos), tasks_p in zip(updated.items(), reduced):
+                if self._versions[node] != versions[node]:
+                    continue  # a newer mean is being reduced
+                self._table.update(pos, tasks_p, self._errors[node])
+                self._measured.add(pos)
+                self.logger.info(
+                    f"Updated data: {pos}: tasks {tasks_p} | "
+                    f"{self._stats.count(pos)} spectra"
+                )
+        else:
+            reduced = await self._reduce_in_pool(positions, data)
+            self._table.extend(positions, reduced, 1.0)
+            self._measured.update(positions)
+            self._spectra.extend(positions, data)
+        self.logger.info(f"Ingested {len(data)} spectra | time: {time.time()-t0:.3f} s")
+        self.last_spectrum = data[-1]
+        self._has_new_data = True
+
     # get data from SGM4
     async def _fetch_data(
         self,
-    ) -> tuple[str, None] | tuple[np.ndarray, np.ndarray] | None:
-        """Get data from SGM4.
+    ) -> tuple[str, None] | tuple[np.ndarray, np.ndarray]:
+        """Get the spectra waiting in the SGM4 output queue.
+
+        Up to TCP.batch_size spectra are fetched in one MEASURE_N round trip. If SGM4
+        does not know MEASURE_N, it falls back to one spectrum per MEASURE.
 
         Returns:
-            tuple[str, None] | tuple[np.ndarray, np.ndarray] | None:
-                - tuple[str, None] if there was an error
-                - tuple[np.ndarray, np.ndarray] if there was no error
-                - None if no data was received
+            tuple[str, None] | tuple[np.ndarray, np.ndarray]:
+                - tuple[str, None] if there was an error or no data
+                - tuple[np.ndarray, np.ndarray] with positions (n, ndim) and
+                    spectra (n, *spectrum_shape) otherwise
         """
         self.logger.debug("Fetching data...")
-        message: str = TCP.send_tcp_message(
-            host=self.settings["TCP"]["host"],
-            port=self.settings["TCP"]["port"],
-            msg="MEASURE",
-            buffer_size=self.settings["TCP"]["buffer_size"],
-            logger=self.logger,
-        )
-        msg: list[str] = message.strip("\r\n").split(" ")
-        msg_code: str = msg[0]
-        vals: list[str] = [v for v in msg[1:] if len(v) > 0]
-        self.logger.debug(f"MEASURE answer: {msg_code}: {len(message)/1024:,.1f} kB")
-        match msg_code:
-            case "ERROR":
-                self.logger.error(message)
-                return message, None
-            case "NO_DATA":
-                self.logger.debug(f"No data received: {message}")
-                return message, None
-            case "MEASURE":
+        spectrum_shape = self.remote.spectrum_shape  # before MEASURE reuses the buffer
+        batch_size = self.settings["TCP"].get("batch_size", 1)
+        try:
+            if batch_size > 1 and self._measure_n:
                 try:
-                    n_pos = int(vals[0])
-                    pos: np.ndarray = np.asarray(vals[1 : n_pos + 1], dtype=float)
-                    data: np.ndarray = np.asarray(vals[n_pos + 1 :], dtype=float)
-                    data = data.reshape(self.remote.spectrum_shape)
-                    return pos, data
-                except ValueError as e:
-                    self.logger.critical(
-                        f"Failed interpreting received data with shape {data.shape}: {e} "
-                    )
-            case _:
-                self.logger.warning(f"Unknown message code: {msg_code}")
-                return message, None
+                    message = await self.remote.send_command("MEASURE_N", batch_size)
+                except RuntimeError as e:
+                    if "MEASURE_N" not in str(e):
+                        raise
+                    self.logger.warning(f"MEASURE_N unavailable, using MEASURE: {e}")
+                    self._measure_n = False
+                    message = await self.remote.send_command("MEASURE")
+            else:
+                message = await self.remote.send_command("MEASURE")
+        except (RuntimeError, asyncio.TimeoutError, OSError) as e:
+            self.logger.error(f"{type(e).__name__} fetching data: {e}")
+            return str(e), None
+        self.logger.debug(f"MEASURE answer: {len(message)/1024:,.1f} kB")
+        try:
+            positions, data = self.remote.parse_measure_n(message, spectrum_shape)
+        except ValueError as e:
+            self.logger.critical(f"Failed interpreting received data: {e} ")
+            return str(e), None
+        if data is None:
+            if str(positions).startswith("ERROR"):
+                self.logger.error(positions)
+            else:
+                self.logger.debug(f"No data received: {positions}")
+            return positions, None
+        # copy out of the connection receive buffer
+        return positions, np.array(data, dtype=self._dtype)
+
+    def _task_list(self) -> list[tuple[str, dict | None, str]]:
+        """function name, params and input of each task, see _reduce_spectrum"""
+        return [
+            (
+                d["function"],
+                self._task_params.get(name, d.get("params", {})),
+                d.get("input", preprocessing.RAW),
+            )
+            for name, d in self.settings["tasks"].items()
+        ]
+
+    def _make_executor(self) -> Executor | None:
+        """pool reducing the spectra, from core.n_threads and core.executor
+
+        n_threads 0 reduces on the event loop. executor is "process" (default) or
+        "thread", the latter only helps with tasks releasing the GIL.
+        """
+        core = self.settings.get("core") or {}
+        n_workers = core.get("n_threads", 0) or 0
+        if n_workers < 1:
+            return None
+        kind = core.get("executor", "process")
+        self.logger.info(f"Reducing spectra in a {kind} pool of {n_workers} workers.")
+        if kind == "process":
+            return ProcessPoolExecutor(n_workers)
+        if kind == "thread":
+            return ThreadPoolExecutor(n_workers, thread_name_prefix="reduce")
+        raise ValueError(f"Unknown executor {kind}, expected process or thread.")
+
+    async def _reduce_in_pool(
+        self, positions: np.ndarray, data: np.ndarray
+    ) -> np.ndarray:
+        """reduce a batch of spectra in the executor, as a single job"""
+        if self._executor is None or self._server_tasks:
+            return self._reduce_batch(positions, data)
+        loop = asyncio.get_running_loop()
+        t0 = time.time()
+        reduced = await loop.run_in_executor(
+            self._executor, _reduce_batch_spectra, data, self._task_list(), self._steps
+        )
+        if reduced.shape[1] != len(self.task_labels):
+            raise RuntimeError(
+                f"Length mismatch between tasks {reduced.shape[1]}"
+                f"and task labels {len(self.task_labels)}."
+            )
+        self.logger.debug(f"Reduced {len(data)} spectra | time: {time.time()-t0:.3f} s")
+        return reduced
 
     def _reduce(self, pos: np.ndarray, data: np.ndarray) -> np.ndarray:
         """reduce a single spectrum to tasks"""
         self.logger.debug(f"Reducing data for pos {pos}...")
         t0 = time.time()
-        reduced = []
-        for _, d in self.settings["tasks"].items():
-            func = getattr(tasks, d["function"])
-            kwargs = d.get("params", {})
-            if kwargs is None:
-                reduced.append(func(data))
-            else:
-                reduced.append(func(data, **kwargs))
-        reduced = np.asarray(reduced, dtype=float).flatten()
+        reduced = _reduce_spectrum(data, self._task_list(), self._steps)
         if len(reduced) != len(self.task_labels):
             raise RuntimeError(
                 f"Length mismatch between tasks {len(reduced)}"
@@ -519,6 +736,12 @@ class SmartScan:
         self.logger.debug(f"Reduction {pos} | {reduced} | time: {time.time()-t0:.3f} s")
         return reduced
 
+    def _reduce_batch(self, positions: np.ndarray, data: np.ndarray) -> np.ndarray:
+        """reduce a batch of spectra to tasks, one row per spectrum"""
+        if self._server_tasks:
+            return np.asarray(data, dtype=float)  # SGM4 already reduced them
+        return np.stack([self._reduce(pos, d) for pos, d in zip(positions, data)])
+
     def get_taks_normalization_weights(self, update=False) -> np.ndarray:
         """Get the weights to normalize the tasks.
 
@@ -546,8 +769,9 @@ class SmartScan:
         """
         self.logger.debug("Telling GP about new data.")
         if self.gp is not None:
-            pos = np.asarray(self.positions)
-            vals = np.asarray(self.task_values)
+            # copies, the GP may keep them while the rows are updated in place
+            pos = np.array(self.positions)
+            vals = np.array(self.task_values)
             if self.settings["scanning"]["normalize_values"] == "always":
                 vals = vals * self.get_taks_normalization_weights(update=True)
             elif self.settings["scanning"]["normalize_values"] != "never":
@@ -555,7 +779,7 @@ class SmartScan:
                     update=update_normalization
                 )
             self.logger.info(f"TELL GP | pos: {pos[-1]} | tasks: {vals[-1]}")
-            self.gp.tell(pos, vals, variances=self.errors)
+            self.gp.tell(pos, vals, variances=np.array(self.errors))
             self._has_new_data = False
 
     # GP loop
@@ -624,10 +848,10 @@ class SmartScan:
         return False
 
     def was_already_measured(self, pos: np.ndarray) -> bool:
-        """check if the given position is in the positions list."""
-        if len(self.positions) == 0:
+        """check if the scan grid node of the given position is in the positions."""
+        if self._measured is None:
             return False
-        return np.any(np.all(np.isclose(self.positions, pos), axis=1))
+        return pos in self._measured
 
     def train_gp(self) -> None:
         """Train the GP."""
@@ -674,7 +898,7 @@ class SmartScan:
         }
         self.save_hyperparameters()
 
-    def ask_gp(self) -> None:
+    async def ask_gp(self) -> None:
         """Ask the GP for the next position."""
         acq_func_callable = getattr(
             gp.aquisition_functions,
@@ -692,6 +916,7 @@ class SmartScan:
                     "n_dim": self.n_dim,
                     "n_tasks": self.n_tasks,
                     "axes": self.remote.axes,
+                    "measured": self._measured,
                 }
             )
 
@@ -704,19 +929,46 @@ class SmartScan:
             acquisition_function=aqf,
             **ask_pars,
         )["x"]
+        rounded_points = []
         for point in next_pos:
             rounded_point = utils.closest_point_on_grid(point, axes=self.remote.axes)
             self.logger.info(
                 f"ASK GP          | Adding {rounded_point} to scan. rounded from {point}"
             )
-            if any([all(rounded_point == prev) for prev in self.positions]):
+            if self.was_already_measured(rounded_point):
                 self.logger.warning(
                     f"ASK GP          | Point {rounded_point} already evaluated!"
                 )
-            self.remote.ADD_POINT(*rounded_point)
-            self.last_asked_position = rounded_point
+            rounded_points.append(rounded_point)
+        self.last_asked_position = (await self._add_points(rounded_points))[-1]
         return True
 
+    async def _add_points(self, points: np.ndarray) -> np.ndarray:
+        """Add points to the scan queue, in a single ADD_POINTS round trip if possible.
+
+        Args:
+            points: positions to add, with shape (n, ndim)
+
+        Returns:
+            np.ndarray: the positions as queued by SGM4
+        """
+        points = np.asarray(points, dtype=float)
+        if len(points) > 1 and self._add_points_supported:
+            try:
+                accepted, queue_length = await self.remote.ADD_POINTS(points)
+                self.logger.debug(
+                    f"Added {len(accepted)} points to scan. Queue length: {queue_length}"
+                )
+                return accepted
+            except RuntimeError as e:
+                if "ADD_POINTS" not in str(e):
+                    raise
+                self.logger.warning(f"ADD_POINTS unavailable, using ADD_POINT: {e}")
+                self._add_points_supported = False
+        for point in points:
+            await self.remote.ADD_POINT(*point)
+        return points
+
     async def gp_loop(self) -> None:  
         """GP loop.  
 
@@ -774,7 +1026,7 @@ class SmartScan:
                     self.tell_gp()  
                     if self.should_train():  
                         self.train_gp()  
-                    success = self.ask_gp()  
+                    success = await self.ask_gp()  
                     if not success:  
                         break  
                     self._should_replot = True  
@@ -782,7 +1034,7 @@ class SmartScan:
                 self.logger.debug("No data to update.")  
                 await asyncio.sleep(0.2)  
 
-        self.remote.END()
+        await self.remote.END()
 
     # plotting loop
     async def plotting_loop(self) -> None:  
@@ -810,7 +1062,7 @@ class SmartScan:
                     pos=np.asarray(self.positions),  
                     val=np.asarray(self.task_values),  
                     old_aqf=aqf,  
-                    last_spectrum=self.last_spectrum,  
+                    last_spectrum=await self._plot_spectrum(),
                     settings=self.settings,  
                 )  
                 self.fig = fig  
@@ -869,7 +1121,7 @@ class SmartScan:
                     gp=self.gp,  
                     positions=np.asarray(self.positions),  
                     values=np.asarray(self.task_values),  
-                    last_spectrum=self.last_spectrum,  
+                    last_spectrum=await self._plot_spectrum(),
                 )  
             else:  
                 plt.pause(0.01)  
@@ -906,7 +1158,7 @@ class SmartScan:
 
     async def start(self) -> None:
         """Initialize scan and start all loops."""
-        self.init_scan()
+        await self.init_scan()
 
         self._ready_for_gp = False
         self._should_stop = False
@@ -914,8 +1166,8 @@ class SmartScan:
 
         await self.all_loops()
 
-    def connect(self) -> None:
-        self.remote.connect()
+    async def connect(self) -> None:
+        await self.remote.connect()
         if len(self.remote.axes[0]) == 0:
             raise ValueError("failed initializing axes!!")
         else:
@@ -923,29 +1175,151 @@ class SmartScan:
                 f"Axes: {[a.shape for a in self.remote.axes]} | Limits: {self.remote.limits} | Step size: {self.remote.step_size} "
             )
 
-    def init_scan(self) -> None:
+    def _reads_spectrum(self) -> list[dict | None]:
+        """params of the tasks and preprocessing steps reading the spectrum itself"""
+        params = [
+            d.get("params")
+            for d in self.settings["tasks"].values()
+            if d.get("input", preprocessing.RAW) == preprocessing.RAW
+        ]
+        params += [p for _, _, source, p in self._steps if source == preprocessing.RAW]
+        return params
+
+    def _roi_union(self) -> list[list[int]] | None:
+        """Bounding box of the regions of interest of all tasks
+
+        Tasks reading a preprocessing step look at the regions of the steps reading the
+        spectrum. Returns None if a task or a step looks at the whole spectrum.
+        """
+        union = None
+        for params in self._reads_spectrum():
+            params = params or {}
+            rois = [v for k, v in params.items() if k == "roi" or k.endswith("_roi")]
+            if len(rois) == 0 or any(roi is None for roi in rois):
+                return None
+            for roi in rois:
+                roi = np.asarray(roi, dtype=int)
+                if union is None:
+                    union = roi.copy()
+                else:
+                    union[:, 0] = np.minimum(union[:, 0], roi[:, 0])
+                    union[:, 1] = np.maximum(union[:, 1], roi[:, 1])
+        return None if union is None else union.tolist()
+
+    async def _set_roi(self) -> None:
+        """Ask SGM4 to send only the part of the spectra the tasks look at
+
+        The task regions of interest are shifted to the cropped spectra. The settings
+        keep the regions relative to the whole spectrum.
+        """
+        roi = self._roi_union() if self.settings["TCP"].get("roi_only", False) else None
+        if roi is None or self._server_tasks:
+            return
+        try:
+            roi = await self.remote.SET_ROI(
+                roi, self.settings["TCP"].get("preview_step")
+            )
+        except RuntimeError as e:
+            if "SET_ROI" not in str(e):
+                raise
+            self.logger.info(f"SET_ROI not supported, fetching whole spectra: {e}")
+            return
+        self._roi = roi
+        origin = np.array([lo for lo, _ in roi])
+
+        def shift(params: dict) -> dict:
+            params = dict(params)
+            for k, v in params.items():
+                if k == "roi" or k.endswith("_roi"):
+                    params[k] = (np.asarray(v, dtype=int) - origin[:, None]).tolist()
+            return params
+
+        self._task_params = {}
+        for name, d in self.settings["tasks"].items():
+            if d.get("input", preprocessing.RAW) == preprocessing.RAW:
+                self._task_params[name] = shift(d["params"])
+        self._steps = [
+            (name, function, source, shift(params or {}))
+            if source == preprocessing.RAW
+            else (name, function, source, params)
+            for name, function, source, params in self._steps
+        ]
+        self.logger.info(f"SGM4 sends the region {roi} of the spectra")
+
+    async def _plot_spectrum(self) -> np.ndarray | None:
+        """Spectrum to plot: a preview of the whole spectrum if SGM4 sends a region
+
+        If SGM4 sends task values, the preview is the only spectrum there is.
+        """
+        if self._roi is None and not self._server_tasks:
+            return self.last_spectrum
+        try:
+            return await self.remote.PREVIEW()
+        except RuntimeError as e:
+            self.logger.debug(f"PREVIEW failed: {e}")
+            return None if self._server_tasks else self.last_spectrum
+
+    async def _start(self) -> None:
+        """START the scan, asking SGM4 to reduce the spectra to the tasks if enabled
+
+        Falls back to fetching spectra if SGM4 cannot reduce them.
+        """
+        if not self.settings["TCP"].get("server_tasks", False):
+            await self.remote.START()
+            return
+        if len(self._steps) > 0:
+            self.logger.info("SGM4 does not run the preprocessing, fetching spectra.")
+            await self.remote.START()
+            return
+        try:
+            await self.remote.START(self.settings["tasks"])
+        except RuntimeError as e:
+            self.logger.warning(f"SGM4 cannot reduce the spectra, fetching them: {e}")
+            await self.remote.START()
+        self._server_tasks = self.remote.server_tasks is not None
+        if self._server_tasks and self.remote.server_tasks != self.task_labels:
+            raise RuntimeError(
+                f"SGM4 reduces to tasks {self.remote.server_tasks}, "
+                f"expected {self.task_labels}"
+            )
+        if self._server_tasks:
+            self.logger.info(f"SGM4 reduces the spectra to {self.task_labels}")
+
+    async def _wait_ready(self, timeout: float) -> str:
+        """Wait until SGM4 is ready to scan, polling STATUS if it does not know WAIT_READY
+
+        Raises:
+            TimeoutError: if SGM4 is not ready after timeout seconds
+        """
+        try:
+            return await self.remote.WAIT_READY(timeout)
+        except RuntimeError as e:
+            if "WAIT_READY" not in str(e):
+                raise
+            self.logger.info(f"WAIT_READY not supported, polling STATUS: {e}")
+        deadline = time.monotonic() + timeout
+        while (status := await self.remote.STATUS()).upper() != "READY":
+            if time.monotonic() >= deadline:
+                raise TimeoutError(f"Scan not ready after {timeout} s. Status: {status}")
+            await asyncio.sleep(0.1)
+        return status
+
+    async def init_scan(self) -> None:
         """Initialize the scan."""
         self.logger.info("Initializing scan.")
         # TODO: add this to settings and give more options
+        ready_timeout = self.settings["TCP"].get("ready_timeout", 60)
         try:
-            self.remote.START()
+            await self._start()
         except AssertionError as e:
             self.logger.error(f"Assertion error when STARTing the scan: {e}")
-            self.remote.END()
-            time.sleep(10)
-            self.remote.START()
-        while True:
-            try:
-                s = self.remote.STATUS()
-                break
-            except Exception as e:
-                self.logger.error(f"Error setting up scan: {e}")
-                self.logger.info("Trying again in 1 second...")
-                time.sleep(1)
-        self.logger.info(f"Scan initialized. Status: {s}")
-        if status := self.remote.STATUS() != "READY":
-            raise RuntimeError(f"Scan not ready. Status: {status}")
-        self.connect()
+            await self.remote.END()
+            await self._wait_ready(ready_timeout)
+            await self._start()
+        status = await self._wait_ready(ready_timeout)
+        self.logger.info(f"Scan initialized. Status: {status}")
+        await self.connect()
+        await self._set_roi()
         self.save_log_to_file()
         self.save_settings()
 
@@ -953,6 +1327,7 @@ class SmartScan:
             self.logger.info(
                 f"Adding {len(self.relative_initial_points)} points to scan."
             )
+            initial_points = []
             for pos in self.relative_initial_points:
                 if len(pos) != self.n_dim:
                     raise ValueError(
@@ -964,10 +1339,13 @@ class SmartScan:
                         pos[i] * self.remote.limits[i][1]
                         + (1 - pos[i]) * self.remote.limits[i][0]
                     )
+                initial_points.append(pos)
 
-                self.remote.ADD_POINT(*pos)
-                self.last_asked_position = pos
-                self.logger.debug(f"Added point {pos} to scan.")
+            added = await self._add_points(initial_points)
+            for pos, queued in zip(self.relative_initial_points, added):
+                pos[:] = queued  # SGM4 may have snapped the points to its grid
+            self.last_asked_position = added[-1]
+            self.logger.debug(f"Added points {added.tolist()} to scan.")
 
     def pause(self) -> None:  
         """暂停扫描"""  
@@ -994,6 +1372,8 @@ class SmartScan:
     def kill(self) -> None:
         self.logger.info("Killing all loops.")
         self._should_stop = True
+        for task in list(self._reductions):
+            task.cancel()
 
     def finalize(self) -> None:
         self.logger.info("Finalizing scan.")
@@ -1001,6 +1381,12 @@ class SmartScan:
         self.save_figure()
         self.logger.info("Saving hyperparameters...")
         self.save_hyperparameters()
+        if self._executor is not None:
+            self._executor.shutdown(wait=False, cancel_futures=True)
+        for spectra in (self._spectra, self._stats):
+            if spectra is not None:
+                spectra.close()
+        self.remote.disconnect()
         self.logger.info("Scan finalized.")
 
     def save_figure(self) -> None:
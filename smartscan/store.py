@@ -0,0 +1,428 @@
+import logging
+import os
+import tempfile
+from collections import OrderedDict
+from pathlib import Path
+from typing import Callable, Hashable, Sequence
+
+import numpy as np
+
+
+class SpectrumStore:
+    """Append-only store of spectra in a memory-mapped file
+
+    Spectra are written to rows of a file mapped with `np.memmap`, which grows by chunk
+    rows when full. Only the window most recently used spectra are kept in RAM, the
+    others are read back from the file when asked for, so that memory does not grow
+    with the number of spectra. Rows are looked up by the key of the position they
+    were measured at, e.g. `GridIndex.node`, so that positions on the same grid node
+    share their rows.
+
+    Spectra are returned read-only. Overwriting a row replaces the spectrum rather than
+    changing it in place, so a spectrum returned earlier keeps its values.
+
+    Args:
+        shape: shape of one spectrum
+        dtype: dtype the spectra are stored with
+        path: file to store the spectra in, overwritten if it exists.
+            None stores them in a temporary file, deleted by `close`.
+        directory: directory of the temporary file, None for the system default
+        window: number of spectra kept in RAM
+        chunk: number of rows the file grows by
+        key: key of a position, its coordinates by default
+    """
+
+    def __init__(
+        self,
+        shape: Sequence[int],
+        dtype: np.dtype | type = float,
+        path: str | Path | None = None,
+        directory: str | Path | None = None,
+        window: int = 32,
+        chunk: int = 256,
+        key: Callable[[Sequence[float]], Hashable] = tuple,
+    ) -> None:
+        self.logger = logging.getLogger(f"{__name__}.SpectrumStore")
+        self.shape = tuple(int(n) for n in shape)
+        self.dtype = np.dtype(dtype)
+        self.window = window
+        self.chunk = chunk
+        self.key = key
+        self._temporary = path is None
+        if path is None:
+            fd, path = tempfile.mkstemp(suffix=".spectra", dir=directory)
+            os.close(fd)
+        self.path = Path(path)
+        self._file = open(self.path, "w+b")
+        self._map = None  # np.memmap of the file, None while empty
+        self._capacity = 0  # rows in the file
+        self._positions = []  # position of each row
+        self._rows = {}  # rows of each position key
+        self._cache = OrderedDict()  # row -> spectrum, least recently used first
+
+    def __len__(self) -> int:
+        return len(self._positions)
+
+    def __contains__(self, pos: Sequence[float]) -> bool:
+        return self.key(pos) in self._rows
+
+    @property
+    def positions(self) -> np.ndarray:
+        """positions of the rows, with shape (n, ndim)"""
+        return np.array(self._positions, dtype=float)
+
+    def rows(self, pos: Sequence[float]) -> list[int]:
+        """rows of the spectra measured at pos, oldest first"""
+        return self._rows.get(self.key(pos), [])
+
+    def at(self, pos: Sequence[float]) -> np.ndarray:
+        """spectra measured at pos, with shape (n, *shape)"""
+        return self[self.rows(pos)]
+
+    def append(self, pos: Sequence[float], spectrum: np.ndarray) -> int:
+        """store a spectrum measured at pos, and return its row"""
+        row = len(self._positions)
+        if row == self._capacity:
+            self._grow(row + 1)
+        self._positions.append(tuple(pos))
+        self._rows.setdefault(self.key(pos), []).append(row)
+        self[row] = spectrum
+        return row
+
+    def extend(self, positions: np.ndarray, spectra: np.ndarray) -> list[int]:
+        """store a batch of spectra, and return their rows"""
+        if len(self._positions) + len(spectra) > self._capacity:
+            self._grow(len(self._positions) + len(spectra))
+        return [self.append(pos, spectrum) for pos, spectrum in zip(positions, spectra)]
+
+    def __getitem__(self, index: int | Sequence[int] | slice) -> np.ndarray:
+        if isinstance(index, slice):
+            index = range(*index.indices(len(self)))
+        if not np.isscalar(index):
+            if len(index) == 0:
+                return np.empty((0, *self.shape), dtype=self.dtype)
+            return np.stack([self[i] for i in index])
+        row = self._check_row(index)
+        if row in self._cache:
+            self._cache.move_to_end(row)
+            return self._cache[row]
+        spectrum = np.array(self._map[row])
+        self._remember(row, spectrum)
+        return spectrum
+
+    def __setitem__(self, index: int, spectrum: np.ndarray) -> None:
+        row = self._check_row(index)
+        spectrum = np.array(spectrum, dtype=self.dtype)  # own copy, see __getitem__
+        if spectrum.shape != self.shape:
+            raise ValueError(f"Expected shape {self.shape}, got {spectrum.shape}")
+        self._map[row] = spectrum
+        self._remember(row, spectrum)
+
+    def _check_row(self, index: int) -> int:
+        row = int(index)
+        if row < 0:
+            row += len(self)
+        if not 0 <= row < len(self):
+            raise IndexError(f"Row {index} out of range for {len(self)} spectra")
+        return row
+
+    def _remember(self, row: int, spectrum: np.ndarray) -> None:
+        spectrum.flags.writeable = False
+        self._cache[row] = spectrum
+        self._cache.move_to_end(row)
+        while len(self._cache) > self.window:
+            self._cache.popitem(last=False)
+
+    def _grow(self, rows: int) -> None:
+        """resize the file to hold at least rows spectra"""
+        capacity = max(rows, self._capacity + self.chunk)
+        row_bytes = self.dtype.itemsize * int(np.prod(self.shape))
+        if self._map is not None:
+            self._map.flush()
+            self._map = None  # unmap before resizing
+        self._file.truncate(capacity * row_bytes)
+        self._map = np.memmap(
+            self._file, dtype=self.dtype, mode="r+", shape=(capacity, *self.shape)
+        )
+        self._capacity = capacity
+        self.logger.debug(f"Spectrum store {self.path} grew to {capacity} rows")
+
+    def flush(self) -> None:
+        """write the spectra to disk"""
+        if self._map is not None:
+            self._map.flush()
+
+    def close(self) -> None:
+        """close the file, deleting it if temporary"""
+        self._cache.clear()
+        self._map = None
+        if not self._file.closed:
+            self._file.close()
+            if self._temporary:
+                self.path.unlink(missing_ok=True)
+
+    def __del__(self) -> None:
+        try:
+            self.close()
+        except Exception:
+            pass
+
+
+class PositionStats:
+    """Running mean and variance of the spectra measured at each position
+
+    Uses Welford's algorithm: each `add` takes O(1) work, without keeping the spectra.
+    The means and the sums of squared differences from them are rows of two
+    `SpectrumStore`, one row per position key, so only the window of recently updated
+    positions is in RAM.
+
+    Args:
+        shape: shape of one spectrum
+        dtype: dtype the statistics are stored with
+        directory: directory of the temporary files, None for the system default
+        window: number of positions kept in RAM
+        key: key of a position, its coordinates by default. Spectra of positions
+            with the same key are averaged together.
+    """
+
+    def __init__(
+        self,
+        shape: Sequence[int],
+        dtype: np.dtype | type = float,
+        directory: str | Path | None = None,
+        window: int = 32,
+        key: Callable[[Sequence[float]], Hashable] = tuple,
+    ) -> None:
+        self._means = SpectrumStore(shape, dtype, directory=directory, window=window)
+        self._m2 = SpectrumStore(shape, dtype, directory=directory, window=window)
+        self.key = key
+        self.counts = {}  # number of spectra added per position key
+        self._rows = {}  # row of the statistics of each position key
+
+    def __len__(self) -> int:
+        return len(self.counts)
+
+    def __contains__(self, pos: Sequence[float]) -> bool:
+        return self.key(pos) in self.counts
+
+    def add(self, pos: Sequence[float], spectrum: np.ndarray) -> None:
+        """add a spectrum measured at pos to the statistics"""
+        k = self.key(pos)
+        if k not in self.counts:
+            self.counts[k] = 1
+            self._rows[k] = self._means.append(pos, spectrum)
+            self._m2.append(pos, np.zeros(self._m2.shape))
+            return
+        self.counts[k] += 1
+        row = self._rows[k]
+        mean = self._means[row]
+        delta = spectrum - mean
+        mean = mean + delta / self.counts[k]
+        self._means[row] = mean
+        self._m2[row] = self._m2[row] + delta * (spectrum - mean)
+
+    def count(self, pos: Sequence[float]) -> int:
+        """number of spectra measured at pos"""
+        return self.counts.get(self.key(pos), 0)
+
+    def mean(self, pos: Sequence[float]) -> np.ndarray:
+        """mean of the spectra measured at pos, read-only"""
+        return self._means[self._rows[self.key(pos)]]
+
+    def variance(self, pos: Sequence[float]) -> np.ndarray:
+        """sample variance of the spectra measured at pos, 0 with less than 2 spectra"""
+        k = self.key(pos)
+        row = self._rows[k]
+        if self.counts[k] < 2:
+            return np.zeros_like(self._m2[row])
+        return self._m2[row] / (self.counts[k] - 1)
+
+    def close(self) -> None:
+        """delete the files of the statistics"""
+        self._means.close()
+        self._m2.close()
+
+
+class GrowableArray:
+    """Array of rows that grows in place, doubling its capacity when full
+
+    Appending is amortized O(1) per row. `view` returns the filled rows without
+    copying them, read-only. Views see later changes of their rows, copy them to keep
+    the values they had.
+
+    Args:
+        shape: shape of one row
+        dtype: dtype of the array
+        capacity: number of rows allocated at first
+    """
+
+    def __init__(
+        self, shape: Sequence[int] = (), dtype: np.dtype | type = float, capacity: int = 64
+    ) -> None:
+        self._data = np.empty((max(capacity, 1), *shape), dtype=dtype)
+        self._size = 0
+
+    def __len__(self) -> int:
+        return self._size
+
+    def append(self, row: np.ndarray) -> int:
+        """add a row at the end, and return its index"""
+        if self._size == len(self._data):
+            self._reserve(self._size + 1)
+        self._data[self._size] = row
+        self._size += 1
+        return self._size - 1
+
+    def extend(self, rows: np.ndarray) -> None:
+        """add rows at the end"""
+        rows = np.asarray(rows, dtype=self._data.dtype)
+        if self._size + len(rows) > len(self._data):
+            self._reserve(self._size + len(rows))
+        self._data[self._size : self._size + len(rows)] = rows
+        self._size += len(rows)
+
+    def __setitem__(self, index: int, row: np.ndarray) -> None:
+        if not -self._size <= index < self._size:
+            raise IndexError(f"Row {index} out of range for {self._size} rows")
+        self._data[index % self._size] = row
+
+    def view(self) -> np.ndarray:
+        """the filled rows, read-only"""
+        view = self._data[: self._size]
+        view.flags.writeable = False
+        return view
+
+    def _reserve(self, rows: int) -> None:
+        """reallocate to hold at least rows rows"""
+        capacity = max(rows, 2 * len(self._data))
+        data = np.empty((capacity, *self._data.shape[1:]), dtype=self._data.dtype)
+        data[: self._size] = self._data[: self._size]
+        self._data = data
+
+
+class TaskTable:
+    """Positions, task values and errors of the reduced spectra, one row each
+
+    Kept as three `GrowableArray` columns, so reading them does not copy anything. Rows
+    are looked up by the key of their position, for updating the tasks of a position
+    in place.
+
+    Args:
+        n_dim: number of axes of a position
+        n_tasks: number of tasks
+        key: key of a position, its coordinates by default
+    """
+
+    def __init__(
+        self,
+        n_dim: int,
+        n_tasks: int,
+        key: Callable[[Sequence[float]], Hashable] = tuple,
+    ) -> None:
+        self._positions = GrowableArray((n_dim,))
+        self._values = GrowableArray((n_tasks,))
+        self._errors = GrowableArray((n_tasks,))
+        self.key = key
+        self._rows = {}  # row of each position key, the last one if repeated
+
+    def __len__(self) -> int:
+        return len(self._positions)
+
+    def __contains__(self, pos: Sequence[float]) -> bool:
+        return self.key(pos) in self._rows
+
+    @property
+    def positions(self) -> np.ndarray:
+        """positions, with shape (n, n_dim), read-only"""
+        return self._positions.view()
+
+    @property
+    def values(self) -> np.ndarray:
+        """task values, with shape (n, n_tasks), read-only"""
+        return self._values.view()
+
+    @property
+    def errors(self) -> np.ndarray:
+        """task errors, with shape (n, n_tasks), read-only"""
+        return self._errors.view()
+
+    def append(
+        self, pos: Sequence[float], values: np.ndarray, errors: np.ndarray | float
+    ) -> int:
+        """add a row, and return its index"""
+        self._positions.append(pos)
+        self._values.append(values)
+        row = self._errors.append(errors)
+        self._rows[self.key(pos)] = row
+        return row
+
+    def extend(
+        self, positions: np.ndarray, values: np.ndarray, errors: np.ndarray | float
+    ) -> None:
+        """add a row per position"""
+        first = len(self)
+        self._positions.extend(positions)
+        self._values.extend(values)
+        self._errors.extend(np.broadcast_to(errors, np.shape(values)))
+        for row, pos in enumerate(positions, start=first):
+            self._rows[self.key(pos)] = row
+
+    def update(
+        self, pos: Sequence[float], values: np.ndarray, errors: np.ndarray | float
+    ) -> int:
+        """overwrite the row of pos, adding it if pos is new, and return its index"""
+        row = self._rows.get(self.key(pos))
+        if row is None:
+            return self.append(pos, values, errors)
+        self._values[row] = values
+        self._errors[row] = errors
+        return row
+
+
+class GridIndex:
+    """Set of the grid nodes measured, for constant time already-measured checks
+
+    Positions are keyed by the integer indices of the nearest node of the grid spanned
+    by axes, so that lookups hash integers rather than floats. Positions closer than
+    half a step along each axis fall on the same node. Positions beyond the axes are
+    indexed as well, the grid extending past them with the same step.
+
+    Args:
+        axes: grid axes, evenly spaced
+    """
+
+    def __init__(self, axes: Sequence[Sequence[float]]) -> None:
+        self.origin = np.array([ax[0] for ax in axes], dtype=float)
+        self.step = np.array(
+            [ax[1] - ax[0] if len(ax) > 1 else 1.0 for ax in axes], dtype=float
+        )
+        self._nodes = set()
+
+    def __len__(self) -> int:
+        return len(self._nodes)
+
+    def __contains__(self, pos: Sequence[float]) -> bool:
+        return self.node(pos) in self._nodes
+
+    def node(self, pos: Sequence[float]) -> tuple[int, ...]:
+        """indices of the grid node nearest to pos"""
+        return tuple(self._nodes_of(np.asarray(pos, dtype=float)[np.newaxis])[0])
+
+    def _nodes_of(self, positions: np.ndarray) -> list[list[int]]:
+        return np.rint((positions - self.origin) / self.step).astype(int).tolist()
+
+    def add(self, pos: Sequence[float]) -> None:
+        """mark the node of pos as measured"""
+        self._nodes.add(self.node(pos))
+
+    def update(self, positions: np.ndarray) -> None:
+        """mark the nodes of positions, with shape (n, ndim), as measured"""
+        positions = np.asarray(positions, dtype=float).reshape(-1, len(self.origin))
+        self._nodes.update(map(tuple, self._nodes_of(positions)))
+
+    def contains(self, positions: np.ndarray) -> np.ndarray:
+        """whether the node of each of positions, with shape (n, ndim), was measured"""
+        positions = np.asarray(positions, dtype=float).reshape(-1, len(self.origin))
+        return np.array(
+            [tuple(n) in self._nodes for n in self._nodes_of(positions)], dtype=bool
+        )
@@ -1,73 +1,115 @@
 from typing import Callable, Sequence
 
 import numpy as np
-from astropy.convolution import Box2DKernel, convolve
-from scipy.ndimage import gaussian_filter, laplace, sobel
+from scipy.ndimage import correlate1d
 from scipy.stats import entropy
 
+from . import filters
+
+# Each task takes a spectrum (H, W), or a stack of spectra (N, H, W) and then returns
+# one value per spectrum, filtering along the last two axes only.
+
+FRAME_AXES = (-2, -1)
+
+
+def _crop(x: np.ndarray, roi: Sequence[Sequence[int]] | None) -> np.ndarray:
+    """crop the last two axes of x to roi"""
+    x = np.asarray(x)
+    if roi is None:
+        return x
+    roi = np.array(roi)
+    return x[..., roi[0, 0] : roi[0, 1], roi[1, 0] : roi[1, 1]]
+
+
+def _reduce(x: np.ndarray, reduction: Callable) -> float | np.ndarray:
+    """reduce each frame of x"""
+    if x.ndim == 2:
+        return reduction(x)
+    return reduction(x, axis=FRAME_AXES)
+
+
+def _laplace(x: np.ndarray) -> np.ndarray:
+    """laplacian along the last two axes, as scipy.ndimage.laplace of a frame"""
+    return correlate1d(x, [1, -2, 1], axis=-2, mode="reflect") + correlate1d(
+        x, [1, -2, 1], axis=-1, mode="reflect"
+    )
+
+
+def _sobel(x: np.ndarray) -> np.ndarray:
+    """sobel along the last axis, as scipy.ndimage.sobel of a frame"""
+    return correlate1d(
+        correlate1d(x, [-1, 0, 1], axis=-1, mode="reflect"),
+        [1, 2, 1],
+        axis=-2,
+        mode="reflect",
+    )
+
 
 def mean(x: np.ndarray, roi: Sequence[Sequence[int]] = None) -> float:
     """Compute the mean of an array
 
     Args:
-        x (np.ndarray): input array
+        x (np.ndarray): input array, (H, W) or a stack (N, H, W)
         roi (Sequence[Sequence[int]], optional): region of interest. Defaults to None.
 
     Returns:
-        float: mean of the array
+        float: mean of the array, per spectrum of a stack
     """
-    if roi is not None:
-        roi = np.array(roi)
-        x = x[roi[0, 0] : roi[0, 1], roi[1, 0] : roi[1, 1]]
-    return np.mean(x)
+    x = _crop(x, roi)
+    return _reduce(x, np.mean)
 
 
 def std(x: np.ndarray, roi: Sequence[Sequence[int]] = None) -> float:
     """Compute the standard deviation of an array
 
     Args:
-        x (np.ndarray): input array
+        x (np.ndarray): input array, (H, W) or a stack (N, H, W)
         roi (Sequence[Sequence[int]], optional): region of interest. Defaults to None.
 
     Returns:
-        float: standard deviation of the array
+        float: standard deviation of the array, per spectrum of a stack
     """
-    if roi is not None:
-        roi = np.array(roi)
-        x = x[roi[0, 0] : roi[0, 1], roi[1, 0] : roi[1, 1]]
-    return np.std(x)
+    x = _crop(x, roi)
+    return _reduce(x, np.std)
 
 
 def laplace_filter(
     x: np.ndarray,
-    sigma: float = 10,
+    sigma: float | Sequence[float] = 10,
     norm: bool = True,
     reduction: Callable = np.mean,
     roi: Sequence[Sequence[int]] = None,
+    truncate: float = 4.0,
+    dtype: str | None = None,
 ) -> float:
     """Compute the mean absolute value of the laplacian of an image
 
     Args:
-        x (np.ndarray): input array
-        sigma (float, optional): sigma of the gaussian filter. Defaults to 10.
+        x (np.ndarray): input array, (H, W) or a stack (N, H, W)
+        sigma (float | Sequence[float], optional): sigma of the gaussian filter, for
+            both axes or one per axis, 0 for an input already smoothed. Defaults to 10.
         norm (bool, optional): normalize the output. Defaults to False.
         reduction (Callable, optional): reduction function. Defaults to np.mean.
         roi (Sequence[Sequence[int]], optional): region of interest. Defaults to None.
+        truncate (float, optional): cut the gaussian at this many sigmas. Defaults to 4.
+        dtype (str, optional): float dtype to filter in. Defaults to None, the dtype of
+            x if float32 or float64, float64 otherwise.
 
     Returns:
         float: absolute value of the laplacian reduced by reduction function (default: mean)
             if reduction is None, returns the laplacian array (2D, not absolute value)
+            per spectrum of a stack
     """
-    if roi is not None:
-        roi = np.array(roi)
-        x = x[roi[0, 0] : roi[0, 1], roi[1, 0] : roi[1, 1]]
-    filt = gaussian_filter(x.astype(np.float64), sigma=sigma)
+    x = _crop(x, roi)
+    filt = x.astype(filters.float_dtype(x) if dtype is None else dtype)
+    if np.any(sigma):
+        filt = filters.gaussian(filt, sigma, truncate)
     if norm:
-        filt /= np.mean(filt)
+        filt /= np.mean(filt, axis=FRAME_AXES, keepdims=True)
     if reduction is not None:
-        return reduction(np.abs(laplace(filt)))
+        return _reduce(np.abs(_laplace(filt)), reduction)
     else:
-        return laplace(filt)
+        return _laplace(filt)
 
 
 def contrast_noise_ratio(
@@ -78,22 +120,20 @@ def contrast_noise_ratio(
     """Compute the contrast to noise ratio of an image
 
     Args:
-        x (np.ndarray): input array
+        x (np.ndarray): input array, (H, W) or a stack (N, H, W)
         sig_roi (Sequence[Sequence[int]]): signal region of interest
         bg_roi (Sequence[Sequence[int]]): background region of interest
 
     Returns:
-        float: contrast to noise ratio
+        float: contrast to noise ratio, per spectrum of a stack
     """
-    signal_roi = np.array(signal_roi)
-    bg_roi = np.array(bg_roi)
     x = np.array(x).squeeze()
-    assert x.ndim == 2, "x must be 2D"
-    signal = x[signal_roi[0, 0] : signal_roi[0, 1], signal_roi[1, 0] : signal_roi[1, 1]]
-    background = x[bg_roi[0, 0] : bg_roi[0, 1], bg_roi[1, 0] : bg_roi[1, 1]]
-    mu_signal = np.mean(signal)
-    mu_background = np.mean(background)
-    sigma_noise = np.std(background)
+    assert x.ndim in (2, 3), "x must be 2D or a stack of 2D"
+    signal = _crop(x, signal_roi)
+    background = _crop(x, bg_roi)
+    mu_signal = _reduce(signal, np.mean)
+    mu_background = _reduce(background, np.mean)
+    sigma_noise = _reduce(background, np.std)
     # Calculate CNR
     return np.abs(mu_signal - mu_background) / sigma_noise
 
@@ -105,17 +145,15 @@ def edge_density(
     """Calculates the edge density of an image
 
     Args:
-        x (np.ndarray): input array
+        x (np.ndarray): input array, (H, W) or a stack (N, H, W)
         roi (Sequence[Sequence[int]], optional): region of interest. Defaults to None.
 
     Returns:
-        float: edge density of the image
+        float: edge density of the image, per spectrum of a stack
     """
-    if roi is not None:
-        roi = np.array(roi)
-        x = x[roi[0, 0] : roi[0, 1], roi[1, 0] : roi[1, 1]]
-    edges = sobel(x)
-    return np.sum(edges) / edges.size
+    x = _crop(x, roi)
+    edges = _sobel(x)
+    return _reduce(edges, np.sum) / (edges.shape[-2] * edges.shape[-1])
 
 
 def image_entropy(
@@ -125,18 +163,23 @@ def image_entropy(
     """Calculates the (negative) entropy of an image
 
     Args:
-        x (np.ndarray): input array
+        x (np.ndarray): input array, (H, W) or a stack (N, H, W)
         roi (Sequence[Sequence[int]], optional): region of interest. Defaults to None.
 
     Returns:
-        float: negative entropy of the image
+        float: negative entropy of the image, per spectrum of a stack
     """
-    if roi is not None:
-        roi = np.array(roi)
-        x = x[roi[0, 0] : roi[0, 1], roi[1, 0] : roi[1, 1]]
-    hist, _ = np.histogram(x, bins=256, range=(0, 256))
-    hist = hist / hist.sum()
-    return entropy(hist)
+    x = _crop(x, roi)
+    # histogram of each frame in one bincount, as np.histogram(bins=256, range=(0, 256))
+    frames = x.reshape(-1, x.shape[-2] * x.shape[-1])
+    valid = (frames >= 0) & (frames <= 256)
+    bins = np.minimum(np.floor(np.where(valid, frames, 0)), 255).astype(int)
+    bins += 256 * np.arange(len(frames))[:, np.newaxis]
+    hist = np.bincount(bins[valid], minlength=256 * len(frames)).reshape(-1, 256)
+    hist = hist / hist.sum(axis=1, keepdims=True)
+    if x.ndim == 2:
+        return entropy(hist[0])
+    return entropy(hist, axis=1)
 
 
 def curvature(
@@ -147,6 +190,7 @@ def curvature(
     w: float = 1,
     roi: Sequence[Sequence[int]] = None,
     reduction: Callable = np.mean,
+    dtype: str | None = None,
 ) -> float:
     """Calculates the curvature of an array using a 2D gaussian kernel
 
@@ -156,46 +200,54 @@ def curvature(
     dispersive features in image plots. Rev. Sci. Instrum. 1 April 2011; 82 (4): 043712.
     https://doi.org/10.1063/1.3585113
 
-    For the convolution function and kernel see:
+    The smoothing is the same as astropy convolve with a Box2DKernel and
+    boundary="extend", run as a separable box filter, see `filters.box`:
      - https://docs.astropy.org/en/latest/api/astropy.convolution.Box2DKernel.html
      - https://docs.astropy.org/en/latest/api/astropy.convolution.convolve.html
 
     Args:
-        x (np.ndarray): input array
-        bw (float, optional): bandwidth of the smoothing kernel. Defaults to 5.
+        x (np.ndarray): input array, (H, W) or a stack (N, H, W)
+        bw (float, optional): bandwidth of the smoothing kernel, 0 for an input already
+            smoothed. Defaults to 5.
         c1 (float, optional): curvature parameter. Defaults to 0.001.
         c2 (float, optional): curvature parameter. Defaults to 0.001.
         w (float, optional): aspect ratio. Defaults to 1.
         roi (Sequence[Sequence[int]], optional): region of interest. Defaults to None.
         reduction (Callable, optional): reduction function. Defaults to np.mean.
+        dtype (str, optional): float dtype to filter in. Defaults to None, the dtype of
+            x if float32 or float64, float64 otherwise.
 
     Returns:
         cv2d(np.array): absolute value of the curvature reduced by reduction function (default: mean)
             if reduction is None, returns the curvature array (2D)
+            per spectrum of a stack
     """
 
-    if roi is not None:
-        roi = np.array(roi)
-        arpesmap = arpesmap[roi[0, 0] : roi[0, 1], roi[1, 0] : roi[1, 1]]
-
-    x = np.arange(arpesmap.shape[0])
-    y = np.arange(arpesmap.shape[1])
-
-    data_smth = convolve(arpesmap, Box2DKernel(bw), boundary="extend")
-
-    dx = np.gradient(data_smth, axis=0)
-    dy = np.gradient(data_smth, axis=1) * w
-    d2x = np.gradient(np.gradient(data_smth, x, axis=0), x, axis=0)
-    d2y = np.gradient(np.gradient(data_smth, y, axis=1), y, axis=1) * w * w
-    dxdy = np.gradient(np.gradient(data_smth, y, axis=1), x, axis=0) * w
-
-    # 2D curvature
-    cv2d = (
-        (1 + c1 * dx**2) * c2 * d2y
-        - 2 * c1 * c2 * dx * dy * dxdy
-        + (1 + c2 * dy**2) * c1 * d2x
-    ) / (1 + c1 * dx**2 + c2 * dy**2) ** 1.5
+    arpesmap = _crop(arpesmap, roi)
+
+    data_smth = np.asarray(arpesmap, dtype=dtype or filters.float_dtype(arpesmap))
+    if bw:
+        data_smth = filters.box(data_smth, bw)
+
+    # first derivatives are reused for the second ones, the pixels are evenly spaced
+    gx = np.gradient(data_smth, axis=-2)
+    gy = np.gradient(data_smth, axis=-1)
+    dx = gx
+    dy = gy * w
+    d2x = np.gradient(gx, axis=-2)
+    d2y = np.gradient(gy, axis=-1) * w * w
+    dxdy = np.gradient(gy, axis=-2) * w
+
+    # 2D curvature, d**1.5 as d * sqrt(d) which is much cheaper than pow
+    dx2 = c1 * dx**2
+    dy2 = c2 * dy**2
+    denominator = 1 + dx2 + dy2
+    denominator *= np.sqrt(denominator)
+    cv2d = (1 + dx2) * c2 * d2y
+    cv2d -= 2 * c1 * c2 * dx * dy * dxdy
+    cv2d += (1 + dy2) * c1 * d2x
+    cv2d /= denominator
     if reduction is not None:
-        return reduction(np.abs(cv2d))
+        return _reduce(np.abs(cv2d), reduction)
     else:
         return cv2d
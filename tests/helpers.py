@@ -0,0 +1,43 @@
+"""simulator servers for the tests"""
+
+import asyncio
+import queue
+import socket
+
+import numpy as np
+import pytest
+
+from smartscan.simulator import VirtualSGM4
+
+SPECTRUM_SHAPE = (640, 400)
+
+
+def free_port() -> int:
+    with socket.socket() as s:
+        s.bind(("localhost", 0))
+        return s.getsockname()[1]
+
+
+async def start_server(n_spectra: int = 0) -> tuple[VirtualSGM4, asyncio.Task]:
+    """simulator answering on a free port, with n_spectra waiting in its output queue"""
+    server = VirtualSGM4("localhost", free_port(), save_to_file=False)
+    server.init_scan(("x", 0, 10, 1), ("y", 0, 10, 1), dwell_time=0)
+    server.limits = [0, 10, 0, 10]  # flat, as LIMITS and INFO read them
+    server.signal_shape = list(SPECTRUM_SHAPE)
+    # the spectra of a multiprocessing queue only become available one pipe at a time
+    server.output_queue = queue.Queue()
+    rng = np.random.default_rng(0)
+    for i in range(n_spectra):
+        data = rng.random(SPECTRUM_SHAPE, dtype=np.float32)
+        server.output_queue.put_nowait(([float(i % 3), 0.0], data))
+    task = asyncio.ensure_future(server.tcp_loop())
+    while server.server is None:
+        await asyncio.sleep(0.01)
+    return server, task
+
+
+async def stop_server(server: VirtualSGM4, task: asyncio.Task) -> None:
+    server.close()
+    task.cancel()
+    with pytest.raises(asyncio.CancelledError):
+        await task
@@ -0,0 +1,96 @@
+from functools import partial
+from pathlib import Path
+
+import h5py
+import numpy as np
+import yaml
+
+from smartscan import preprocessing, tasks
+from smartscan.io import load_smartscan
+from smartscan.simulator import SGM4FileManager
+from smartscan.smartscan import SmartScan
+
+SETTINGS_FILE = Path(__file__).parents[1] / "config.yaml"
+SHAPE = (200, 140)
+
+
+def preprocessing_settings() -> dict:
+    """config.yaml, with the region and the smoothing moved to preprocessing steps"""
+    with open(SETTINGS_FILE) as f:
+        settings = yaml.safe_load(f)
+    roi = settings["tasks"]["mean"]["params"]["roi"]
+    settings["preprocessing"] = {
+        "roi": {"function": "crop", "params": {"roi": roi}},
+        "smooth": {"function": "smooth", "input": "roi", "params": {"size": 2}},
+    }
+    settings["tasks"]["mean"].update(input="roi", params=None)
+    curvature = settings["tasks"]["curvature"]
+    curvature["params"].update(bw=0)
+    del curvature["params"]["roi"]
+    curvature["input"] = "smooth"
+    settings["core"] = {"n_threads": 0}
+    return settings
+
+
+def write_scan(folder: Path, positions: np.ndarray, spectra: np.ndarray) -> None:
+    """an h5 file as SGM4 saves it, with the bits load_smartscan reads"""
+    with h5py.File(folder / "scan.h5", "w") as f:
+        f.create_group("Entry/Instrument")
+        f["Entry/Data/TransformedData"] = spectra
+        details = f.create_group("Entry/Data/ScanDetails")
+        details["TruePositions"] = positions
+        details["FastAxis_length"] = np.array(SHAPE)
+        details["FastAxis_start"] = np.zeros(2)
+        details["FastAxis_step"] = np.ones(2)
+        details["FastAxis_names"] = np.array([b"energy", b"angle"])
+        details["SlowAxis_names"] = np.array([b"x", b"y"])
+
+
+def test_offline_tasks_match_the_scan(tmp_path):
+    """load_smartscan and SGM4FileManager run the preprocessing steps like SmartScan"""
+    settings = preprocessing_settings()
+    with open(tmp_path / "scan.yaml", "w") as f:
+        yaml.safe_dump(settings, f)
+    positions = np.array([[0.0, 0.0], [1.0, 0.0], [0.0, 1.0]])
+    rng = np.random.default_rng(0)
+    spectra = rng.random((len(positions), *SHAPE), dtype=np.float32)
+    write_scan(tmp_path, positions, spectra)
+
+    online = SmartScan(settings)._reduce_batch(positions, spectra)
+    offline = load_smartscan("scan", folder=tmp_path)["task_values"]
+    assert offline.shape == online.shape == (len(positions), len(settings["tasks"]))
+    assert np.allclose(offline, online, rtol=1e-5)
+
+    steps = preprocessing.build(settings["preprocessing"], ["roi", "smooth"])
+    manager = SGM4FileManager(tmp_path / "scan.h5")
+    for i, d in enumerate(settings["tasks"].values()):
+        func = partial(getattr(tasks, d["function"]), **(d["params"] or {}))
+        stack = manager.reduce(func, steps, d["input"])
+        assert np.allclose(stack[:, 2], online[:, i], rtol=1e-5), d["function"]
+
+
+def test_repeated_counts_average_to_floats(tmp_path):
+    """integer spectra measured twice are averaged without truncation"""
+    settings = preprocessing_settings()
+    with open(tmp_path / "scan.yaml", "w") as f:
+        yaml.safe_dump(settings, f)
+    positions = np.array([[0.0, 0.0], [0.0, 0.0], [1.0, 0.0]])
+    spectra = np.random.default_rng(0).integers(0, 100, (3, *SHAPE), dtype=np.uint16)
+    write_scan(tmp_path, positions, spectra)
+    unique = load_smartscan("scan", folder=tmp_path)["unique_spectra"].values
+    assert np.issubdtype(unique.dtype, np.floating)
+    assert np.allclose(unique[0], spectra[:2].mean(axis=0))
+    assert np.array_equal(unique[1], spectra[2])
+
+
+def test_file_manager_reduces_in_chunks(tmp_path):
+    """chunks of spectra reduce to the same stack as the whole file"""
+    positions = np.arange(10.0).reshape(5, 2)
+    spectra = np.random.default_rng(0).random((5, *SHAPE), dtype=np.float32)
+    write_scan(tmp_path, positions, spectra)
+    manager = SGM4FileManager(tmp_path / "scan.h5")
+    for func in ("mean", "laplace_filter", np.max):
+        whole = manager.reduce(func)
+        assert np.array_equal(manager.reduce(func, chunk_size=2), whole)
+        assert np.array_equal(whole[:, :2], positions)
+    assert np.allclose(whole[:, 2], spectra.max(axis=(1, 2)))
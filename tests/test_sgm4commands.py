@@ -0,0 +1,76 @@
+import asyncio
+
+import numpy as np
+import pytest
+
+from smartscan.sgm4commands import AsyncSGM4Commands, SGM4Commands
+
+from helpers import SPECTRUM_SHAPE, start_server, stop_server
+
+
+@pytest.mark.parametrize(
+    "name", ["ndim", "limits", "step_size", "spectrum_shape", "filename", "axes"]
+)
+def test_scan_info_needs_connect(name):
+    remote = AsyncSGM4Commands("localhost", 1)
+    with pytest.raises(RuntimeError, match="connect"):
+        getattr(remote, name)
+
+
+def test_sync_and_async_commands_agree():
+    """both classes send the same commands and parse the responses alike"""
+
+    async def run() -> None:
+        server, task = await start_server(n_spectra=4)
+        sync = SGM4Commands("localhost", server.port, data_format="binary")
+        remote = AsyncSGM4Commands("localhost", server.port, data_format="binary")
+        try:
+            await asyncio.to_thread(sync.connect)
+            await remote.connect()
+            for name in ("ndim", "limits", "step_size", "spectrum_shape", "filename"):
+                assert getattr(remote, name) == getattr(sync, name)
+            assert remote.spectrum_shape == SPECTRUM_SHAPE
+            assert remote.data_format == sync.data_format == "binary"
+            assert await remote.STATUS() == await asyncio.to_thread(sync.STATUS)
+            assert await remote.ADD_POINT(1.0, 2.0)
+            accepted, _ = await remote.ADD_POINTS(np.array([[1.0, 2.0], [3.0, 4.0]]))
+            assert np.array_equal(accepted, [[1.0, 2.0], [3.0, 4.0]])
+            positions, data = await remote.MEASURE_N(2)
+            assert data.shape == (2, *SPECTRUM_SHAPE)
+            assert data.flags.owndata
+            positions, data = await asyncio.to_thread(sync.MEASURE_N, 2)
+            assert data.shape == (2, *SPECTRUM_SHAPE)
+            assert await remote.MEASURE() == ("NO_DATA", None)
+        finally:
+            sync.disconnect()
+            remote.disconnect()
+            await stop_server(server, task)
+
+    asyncio.run(run())
+
+
+def test_wait_ready_survives_a_slice_timing_out():
+    """a WAIT_READY slice answered too late counts as unresponsive, not as a failure"""
+
+    async def run() -> None:
+        server, task = await start_server()
+        wait_ready = server.WAIT_READY
+        calls = []
+
+        async def frozen_once(timeout: str = "0") -> str:
+            calls.append(timeout)
+            if len(calls) == 1:
+                await asyncio.sleep(1)  # as the simulator freezes after START
+            return await wait_ready("0")
+
+        server.WAIT_READY = frozen_once
+        server._ready.set()
+        remote = AsyncSGM4Commands("localhost", server.port, timeout=0.3)
+        try:
+            assert await remote.WAIT_READY(5) == "IDLE"
+            assert len(calls) > 1
+        finally:
+            remote.disconnect()
+            await stop_server(server, task)
+
+    asyncio.run(run())
@@ -0,0 +1,101 @@
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+
+import numpy as np
+import pytest
+import yaml
+
+from smartscan import tasks
+from smartscan.smartscan import SmartScan
+
+from helpers import SPECTRUM_SHAPE, start_server, stop_server
+
+SETTINGS_FILE = Path(__file__).parents[1] / "config.yaml"
+
+
+def scan_settings(port: int, dtype: str, merge: bool) -> dict:
+    with open(SETTINGS_FILE) as f:
+        settings = yaml.safe_load(f)
+    settings["TCP"].update(port=port, batch_size=8, pipeline=True, roi_only=False)
+    settings["scanning"].update(dtype=dtype, merge_unique_positions=merge)
+    settings["core"] = {"n_threads": 0}  # reduce on the loop, where the tasks are spied
+    return settings
+
+
+@pytest.mark.parametrize("merge", [True, False])
+@pytest.mark.parametrize("dtype", ["float32", "float64"])
+def test_spectra_keep_the_scanning_dtype(dtype, merge, monkeypatch, tmp_path):
+    """spectra are fetched, stored, merged and reduced as scanning.dtype"""
+    reduced_dtypes = set()
+    for name in ("mean", "curvature"):
+        task = getattr(tasks, name)
+
+        def spy(x, *args, task=task, **kwargs):
+            reduced_dtypes.add(np.asarray(x).dtype)
+            return task(x, *args, **kwargs)
+
+        monkeypatch.setattr(tasks, name, spy)
+
+    async def run() -> None:
+        server, task = await start_server(n_spectra=8)
+        scan = SmartScan(scan_settings(server.port, dtype, merge))
+        try:
+            await scan.remote.connect()
+            scan.remote._filename = tmp_path / "test.h5"  # where finalize saves
+            positions, data = await scan._fetch_data()
+            assert data.shape == (8, *SPECTRUM_SHAPE)
+            assert data.dtype == dtype
+            await scan._ingest_batch(positions, data)
+        finally:
+            scan.remote.disconnect()
+            await stop_server(server, task)
+        if merge:
+            assert scan._stats.mean(positions[0]).dtype == dtype
+        else:
+            assert scan._spectra[0].dtype == dtype
+        assert reduced_dtypes == {np.dtype(dtype)}
+        assert len(scan.task_values) == (3 if merge else 8)
+
+    asyncio.run(run())
+
+
+def test_positions_on_one_node_are_merged(tmp_path):
+    """spectra 1e-12 apart are averaged into the row of their grid node"""
+    settings = scan_settings(0, "float32", merge=True)
+    settings["scanning"]["store_dir"] = str(tmp_path)
+    scan = SmartScan(settings)
+    scan.remote._axes = [np.arange(0, 10, 1.0)] * 2
+    scan.remote._filename = tmp_path / "test.h5"
+    positions = np.array([[2.0, 3.0], [2.0 + 1e-12, 3.0 - 1e-12]])
+    data = np.random.default_rng(0).random((2, *SPECTRUM_SHAPE), dtype=np.float32)
+    asyncio.run(scan._ingest_batch(positions, data))
+    assert len(scan.positions) == len(scan.task_values) == 1
+    assert scan._stats.count(positions[1]) == 2
+    assert scan.was_already_measured(positions[1])
+    assert list(scan._versions) == [(2, 3)]
+    assert np.allclose(scan._stats.mean(positions[0]), data.mean(axis=0))
+
+
+def test_a_batch_is_reduced_in_one_pool_job():
+    """the pool gets one job per batch, reducing as the event loop would"""
+    settings = scan_settings(0, "float32", merge=False)
+    settings["core"] = {"n_threads": 2, "executor": "thread"}
+    scan = SmartScan(settings)
+    jobs = []
+
+    class CountingExecutor(ThreadPoolExecutor):
+        def submit(self, fn, *args, **kwargs):
+            jobs.append(fn)
+            return super().submit(fn, *args, **kwargs)
+
+    scan._executor.shutdown()
+    scan._executor = CountingExecutor(2)
+    positions = np.zeros((4, 2))
+    data = np.random.default_rng(0).random((4, *SPECTRUM_SHAPE), dtype=np.float32)
+    try:
+        reduced = asyncio.run(scan._reduce_in_pool(positions, data))
+    finally:
+        scan._executor.shutdown()
+    assert len(jobs) == 1
+    assert np.array_equal(reduced, scan._reduce_batch(positions, data))
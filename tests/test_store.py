@@ -0,0 +1,37 @@
+import numpy as np
+
+from smartscan import store
+
+AXES = [np.arange(0, 10, 0.5), np.arange(-5, 5, 0.25)]
+POS = np.array([1.5, -0.75])
+NEAR = POS + 1e-12  # the same grid node, a different float
+
+
+def test_positions_on_one_node_share_their_statistics():
+    grid = store.GridIndex(AXES)
+    stats = store.PositionStats((4, 3), key=grid.node)
+    stats.add(POS, np.ones((4, 3)))
+    stats.add(NEAR, 3 * np.ones((4, 3)))
+    try:
+        assert len(stats) == 1
+        assert stats.count(POS) == stats.count(NEAR) == 2
+        assert np.all(stats.mean(NEAR) == 2)
+        assert np.all(stats.variance(POS) == 2)
+    finally:
+        stats.close()
+
+
+def test_positions_on_one_node_share_their_rows():
+    grid = store.GridIndex(AXES)
+    spectra = store.SpectrumStore((2,), key=grid.node)
+    table = store.TaskTable(2, 1, key=grid.node)
+    try:
+        spectra.extend([POS, NEAR], np.zeros((2, 2)))
+        assert spectra.rows(POS) == spectra.rows(NEAR) == [0, 1]
+        table.update(POS, [1.0], 0.1)
+        table.update(NEAR, [2.0], 0.1)
+        assert len(table) == 1
+        assert NEAR in table
+        assert table.values[0, 0] == 2.0
+    finally:
+        spectra.close()
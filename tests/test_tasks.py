@@ -0,0 +1,62 @@
+import numpy as np
+import pytest
+from scipy.ndimage import gaussian_filter
+
+from smartscan import filters, tasks
+
+# float32 keeps ~7 significant digits. The reductions run over ~30k pixels per frame,
+# and edge_density sums derivatives that mostly cancel, so the float32 values are held
+# to 1e-5 of the float64 ones.
+RTOL = 1e-5
+
+TASKS = {
+    "mean": {},
+    "std": {},
+    "laplace_filter": {"sigma": 3},
+    "contrast_noise_ratio": {
+        "signal_roi": [[50, 100], [40, 120]],
+        "bg_roi": [[150, 200], [0, 160]],
+    },
+    "edge_density": {},
+    "image_entropy": {},
+    "curvature": {"bw": 5},
+}
+
+
+@pytest.fixture(scope="module")
+def stack() -> np.ndarray:
+    """noisy parabolic bands on a background, one per spectrum, as float32"""
+    n, h, w = 4, 200, 160
+    y, x = np.mgrid[:h, :w]
+    bands = [
+        100 * np.exp(-(((y - 0.002 * (x - 80) ** 2 - 60 - 10 * i) / 8) ** 2)) + 20
+        for i in range(n)
+    ]
+    noise = np.random.default_rng(0).normal(0, 5, (n, h, w))
+    return np.clip(np.stack(bands) + noise, 0, 255).astype(np.float32)
+
+
+@pytest.mark.parametrize("name", TASKS)
+def test_float32_matches_float64(name, stack):
+    func = getattr(tasks, name)
+    values32 = np.asarray(func(stack, **TASKS[name]))
+    values64 = np.asarray(func(stack.astype(np.float64), **TASKS[name]))
+    assert values32.shape == values64.shape == (len(stack),)
+    assert np.allclose(values32, values64, rtol=RTOL, atol=0)
+
+
+@pytest.mark.parametrize("name", ["laplace_filter", "curvature"])
+@pytest.mark.parametrize("dtype", [np.float32, np.float64])
+def test_filters_run_in_the_dtype_of_the_input(name, dtype, stack):
+    filtered = getattr(tasks, name)(stack.astype(dtype), reduction=None)
+    assert filtered.dtype == dtype
+
+
+@pytest.mark.parametrize("sigma", [3, (2, 5), (0, 4)])
+def test_gaussian_takes_a_sigma_per_axis(sigma, stack):
+    """as scipy gaussian_filter, with the spectra of a stack smoothed apart"""
+    expected = gaussian_filter(stack.astype(np.float64), (0, *np.broadcast_to(sigma, 2)))
+    smoothed = filters.gaussian(stack.astype(np.float64), sigma)
+    assert np.allclose(smoothed, expected)
+    values = tasks.laplace_filter(stack, sigma=sigma)
+    assert values.shape == (len(stack),) and np.all(np.isfinite(values))
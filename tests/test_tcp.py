@@ -0,0 +1,172 @@
+import asyncio
+import socket
+import threading
+import time
+
+import numpy as np
+import pytest
+
+from smartscan import TCP
+
+from helpers import SPECTRUM_SHAPE, free_port, start_server, stop_server
+
+
+class EchoServer(TCP.Server):
+    """answers "BYTES n seed" with n pseudo-random bytes, as binary array messages"""
+
+    def parse_message(self, message: str) -> bytes:
+        _, n, seed = message.split()
+        return expected_bytes(int(n), int(seed))
+
+
+def expected_bytes(n: int, seed: int) -> bytes:
+    # compressible, so that compressed responses span several chunks as well
+    data = np.random.default_rng(seed).integers(0, 16, n, dtype=np.uint8)
+    return TCP.encode_array_message("BYTES", [float(seed)], data)
+
+
+async def status_latencies(client: TCP.Client, n: int = 20) -> np.ndarray:
+    latencies = []
+    for _ in range(n):
+        t0 = time.perf_counter()
+        assert await client.request("STATUS", timeout=5) == "STATUS IDLE"
+        latencies.append(time.perf_counter() - t0)
+    return np.array(latencies)
+
+
+@pytest.mark.parametrize("data_format", ["binary", "float16"])
+def test_status_is_answered_during_measure_n(data_format):
+    """a large MEASURE_N does not hold up the STATUS requests sent after it"""
+    k = 50
+
+    async def run() -> None:
+        server, task = await start_server(n_spectra=k)
+        client = TCP.Client("localhost", server.port, pipeline=True, verbose=False)
+        try:
+            await client.connect()
+            assert client.pipelined
+            assert await client.request(f"FORMAT {data_format}") == f"FORMAT {data_format}"
+            idle = await status_latencies(client)
+            measure = asyncio.ensure_future(client.request(f"MEASURE_N {k}", timeout=60))
+            await asyncio.sleep(0)  # MEASURE_N is sent first
+            busy = await status_latencies(client)
+            assert not measure.done(), "MEASURE_N finished too early to test anything"
+            response = await measure
+            assert np.median(busy) < max(10 * np.median(idle), 0.005)
+            assert busy.max() < 0.05
+            code, _, data = TCP.decode_array_message(response)
+            assert code == "MEASURE_N"
+            assert data.shape == (k, *SPECTRUM_SHAPE)
+        finally:
+            client.close()
+            await stop_server(server, task)
+
+    asyncio.run(run())
+
+
+@pytest.mark.parametrize("compression", [None, "zlib"])
+@pytest.mark.parametrize("checksum", [False, True])
+def test_pipelined_responses_are_reassembled(compression, checksum):
+    """concurrent responses of one or several chunks arrive whole and intact"""
+    sizes = [10, TCP.PIPELINE_CHUNK_SIZE, 3 * TCP.PIPELINE_CHUNK_SIZE + 7, 5_000_000]
+
+    async def run() -> None:
+        server = EchoServer("localhost", free_port(), checksum=checksum)
+        task = asyncio.ensure_future(server.tcp_loop())
+        while server.server is None:
+            await asyncio.sleep(0.01)
+        client = TCP.Client(
+            "localhost",
+            server.port,
+            checksum=checksum,
+            compression=compression,
+            compress_threshold=1024,
+            pipeline=True,
+            verbose=False,
+        )
+        try:
+            await client.connect()
+            assert client.pipelined
+            responses = await asyncio.gather(
+                *[
+                    client.request(f"BYTES {n} {seed}", timeout=10)
+                    for seed, n in enumerate(sizes * 2)
+                ]
+            )
+            for seed, (n, response) in enumerate(zip(sizes * 2, responses)):
+                assert bytes(response) == expected_bytes(n, seed)
+        finally:
+            client.close()
+            server.close()
+            task.cancel()
+            with pytest.raises(asyncio.CancelledError):
+                await task
+
+    asyncio.run(run())
+
+
+def test_measure_n_encodes_with_the_format_and_region_of_its_request():
+    """FORMAT and SET_ROI sent while MEASURE_N encodes do not change its response"""
+
+    async def run() -> None:
+        server, task = await start_server(n_spectra=2)
+        try:
+            server.FORMAT("binary")
+            server.SET_ROI("10,50", "20,80")
+            response = server.MEASURE_N("2")
+            server.FORMAT("text")
+            server.SET_ROI()
+            code, _, data = TCP.decode_array_message(await response)
+            assert code == "MEASURE_N"
+            assert data.shape == (2, 40, 60)
+        finally:
+            await stop_server(server, task)
+
+    asyncio.run(run())
+
+
+def hang_up_server() -> tuple[socket.socket, list[bytes]]:
+    """a server reading a request on each connection and closing it without answering"""
+    listener = socket.create_server(("localhost", 0))
+    received = []
+
+    def serve() -> None:
+        while True:
+            try:
+                connection, _ = listener.accept()
+            except OSError:
+                return  # the listener was closed
+            with connection:
+                received.append(connection.recv(1024))
+
+    threading.Thread(target=serve, daemon=True).start()
+    return listener, received
+
+
+def test_requests_are_not_sent_again_once_sent():
+    """a request whose response is lost may have run, and is not repeated"""
+    listener, received = hang_up_server()
+    connection = TCP.Connection("localhost", listener.getsockname()[1], timeout=5)
+    try:
+        with pytest.raises(ConnectionError):
+            connection.request("ADD_POINT 1 2")
+        assert len(received) == 1
+    finally:
+        connection.close()
+        listener.close()
+
+
+def test_async_pool_requests_are_not_sent_again_once_sent():
+    listener, received = hang_up_server()
+    pool = TCP.AsyncConnectionPool("localhost", listener.getsockname()[1], timeout=5)
+
+    async def run() -> None:
+        with pytest.raises(ConnectionError):
+            await pool.request("ADD_POINT 1 2", timeout=5)
+
+    try:
+        asyncio.run(run())
+        assert len(received) == 1
+    finally:
+        pool.close()
+        listener.close()